@@ -18,6 +18,7 @@ setup(name='SpaceDrive',
       author_email='croxis@gmail.com',
       url='http://croxis.net/',
       install_requires=[
+            'numpy',
             'pyyaml'
       ],
       package_data={
@@ -19,9 +19,12 @@ from . import celestial_components
 from . import physics_components
 
 from .graphic_system import GraphicsSystem
+from . import ephemeris
+from . import floating_origin
 from . import gui_system
 from . import orbit_system
 from . import physics_system
+from . import solar_database
 
 from . import universals
 
@@ -97,6 +100,7 @@ def init_system(system, component=None):
     log.debug("Setting up system: " + str(system))
     system = system(component)
     sandbox.add_system(system)
+    return system
 
 
 def init_graphics(system=GraphicsSystem,
@@ -138,25 +142,40 @@ def init_graphics(system=GraphicsSystem,
         sandbox.base.disableMouse()
 
 
-def init_client_net(system, component=None, address='127.0.0.1', port=1999):
-    """Sets up and registers client network system."""
-    system = system(component)
-    system.init(address, port)
-    sandbox.add_system(system)
+def init_client_net(system, component=None, address='127.0.0.1', port=1999,
+                    threaded=False):
+    """Sets up and registers client network system. With threaded it runs
+    on networking.transport, the server has to as well. Returns the system."""
+    return init_net(system, component, address, port, threaded)
+
+
+def init_server_net(system, component=None, address='127.0.0.1', port=1999,
+                    threaded=False):
+    """Sets up and registers server network system, threaded as in
+    init_client_net. Returns the system."""
+    return init_net(system, component, address, port, threaded)
 
 
-def init_server_net(system, component=None, address='127.0.0.1', port=1999):
+def init_net(system, component, address, port, threaded):
+    if threaded:
+        # Networking is optional, only load it when asked for
+        from .networking import transport
+        system = transport.make_async(system)
     system = system(component)
     system.init(address, port)
     sandbox.add_system(system)
+    return system
 
 
 def init_gui():
     init_system(gui_system.GUISystem)
 
 
-def init_solar_system():
-    pass
+def init_solar_system(filename=None, database_filename=None):
+    """Creates the solar systems of a yaml file. A precompiled database is
+    used when it is up to date, see solar_database."""
+    if filename:
+        solar_database.load(filename, database_filename)
 
 
 def init_orbits(system=orbit_system.OrbitSystem,
@@ -164,11 +183,27 @@ def init_orbits(system=orbit_system.OrbitSystem,
     init_system(system, component)
 
 
-def init_physics(system=physics_system.PhysicsSystem,
-                 component=physics_components.BulletPhysicsComponent):
+def init_floating_origin(system=floating_origin.FloatingOriginSystem,
+                         component=physics_components.BulletPhysicsComponent):
+    """Keeps the render and physics origin near the player. Register before
+    physics and graphics."""
     init_system(system, component)
 
 
+def init_physics(system=physics_system.PhysicsSystem,
+                 component=physics_components.BulletPhysicsComponent,
+                 workers=0, tick_rate=None, max_substeps=None):
+    """workers is the number of threads stepping physics zones in parallel,
+    0 steps them on the main thread. tick_rate is the fixed number of physics
+    ticks per second and max_substeps the most ticks stepped in one frame."""
+    system = init_system(system, component)
+    system.set_workers(workers)
+    if tick_rate is not None:
+        system.tick_rate = tick_rate
+    if max_substeps is not None:
+        system.max_substeps = max_substeps
+
+
 def run():
     sandbox.run()
 
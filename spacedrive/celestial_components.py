@@ -27,6 +27,8 @@ class CelestialComponent:
         self.soi = soi
         self.kind = kind
         self.orbit = orbit
+        # Compiled orbit formulas, see orbit_system.compile_orbit
+        self.orbit_elements = None
         self.radius = 1
         self.rotation = 0
         self.name = name
@@ -0,0 +1,181 @@
+"""Chebyshev ephemeris of celestial bodies.
+
+Positions of orbiting bodies are smooth, so instead of solving Kepler's
+equation for every query the orbit of each body is fitted with Chebyshev
+polynomials over windows of days. Queries inside a fitted window are a
+polynomial evaluation, for both position and velocity."""
+
+from collections import OrderedDict
+from math import floor
+
+import numpy as np
+from numpy.polynomial import chebyshev
+from panda3d.core import LPoint3d, LVector3d
+
+from . import orbit_system
+from . import universals
+
+from direct.directnotify.DirectNotify import DirectNotify
+
+log = DirectNotify().newCategory("SpaceDrive-Ephemeris")
+
+# Longest window of days fitted by one segment
+DEFAULT_WINDOW = 32.0
+# Windows are shortened so the mean anomaly never moves more than this many
+# degrees within a segment
+MAX_SEGMENT_ANGLE = 45.0
+DEFAULT_DEGREE = 12
+DEFAULT_MAX_SEGMENTS = 4096
+
+_ephemeris = None
+
+
+def get_ephemeris():
+    """Returns the shared Ephemeris."""
+    global _ephemeris
+    if _ephemeris is None:
+        _ephemeris = Ephemeris()
+    return _ephemeris
+
+
+class Segment(object):
+    """Chebyshev coefficients of the position of a body, relative to its
+    parent, for the days start to start + 2 * half_window."""
+    def __init__(self, elements, start, half_window, coefficients):
+        self.elements = elements
+        self.start = start
+        self.half_window = half_window
+        self.middle = start + half_window
+        self.coefficients = coefficients
+        # Derivative per day
+        self.derivative = chebyshev.chebder(coefficients) / half_window
+
+    def scaled(self, day):
+        return (np.asarray(day, dtype=np.float64) - self.middle) / \
+            self.half_window
+
+
+class Ephemeris(object):
+    """Cache of Chebyshev segments fitted from orbit_system.calc_body_path.
+
+    window is the longest span of days covered by one segment. Fast bodies get
+    shorter windows, see MAX_SEGMENT_ANGLE. Segments are fitted on demand and
+    the least recently used are evicted once there are more than
+    max_segments."""
+    def __init__(self, window=DEFAULT_WINDOW, degree=DEFAULT_DEGREE,
+                 max_segments=DEFAULT_MAX_SEGMENTS):
+        self.window = window
+        self.degree = degree
+        self.max_segments = max_segments
+        self.segments = OrderedDict()
+        self.windows = {}
+        # Chebyshev nodes on [-1, 1], fits through them are near minimax
+        count = degree + 1
+        self.nodes = np.cos(np.pi * (np.arange(count) + 0.5) / count)
+
+    def __len__(self):
+        return len(self.segments)
+
+    def clear(self, component=None):
+        """Drops every segment, or only those of component."""
+        if component is None:
+            self.segments.clear()
+            self.windows.clear()
+            return
+        self.windows.pop(component, None)
+        for key in [key for key in self.segments if key[0] is component]:
+            del self.segments[key]
+
+    def get_window(self, component):
+        """Returns the segment length in days used for component."""
+        window = self.windows.get(component)
+        if window is None:
+            window = self.window
+            mean_anomaly = orbit_system.get_orbit_elements(component)['M']
+            if mean_anomaly.linear is not None and mean_anomaly.linear[1]:
+                window = min(window,
+                             MAX_SEGMENT_ANGLE / abs(mean_anomaly.linear[1]))
+            self.windows[component] = window
+        return window
+
+    def get_segment(self, component, day):
+        """Returns the Segment of component covering day, fitting it if it is
+        not cached."""
+        window = self.get_window(component)
+        index = int(floor(day / window))
+        key = (component, index)
+        segment = self.segments.get(key)
+        if segment is not None:
+            if segment.elements is component.orbit_elements:
+                self.segments.move_to_end(key)
+                return segment
+            # Elements were replaced since the fit
+            self.clear(component)
+            return self.get_segment(component, day)
+        segment = self.fit(component, index * window, window)
+        self.segments[key] = segment
+        if len(self.segments) > self.max_segments:
+            self.segments.popitem(last=False)
+        return segment
+
+    def fit(self, component, start, window):
+        """Fits a new Segment of component from start over window days."""
+        half_window = window / 2.0
+        days = start + half_window + half_window * self.nodes
+        positions = orbit_system.calc_body_path(component, days)
+        coefficients = chebyshev.chebfit(self.nodes, positions, self.degree)
+        return Segment(orbit_system.get_orbit_elements(component), start,
+                       half_window, coefficients)
+
+    def position(self, component, day):
+        """Returns the position in meters of component relative to its parent
+        on the given day."""
+        segment = self.get_segment(component, day)
+        x, y, z = chebyshev.chebval(segment.scaled(day),
+                                    segment.coefficients).tolist()
+        return LPoint3d(x, y, z)
+
+    def velocity(self, component, day):
+        """Returns the velocity in meters per second of component relative to
+        its parent on the given day."""
+        segment = self.get_segment(component, day)
+        velocity = chebyshev.chebval(segment.scaled(day), segment.derivative)
+        x, y, z = (velocity / universals.SECONDSINDAY).tolist()
+        return LVector3d(x, y, z)
+
+    def positions(self, component, days):
+        """Returns a (len(days), 3) array of positions relative to the parent
+        of component. Days may span several segments."""
+        days = np.asarray(days, dtype=np.float64)
+        result = np.empty((days.size, 3), dtype=np.float64)
+        indexes = np.floor(days / self.get_window(component)).astype(np.int64)
+        for index in np.unique(indexes):
+            mask = indexes == index
+            segment = self.get_segment(component,
+                                       float(days[mask][0]))
+            result[mask] = chebyshev.chebval(segment.scaled(days[mask]),
+                                             segment.coefficients).T
+        return result
+
+    def heliocentric_position(self, component, day):
+        """Returns the heliocentric position of component on the given day,
+        adding the ephemeris of every orbiting ancestor."""
+        position = LPoint3d(0, 0, 0)
+        while component is not None:
+            if component.orbit:
+                position += self.position(component, day)
+            else:
+                position += component.true_pos
+                break
+            component = orbit_system.get_parent_component(component)
+        return position
+
+    def heliocentric_velocity(self, component, day):
+        """Returns the velocity of component in the frame of its top level
+        body on the given day, adding the ephemeris of every orbiting
+        ancestor."""
+        velocity = LVector3d(0, 0, 0)
+        while component is not None and component.orbit:
+            velocity += self.velocity(component, day)
+            component = orbit_system.get_parent_component(component)
+        return velocity
@@ -0,0 +1,131 @@
+"""Floating origin shared by physics and rendering.
+
+True positions stay in double precision in CelestialComponent and
+BulletPhysicsComponent. The render and Bullet scene graphs only hold
+positions relative to a double precision origin, kept near the camera or the
+player's ship, so float precision is best where the player is looking. When
+the focus drifts further than a threshold from the origin everything
+attached to the origin is moved back in one pass."""
+
+from panda3d.core import LPoint3d, LVector3d, NodePath, Point3, Vec3
+
+import sandbox
+
+from . import physics_components as phys_comps
+from . import universals
+
+from direct.directnotify.DirectNotify import DirectNotify
+
+log = DirectNotify().newCategory("SpaceDrive-FloatingOrigin")
+
+# Meters the focus may drift from the origin before a rebase. Floats still
+# have centimeter precision well beyond this, see physics_system notes.
+DEFAULT_THRESHOLD = 20000.0
+
+_origin = None
+
+
+def get_origin():
+    """Returns the shared FloatingOrigin of the render and physics scene."""
+    global _origin
+    if _origin is None:
+        _origin = FloatingOrigin()
+    return _origin
+
+
+class FloatingOrigin(object):
+    """Double precision origin of a float scene graph.
+
+    NodePaths attached to root are positioned relative to origin. Listeners
+    are called with the double precision shift after every rebase."""
+    def __init__(self, origin=LPoint3d(0, 0, 0), threshold=DEFAULT_THRESHOLD,
+                 name='floating origin'):
+        self.origin = LPoint3d(origin)
+        self.threshold = threshold
+        self.root = NodePath(name)
+        self.listeners = []
+        self.rebase_count = 0
+
+    def attach(self, node_path):
+        """Moves node_path under root, keeping its true position."""
+        node_path.reparent_to(self.root)
+
+    def to_local(self, true_pos):
+        """Converts a true position to a float position under root."""
+        local = true_pos - self.origin
+        return Point3(local.get_x(), local.get_y(), local.get_z())
+
+    def to_true(self, local_pos):
+        """Converts a float position under root to a true position."""
+        return LPoint3d(self.origin.get_x() + local_pos.get_x(),
+                        self.origin.get_y() + local_pos.get_y(),
+                        self.origin.get_z() + local_pos.get_z())
+
+    def get_true_pos(self, node_path):
+        """Returns the true position of a NodePath attached to root."""
+        return self.to_true(node_path.get_pos(self.root))
+
+    def set_true_pos(self, node_path, true_pos):
+        """Places a NodePath attached to root at a true position."""
+        node_path.set_pos(self.root, self.to_local(true_pos))
+
+    def needs_rebase(self, focus_true_pos):
+        return (focus_true_pos - self.origin).length() > self.threshold
+
+    def update(self, focus_true_pos):
+        """Rebases around focus_true_pos if it drifted past the threshold.
+        Returns True if a rebase happened."""
+        if self.needs_rebase(focus_true_pos):
+            self.rebase(focus_true_pos)
+            return True
+        return False
+
+    def rebase(self, new_origin):
+        """Moves the origin to new_origin and shifts every NodePath attached
+        to root so their true positions do not change.
+
+        This is a loop over the direct children of root, not one transform.
+        Moving them all at once would need a node between root and them
+        holding the shift, and that node would collect the very offset the
+        rebase removes, losing float precision again. Only the tops of the
+        attached trees are touched and only when the focus drifted past the
+        threshold, never per frame. Bullet bodies are shifted by the
+        listeners."""
+        shift = LVector3d(new_origin - self.origin)
+        offset = Vec3(shift.get_x(), shift.get_y(), shift.get_z())
+        for child in self.root.get_children():
+            child.set_pos(child.get_pos() - offset)
+        self.origin = LPoint3d(new_origin)
+        self.rebase_count += 1
+        log.debug("Rebased to " + str(self.origin))
+        for listener in self.listeners:
+            listener(shift)
+
+
+class FloatingOriginSystem(sandbox.EntitySystem):
+    """Keeps the shared origin near the focus: the entity in focus_entity,
+    the client's ship, or the camera when there is neither."""
+    focus_entity = None
+
+    def begin(self):
+        origin = get_origin()
+        focus = self.get_focus(origin)
+        if focus is not None:
+            origin.update(focus)
+
+    def get_focus(self, origin):
+        entity_id = self.focus_entity
+        if entity_id is None:
+            entity_id = universals.shipid
+        entity = sandbox.entities.get(entity_id) if entity_id is not None \
+            else None
+        if entity is not None and entity.has_component(
+                phys_comps.BulletPhysicsComponent):
+            return entity.get_component(
+                phys_comps.BulletPhysicsComponent).get_true_pos()
+        if universals.run_client:
+            return origin.get_true_pos(sandbox.base.camera)
+        return None
+
+    def process(self, entity):
+        """The rebase is done for every entity at once in begin()."""
@@ -3,28 +3,72 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import math
+
 from panda3d.core import Point3, Point3D, Vec3
 
 import sandbox
 
 from .celestial_components import CelestialComponent, StarComponent
 from .render_components import CelestialRenderComponent
+from .floating_origin import get_origin
+from . import surface_mesh
 
 
 __author__ = 'croxis'
 
+# Angular radius, in radians, above which a body gets its full mesh
+LOAD_ANGULAR_SIZE = 0.003
+# A mesh smaller than this that is also off screen is counted as idle
+RELEASE_ANGULAR_SIZE = 0.0015
+# Seconds a mesh has to stay idle before it is released
+RELEASE_DELAY = 30.0
+# Impostors never get smaller than this angular radius
+IMPOSTOR_ANGULAR_SIZE = 0.001
+# Part of the far clip plane distant bodies are squeezed into
+FAR_FRACTION = 0.9
+# Meters at which a body is drawn at the far end of the squeezed range
+HORIZON = 1.0e14
+
+
+def compress_distance(distance, start, end, horizon=HORIZON):
+    """Returns the distance a body distance meters away is drawn at.
+    Distances up to start are kept. Further ones are squeezed between start
+    and end by the logarithm of distance / start, reaching end at horizon,
+    so bodies keep their order in depth. Scaling a body by the result over
+    distance keeps its angular size."""
+    if distance <= start:
+        return distance
+    if distance >= horizon:
+        return end
+    return start + (end - start) * math.log(distance / start) \
+        / math.log(horizon / start)
+
 
 class GraphicsSystem(sandbox.EntitySystem):
+    """Places celestial bodies around the camera. The camera lives under the
+    shared FloatingOrigin so positions near it keep float precision. Bodies
+    further than half the far clip plane are drawn closer and smaller by
+    compress_distance so they stay inside it."""
     camera_entity = 0  # Entity camera is attached to for relative positioning
     current_pos = Point3D(0)
+    camera_pos = Point3(0)
     sun_pos = Point3D(0)
 
+    def init(self):
+        origin = get_origin()
+        origin.root.reparent_to(sandbox.base.render)
+        origin.attach(sandbox.base.camera)
+
     def begin(self):
         self.far_clip_plane = sandbox.base.camLens.get_far()
         self.scale_start_distance = self.far_clip_plane/2.0
         #entity = sandbox.entities[self.camera_entity]
         #entity.get_component()
         #self.current_pos = component.get_true_pos()
+        origin = get_origin()
+        self.camera_pos = sandbox.base.camera.get_pos(origin.root)
+        self.current_pos = origin.to_true(self.camera_pos)
         # Get normalized sun direction. Expand to multiple suns later
         component = sandbox.get_components(StarComponent)[0]
         entity = sandbox.get_entity(component)
@@ -36,25 +80,25 @@ class GraphicsSystem(sandbox.EntitySystem):
             render_component = entity.get_component(CelestialRenderComponent)
             celestial_component = entity.get_component(CelestialComponent)
             relative_pos = Point3D(celestial_component.true_pos - self.current_pos)
-            debug = Point3D(relative_pos)
-            debug.normalize()
-            scale_factor = 1
             radius = celestial_component.radius
-            if relative_pos.length() > self.scale_start_distance:
-                #scale_factor = (1 / (0.5**self.scale_start_distance)) * (0.5)**difference.length()
-                #scale_factor = (self.scale_start_distance / difference.length())
-                #scale_factor = (1 / (0.999999**self.scale_start_distance)) * (0.999999)**difference.length()
-                scale_factor = 1/1000.0
+            distance = relative_pos.length()
+            angular_size = radius / distance if distance else 1.0
+            drawn = compress_distance(distance, self.scale_start_distance,
+                                      self.far_clip_plane * FAR_FRACTION)
+            if drawn != distance:
+                scale_factor = drawn / distance
                 relative_pos *= scale_factor
                 radius *= scale_factor
-                # Scale again if we are too far
-                if relative_pos.length() > self.scale_start_distance:
-                    scale_factor = 1*(0.9999999)**((relative_pos.length() - self.scale_start_distance))
-                    relative_pos *= scale_factor
-                    radius *= scale_factor
-            screen_pos = Point3(relative_pos.get_x(), relative_pos.get_y(), relative_pos.get_z())
-            render_component.mesh.set_pos(screen_pos)
-            render_component.mesh.set_scale(radius)
+            screen_pos = self.camera_pos + Vec3(relative_pos.get_x(), relative_pos.get_y(), relative_pos.get_z())
+            self.update_detail(render_component, celestial_component,
+                               angular_size, screen_pos)
+            if render_component.mesh is not None:
+                render_component.mesh.set_pos(screen_pos)
+                render_component.mesh.set_scale(radius)
+            else:
+                render_component.impostor.set_pos(screen_pos)
+                render_component.impostor.set_scale(max(
+                    radius, relative_pos.length() * IMPOSTOR_ANGULAR_SIZE))
             if render_component.light:
                 #vector = self.current_pos - self.sun_pos
                 vector = self.sun_pos - self.current_pos
@@ -101,3 +145,41 @@ class GraphicsSystem(sandbox.EntitySystem):
         cameraHeight = (base.camera.getPos()-self.mesh.getPos()).length()
         self.atmo.setShaderInput("fCameraHeight", cameraHeight)
         self.atmo.setShaderInput("fCameraHeight2", cameraHeight*cameraHeight)"""
+
+    def update_detail(self, render_component, celestial_component,
+                      angular_size, screen_pos):
+        """Loads the mesh of a body once it looks big enough and releases it
+        after it spent RELEASE_DELAY seconds small and off screen. Bodies
+        without an impostor, like stars, always keep their mesh."""
+        if render_component.impostor is None:
+            return
+        if render_component.mesh is None:
+            if angular_size > LOAD_ANGULAR_SIZE:
+                self.load_mesh(render_component, celestial_component)
+            return
+        camera_pos = sandbox.base.cam.get_relative_point(sandbox.base.render,
+                                                         screen_pos)
+        if angular_size < RELEASE_ANGULAR_SIZE and \
+                not sandbox.base.camNode.is_in_view(camera_pos):
+            render_component.idle_time += globalClock.getDt()
+            if render_component.idle_time > RELEASE_DELAY:
+                self.release_mesh(render_component)
+        else:
+            render_component.idle_time = 0
+
+    def load_mesh(self, render_component, celestial_component):
+        """Creates the full mesh and textures of a body."""
+        render_component.mesh = surface_mesh.make_planet(
+            name=celestial_component.name)
+        if render_component.textures:
+            render_component.mesh.set_textures(render_component.textures)
+        render_component.mesh.reparent_to(sandbox.base.render)
+        render_component.impostor.hide()
+        render_component.idle_time = 0
+
+    def release_mesh(self, render_component):
+        """Drops the mesh and textures of a body, leaving the impostor."""
+        render_component.mesh.release()
+        render_component.mesh = None
+        render_component.impostor.show()
+        render_component.idle_time = 0
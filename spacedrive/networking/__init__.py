@@ -1,8 +1,3 @@
 __author__ = 'croxis'
 
-import capnp
-from .client_networking import ClientNetworkSystem
-
-capnp.remove_import_hook()
-
-
+from .client_networking import AsyncClientNetworkSystem, ClientNetworkSystem
@@ -0,0 +1,87 @@
+"""Throughput of the protocol codec against per field packing.
+
+The per field path packs and unpacks every value of every ship on its own,
+the way the request helpers used to build datagrams field by field. Run with
+
+    python -m spacedrive.networking.benchmark [ships] [repeats]"""
+
+import struct
+import sys
+import timeit
+
+import numpy as np
+
+from . import protocol
+
+# (field, struct format) of a POS_PHYS_UPDATE record
+FIELDS = (('ship_id', '<I'), ('soi_id', '<i'), ('band', '<B'),
+          ('px', '<i'), ('py', '<i'), ('pz', '<i'), ('quat', '<I'),
+          ('vx', '<i'), ('vy', '<i'), ('vz', '<i'),
+          ('wx', '<h'), ('wy', '<h'), ('wz', '<h'),
+          ('thrust', '<f'), ('torque', '<f'))
+
+
+def make_records(ships):
+    records = protocol.get_message(protocol.POS_PHYS_UPDATE).empty(ships)
+    rng = np.random.default_rng(0)
+    for field in records.dtype.names:
+        records[field] = rng.integers(0, 100, ships)
+    records['ship_id'] = np.arange(ships)
+    return records
+
+
+def encode_per_field(tick, ships):
+    """Packs a POS_PHYS_UPDATE one value at a time from dicts."""
+    parts = [struct.pack('<I', tick), struct.pack('<H', len(ships))]
+    for ship in ships:
+        for field, fmt in FIELDS:
+            parts.append(struct.pack(fmt, ship[field]))
+    return b''.join(parts)
+
+
+def decode_per_field(data):
+    offset = 0
+    tick, = struct.unpack_from('<I', data, offset)
+    count, = struct.unpack_from('<H', data, 4)
+    offset = 6
+    ships = []
+    for _ in range(count):
+        ship = {}
+        for field, fmt in FIELDS:
+            ship[field], = struct.unpack_from(fmt, data, offset)
+            offset += struct.calcsize(fmt)
+        ships.append(ship)
+    return tick, ships
+
+
+def run(ships=1000, repeats=200):
+    """Returns a dict of messages per second of each path."""
+    records = make_records(ships)
+    dicts = [dict(zip(records.dtype.names, record))
+             for record in records.tolist()]
+    codec = protocol.Codec()
+    encoded = bytes(codec.encode(protocol.POS_PHYS_UPDATE, (1,), records))
+    per_field = encode_per_field(1, dicts)
+    assert encoded == per_field
+    timings = {
+        'codec encode': lambda: codec.encode(protocol.POS_PHYS_UPDATE, (1,),
+                                             records),
+        'per field encode': lambda: encode_per_field(1, dicts),
+        'codec decode': lambda: protocol.decode(protocol.POS_PHYS_UPDATE,
+                                                encoded),
+        'per field decode': lambda: decode_per_field(per_field),
+    }
+    results = {}
+    for name, function in timings.items():
+        seconds = min(timeit.repeat(function, number=repeats, repeat=3))
+        results[name] = repeats / seconds
+    return results
+
+
+if __name__ == '__main__':
+    ships = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    print("POS_PHYS_UPDATE with", ships, "ships,",
+          protocol.get_message(protocol.POS_PHYS_UPDATE).size(ships), "bytes")
+    for name, rate in sorted(run(ships, repeats).items()):
+        print("{0:>18}: {1:12.1f} messages/s".format(name, rate))
@@ -1,17 +1,35 @@
 __author__ = 'croxis'
+import numpy as np
 import sandbox
 
+from . import entity_map
+from . import interpolation
+from . import outbound
+from . import protocol
+from . import quantize
+from . import replication
+from . import transport
+from .. import physics_system
+from .. import universals
+
 from direct.directnotify.DirectNotify import DirectNotify
 
 log = DirectNotify().newCategory("SpaceDrive-ClientNet")
 
 
-#PROPOSAL! {server entity id: client entity id} and reverse lookup dict too
-
-
-class ClientNetworkSystem(sandbox.UDPNetworkSystem):
+class ClientNetworkSystem(outbound.BatchedSender, sandbox.UDPNetworkSystem):
+    """Requests are queued and sent together at the end of each frame.
+    Ship updates are buffered and sampled every frame, see
+    interpolation.py. entities maps the server ids of replicated entities to
+    the client entities showing them."""
     def init2(self):
         self.packetCount = 0
+        self.quantizer = quantize.get_quantizer()
+        self.receiver = replication.SnapshotReceiver(quantizer=self.quantizer)
+        self.interpolation = interpolation.InterpolationBuffer()
+        self.entities = entity_map.EntityMap()
+        self.accept('mapEntity', self.mapEntity)
+        self.accept('unmapEntity', self.entities.remove_server)
         self.accept('login', self.sendLogin)
         self.accept('requestStations', self.requestStations)
         self.accept('requestThrottle', self.requestThrottle)
@@ -20,9 +38,26 @@ class ClientNetworkSystem(sandbox.UDPNetworkSystem):
 
     def process_packet(self, msgID, remotePacketCount, ack, acks, hashID, serialized, address):
         #If not in our protocol range then we just reject
-        if msgID < 0 or msgID > 200:
+        if msgID < 0 or msgID >= len(protocol.MESSAGES):
+            return
+        if msgID == protocol.BATCH:
+            for sub_id, payload in outbound.unpack_batch(serialized):
+                self.process_packet(sub_id, remotePacketCount, ack, acks,
+                                    hashID, payload, address)
+            return
+        if msgID == protocol.POS_PHYS_DELTA:
+            data = self.receiver.decode(serialized)
+            if data is not None:
+                tick, records = data
+                self.interpolation.push(tick, self.quantizer.decode(records),
+                                        globalClock.getFrameTime())
+                # The server uses the newest rebuilt tick as the baseline
+                self.send_message(protocol.SNAPSHOT_ACK,
+                                  (self.receiver.latest_tick,))
+            return
+        data = protocol.decode(msgID, serialized)
+        if data is None:
             return
-        data = protocol.readProto(msgID, serialized)
         if msgID == protocol.CONFIRM_STATIONS:
             sandbox.send('shipUpdate', [data, True])
             sandbox.send('setShipID', [data])
@@ -31,37 +66,76 @@ class ClientNetworkSystem(sandbox.UDPNetworkSystem):
             sandbox.send('shipUpdates', [data])
             sandbox.send('shipSelectScreen', [data])
         elif msgID == protocol.POS_PHYS_UPDATE:
-            sandbox.send('shipUpdates', [data])
+            values, records = data
+            records = np.sort(records, order='ship_id')
+            self.interpolation.push(values.tick,
+                                    self.quantizer.decode(records),
+                                    globalClock.getFrameTime())
         elif msgID == protocol.SHIP_CLASSES:
             sandbox.send('shipClassList', [data])
 
     def sendLogin(self, serverAddress):
         self.serverAddress = serverAddress
-        datagram = self.generateGenericPacket(protocol.LOGIN)
-        universals.log.debug("sending login")
-        self.send(datagram)
+        log.debug("sending login")
+        self.send_message(protocol.LOGIN,
+                          (protocol.to_bytes(universals.username),))
 
     def requestCreateShip(self, shipName, className):
-        datagram = protocol.requestCreateShip(shipName, className)
-        self.send(datagram)
+        self.send_message(protocol.REQUEST_CREATE_SHIP,
+                          (protocol.to_bytes(shipName),
+                           protocol.to_bytes(className)))
 
     def requestStations(self, shipid, stations):
-        datagram = protocol.requestStations(shipid, stations)
-        self.send(datagram)
+        records = protocol.get_message(protocol.REQUEST_STATIONS).empty(
+            len(stations))
+        records['station'] = [protocol.to_bytes(station)
+                               for station in stations]
+        self.send_message(protocol.REQUEST_STATIONS, (shipid,), records)
 
     def requestThrottle(self, throttle, heading):
-        datagram = protocol.requestThrottle(throttle, heading)
-        self.send(datagram)
+        self.send_message(protocol.REQUEST_THROTTLE, (throttle, heading))
 
     def requestTarget(self, targetID):
-        datagram = protocol.requestTurretTarget(targetID)
-        self.send(datagram)
+        self.send_message(protocol.REQUEST_TARGET, (targetID,))
+
+    def send_message(self, msg_id, values=(), records=None):
+        """Encodes a protocol message and queues it for the server."""
+        self.queue_message(self.serverAddress, msg_id,
+                           protocol.encode(msg_id, values, records))
+
+    def end(self):
+        """Sends the queued requests and the ships to draw this frame in a
+        'shipStates' event: their states relative to the SOI body, client
+        ids and true positions. Ships are only drawn once a PhysicsSystem has
+        the SOI bodies."""
+        self.flush_messages()
+        snapshot = self.interpolation.sample(globalClock.getFrameTime())
+        physics = physics_system.get_physics()
+        soi_index = None if physics is None else physics.soi_index
+        if snapshot is not None and soi_index is not None:
+            sandbox.send('shipStates', [
+                snapshot, self.entities.to_client(snapshot['ship_id']),
+                quantize.to_true_positions(snapshot, soi_index)])
+
+    def mapEntity(self, serverID, entity):
+        """Links a client entity to the server entity it shows."""
+        component = ServerComponent()
+        component.serverEntityID = serverID
+        component.handle = self.entities.add(serverID, entity.id)
+        entity.add_component(component)
 
     def send(self, datagram):
         self.send_data(datagram, self.serverAddress)
 
 
-class ServerComponent:
-    """Theoretical component for server generated and sent entities"""
-    serverEntityID = 0
-    lastServerUpdate = 0
+class AsyncClientNetworkSystem(transport.AsyncUDPMixin, ClientNetworkSystem):
+    """ClientNetworkSystem receiving on the network thread of transport.py,
+    for servers on it as well."""
+
+
+class ServerComponent(object):
+    """Component of client entities replicated from the server. handle is
+    the (client id, generation) of the entity in ClientNetworkSystem.entities,
+    check it with EntityMap.is_valid before trusting serverEntityID."""
+    serverEntityID = entity_map.NO_ENTITY
+    handle = None
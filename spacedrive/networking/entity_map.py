@@ -0,0 +1,128 @@
+"""Mapping between server and client entity ids.
+
+Entity ids are small integers, so both directions are numpy arrays indexed
+by id and grown on demand. A lookup is one array read and a whole message
+of ship ids is remapped with one fancy index. Client ids get a generation
+every time they are mapped, a (client id, generation) handle kept by a
+component stops being valid once the id is unmapped or reused."""
+
+import numpy as np
+
+from direct.directnotify.DirectNotify import DirectNotify
+
+log = DirectNotify().newCategory("SpaceDrive-EntityMap")
+
+NO_ENTITY = -1
+# Ids covered by the arrays up front, doubled when a larger id is mapped
+DEFAULT_SIZE = 256
+
+
+def lookup(table, ids):
+    """Returns table[ids] with NO_ENTITY for ids outside of table."""
+    ids = np.asarray(ids, dtype=np.int64)
+    result = np.full(ids.shape, NO_ENTITY, dtype=np.int64)
+    inside = (ids >= 0) & (ids < len(table))
+    result[inside] = table[ids[inside]]
+    return result
+
+
+class EntityMap(object):
+    """Two way map of server and client entity ids.
+
+    server_to_client[server id] and client_to_server[client id] hold the
+    other id or NO_ENTITY. generations[client id] counts the times the id was
+    mapped."""
+    def __init__(self, size=DEFAULT_SIZE):
+        self.server_to_client = np.full(size, NO_ENTITY, dtype=np.int64)
+        self.client_to_server = np.full(size, NO_ENTITY, dtype=np.int64)
+        self.generations = np.zeros(size, dtype=np.uint32)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def reserve(self, server_id, client_id):
+        """Grows the arrays to hold server_id and client_id."""
+        size = len(self.server_to_client)
+        if server_id >= size:
+            while size <= server_id:
+                size *= 2
+            grown = np.full(size, NO_ENTITY, dtype=np.int64)
+            grown[:len(self.server_to_client)] = self.server_to_client
+            self.server_to_client = grown
+        size = len(self.client_to_server)
+        if client_id >= size:
+            while size <= client_id:
+                size *= 2
+            grown = np.full(size, NO_ENTITY, dtype=np.int64)
+            grown[:len(self.client_to_server)] = self.client_to_server
+            self.client_to_server = grown
+            generations = np.zeros(size, dtype=np.uint32)
+            generations[:len(self.generations)] = self.generations
+            self.generations = generations
+
+    def add(self, server_id, client_id):
+        """Maps server_id to client_id, replacing earlier mappings of either.
+        Returns the handle of client_id."""
+        if server_id < 0 or client_id < 0:
+            raise ValueError("Entity ids must not be negative")
+        self.remove_server(server_id)
+        self.remove_client(client_id)
+        self.reserve(server_id, client_id)
+        self.server_to_client[server_id] = client_id
+        self.client_to_server[client_id] = server_id
+        self.generations[client_id] += 1
+        self.count += 1
+        return client_id, int(self.generations[client_id])
+
+    def remove_server(self, server_id):
+        """Unmaps server_id. Returns its client id or NO_ENTITY."""
+        client_id = self.get_client(server_id)
+        if client_id != NO_ENTITY:
+            self.server_to_client[server_id] = NO_ENTITY
+            self.client_to_server[client_id] = NO_ENTITY
+            self.count -= 1
+        return client_id
+
+    def remove_client(self, client_id):
+        """Unmaps client_id. Returns its server id or NO_ENTITY."""
+        server_id = self.get_server(client_id)
+        if server_id != NO_ENTITY:
+            self.remove_server(server_id)
+        return server_id
+
+    def clear(self):
+        self.server_to_client[:] = NO_ENTITY
+        self.client_to_server[:] = NO_ENTITY
+        self.count = 0
+
+    def get_client(self, server_id):
+        if 0 <= server_id < len(self.server_to_client):
+            return int(self.server_to_client[server_id])
+        return NO_ENTITY
+
+    def get_server(self, client_id):
+        if 0 <= client_id < len(self.client_to_server):
+            return int(self.client_to_server[client_id])
+        return NO_ENTITY
+
+    def get_handle(self, client_id):
+        """Returns (client_id, generation) of a mapped client id or None."""
+        if self.get_server(client_id) == NO_ENTITY:
+            return None
+        return client_id, int(self.generations[client_id])
+
+    def is_valid(self, handle):
+        """True while the client id of handle is still mapped to the same
+        server entity."""
+        client_id, generation = handle
+        return (self.get_server(client_id) != NO_ENTITY
+                and self.generations[client_id] == generation)
+
+    def to_client(self, server_ids):
+        """Returns the client ids of an array of server ids, NO_ENTITY for the
+        unmapped ones."""
+        return lookup(self.server_to_client, server_ids)
+
+    def to_server(self, client_ids):
+        return lookup(self.client_to_server, client_ids)
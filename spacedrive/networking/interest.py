@@ -0,0 +1,104 @@
+"""Interest management of replicated ships.
+
+A ship is relevant to a client when it is close to the client's ship or in
+a SOI next to the client's in the SOI hierarchy: the same body, one of its
+ancestors or one of its moons. Relevant ships are updated at a rate set by
+their distance band. Every relevant ship of a client has a priority
+accumulator that grows by its band rate each tick, ships are due once it
+reaches one and the due ships with the largest accumulators are sent until
+the bandwidth budget of the tick is used up."""
+
+import numpy as np
+
+from .replication import RECORD
+
+from direct.directnotify.DirectNotify import DirectNotify
+
+log = DirectNotify().newCategory("SpaceDrive-Interest")
+
+# (distance in meters up to which the band applies, ticks between updates).
+# The last band covers the rest of the neighboring SOIs.
+DEFAULT_BANDS = (
+    (10000.0, 1),
+    (100000.0, 3),
+    (1000000.0, 10),
+    (np.inf, 30),
+)
+# Bytes of ship updates sent to one client per tick
+DEFAULT_BUDGET = 1400
+# Bytes of a ship with every field changed, its id and its mask
+RECORD_COST = RECORD.itemsize + 4 + 2
+# New ships start due so they show up at once
+NEW_PRIORITY = 1.0
+
+
+class InterestManager(object):
+    """Chooses the ships sent to each client every tick.
+
+    soi_index is a soi_index.SOIIndex used for the SOI neighborhood, without
+    one only distance counts."""
+    def __init__(self, soi_index=None, bands=DEFAULT_BANDS,
+                 budget=DEFAULT_BUDGET, record_cost=RECORD_COST):
+        self.soi_index = soi_index
+        self.distances = np.array([band[0] for band in bands])
+        self.rates = np.array([1.0 / band[1] for band in bands])
+        self.budget = budget
+        self.record_cost = record_cost
+        # address: (relevant ids, accumulators)
+        self.clients = {}
+
+    def remove_client(self, address):
+        self.clients.pop(address, None)
+
+    def get_neighborhood(self, soi_id):
+        """Returns the entity ids of the SOI soi_id, its ancestors and its
+        children."""
+        soi_index = self.soi_index
+        index = soi_index.index_of.get(soi_id)
+        if index is None:
+            return np.empty(0, dtype=np.int64)
+        indexes = soi_index.perturbers(index)
+        return np.array([soi_index.ids[i] for i in indexes], dtype=np.int64)
+
+    def get_relevance(self, snapshot, focus_position, focus_soi):
+        """Returns (relevant mask, update rate) of every ship of snapshot for
+        a client whose ship is at focus_position in focus_soi."""
+        offsets = np.stack([snapshot[axis] for axis in ('x', 'y', 'z')],
+                           axis=1) - np.asarray(focus_position)
+        distances = np.sqrt(np.einsum('nj,nj->n', offsets, offsets))
+        bands = np.minimum(np.searchsorted(self.distances, distances),
+                           len(self.distances) - 1)
+        rates = self.rates[bands]
+        near = distances <= self.distances[0]
+        if self.soi_index is None or focus_soi is None:
+            related = np.ones(len(snapshot), dtype=bool)
+        else:
+            related = np.isin(snapshot['soi_id'],
+                              self.get_neighborhood(focus_soi))
+        relevant = near | (related & (distances <= self.distances[-1]))
+        return relevant, rates
+
+    def select(self, address, snapshot, focus_position, focus_soi=None):
+        """Returns (selected ids, relevant ids) of snapshot for the client at
+        address this tick, to pass to Replicator.encode."""
+        relevant, rates = self.get_relevance(snapshot, focus_position,
+                                             focus_soi)
+        ids = snapshot['ship_id'][relevant]
+        accumulators = np.full(len(ids), NEW_PRIORITY)
+        previous = self.clients.get(address)
+        if previous is not None and len(previous[0]):
+            previous_ids, previous_accumulators = previous
+            rows = np.minimum(np.searchsorted(previous_ids, ids),
+                              len(previous_ids) - 1)
+            known = previous_ids[rows] == ids
+            accumulators[known] = previous_accumulators[rows[known]]
+        accumulators += rates[relevant]
+        due = np.flatnonzero(accumulators >= 1.0)
+        count = int(self.budget // self.record_cost)
+        if len(due) > count:
+            # Largest accumulators first, ties to the lowest id
+            due = due[np.argsort(-accumulators[due], kind='stable')[:count]]
+            due.sort()
+        accumulators[due] = 0.0
+        self.clients[address] = (ids, accumulators)
+        return ids[due], ids
@@ -0,0 +1,160 @@
+"""Client side interpolation of replicated ships.
+
+Snapshots from the server are buffered with their tick and ships are drawn
+delay seconds in the past, between the two snapshots around that time, so
+ships move smoothly at any packet rate. Ships are kept relative to their SOI
+body as decoded by quantize.py. Positions follow a cubic Hermite
+curve through the positions and velocities of both snapshots. When the next
+snapshot is late ships keep moving along their velocity for at most
+max_extrapolation seconds and then hold.
+
+Server time is estimated from the arrival time of each snapshot. The
+estimate follows slowly to hide jitter and jumps when it is far off, after a
+stall or a server restart."""
+
+import bisect
+
+import numpy as np
+
+from .. import trajectory
+from .replication import DEFAULT_TICK_RATE
+
+from direct.directnotify.DirectNotify import DirectNotify
+
+log = DirectNotify().newCategory("SpaceDrive-Interpolation")
+
+# Seconds ships are drawn behind the newest server time, cover two to three
+# packets at the send rate
+DEFAULT_DELAY = 0.1
+# Seconds ships may move past the newest snapshot
+MAX_EXTRAPOLATION = 0.25
+# Snapshots kept, older ones are dropped once the render time passes them
+CAPACITY = 32
+# Fraction of the clock error corrected per snapshot
+OFFSET_SMOOTHING = 0.1
+# Seconds the clock may be off before it jumps
+RESYNC = 1.0
+
+_POSITION = ('x', 'y', 'z')
+_VELOCITY = ('vx', 'vy', 'vz')
+_QUAT = ('qw', 'qx', 'qy', 'qz')
+_LINEAR = ('wx', 'wy', 'wz', 'thrust', 'torque')
+
+
+def get_columns(snapshot, fields):
+    return np.stack([snapshot[field] for field in fields],
+                    axis=1).astype(np.float64)
+
+
+def set_columns(snapshot, fields, values):
+    for column, field in enumerate(fields):
+        snapshot[field] = values[:, column]
+
+
+def interpolate(before, after, fraction, dt):
+    """Returns the ships of after, dt seconds after before, fraction of the
+    way from their state in before. Ships not in before, or in another SOI
+    there, are as in after."""
+    result = after.copy()
+    if not len(before) or not len(after):
+        return result
+    rows = np.minimum(np.searchsorted(before['ship_id'], after['ship_id']),
+                      len(before) - 1)
+    known = np.flatnonzero((before['ship_id'][rows] == after['ship_id'])
+                           & (before['soi_id'][rows] == after['soi_id']))
+    old = before[rows[known]]
+    new = after[known]
+    fields = _POSITION + _VELOCITY
+    states = trajectory.hermite(0.0, get_columns(old, fields), dt,
+                                get_columns(new, fields), fraction * dt)
+    q0 = get_columns(old, _QUAT)
+    q1 = get_columns(new, _QUAT)
+    # Take the short way around
+    q1[np.einsum('nj,nj->n', q0, q1) < 0] *= -1.0
+    quats = q0 + (q1 - q0) * fraction
+    quats /= np.linalg.norm(quats, axis=1)[:, None]
+    values = get_columns(old, _LINEAR)
+    values += (get_columns(new, _LINEAR) - values) * fraction
+    blended = result[known]
+    set_columns(blended, fields, states)
+    set_columns(blended, _QUAT, quats)
+    set_columns(blended, _LINEAR, values)
+    result[known] = blended
+    return result
+
+
+def extrapolate(snapshot, dt):
+    """Returns a copy of snapshot with positions moved along the velocities
+    for dt seconds. Orientations are kept."""
+    result = snapshot.copy()
+    for position, velocity in zip(_POSITION, _VELOCITY):
+        result[position] += result[velocity] * dt
+    return result
+
+
+class InterpolationBuffer(object):
+    """Timestamped snapshots of the replicated ships, sorted by ship_id, and
+    the estimated server clock. Times are local seconds, the frame time of
+    the client."""
+    def __init__(self, tick_rate=DEFAULT_TICK_RATE, delay=DEFAULT_DELAY,
+                 max_extrapolation=MAX_EXTRAPOLATION, capacity=CAPACITY):
+        self.tick_rate = tick_rate
+        self.delay = delay
+        self.max_extrapolation = max_extrapolation
+        self.capacity = capacity
+        self.ticks = []
+        self.snapshots = []
+        # Server seconds minus local seconds
+        self.offset = None
+
+    def __len__(self):
+        return len(self.ticks)
+
+    def clear(self):
+        self.ticks = []
+        self.snapshots = []
+        self.offset = None
+
+    def push(self, tick, snapshot, now):
+        """Adds the snapshot of server tick received at now. Duplicates and
+        snapshots older than the buffer are ignored."""
+        sample = tick / self.tick_rate - now
+        if self.offset is None or abs(sample - self.offset) > RESYNC:
+            self.offset = sample
+        else:
+            self.offset += (sample - self.offset) * OFFSET_SMOOTHING
+        index = bisect.bisect_left(self.ticks, tick)
+        if index < len(self.ticks) and self.ticks[index] == tick:
+            return
+        if index == 0 and len(self.ticks) >= self.capacity:
+            return
+        self.ticks.insert(index, tick)
+        self.snapshots.insert(index, snapshot)
+        if len(self.ticks) > self.capacity:
+            del self.ticks[0]
+            del self.snapshots[0]
+
+    def get_render_time(self, now):
+        """Returns the server time in seconds drawn at now."""
+        return now + self.offset - self.delay
+
+    def sample(self, now):
+        """Returns the snapshot of the ships to draw at now, or None before
+        the first snapshot arrived."""
+        if not self.ticks:
+            return None
+        render_tick = self.get_render_time(now) * self.tick_rate
+        index = bisect.bisect_right(self.ticks, render_tick)
+        if index == 0:
+            return self.snapshots[0].copy()
+        # Earlier snapshots are not needed again
+        del self.ticks[:index - 1]
+        del self.snapshots[:index - 1]
+        if len(self.ticks) == 1:
+            dt = (render_tick - self.ticks[0]) / self.tick_rate
+            return extrapolate(self.snapshots[0],
+                               min(dt, self.max_extrapolation))
+        before, after = self.ticks[:2]
+        return interpolate(self.snapshots[0], self.snapshots[1],
+                           (render_tick - before) / (after - before),
+                           (after - before) / self.tick_rate)
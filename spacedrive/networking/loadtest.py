@@ -0,0 +1,475 @@
+"""Loopback load test of the server network code.
+
+A server started with init_server_net replicates synthetic ships to clients
+simulated by worker processes, each running several ClientNetworkSystems.
+Both ends use the threaded transport. Clients talk to the server through a
+relay in the parent process that adds latency, jitter, loss and reordering.
+Everything runs on 127.0.0.1. Run with
+
+    python -m spacedrive.networking.loadtest --clients 32 --latency 0.05
+
+The report has the server CPU time per tick, the bytes sent to each client
+per second it was logged in and the latency from the server sending a tick
+to a client decoding it. The CPU time is that of the whole server process
+between two ticks, all of its threads: receiving, process_packet, the task
+manager and encoding. Ticks before the first client logged in are left out.
+Clients spawn and log in before the measured duration starts.
+Clients are bound to consecutive ports after --port, the relay listens on
+--port and the server on --port - 1."""
+
+import argparse
+import heapq
+import math
+import multiprocessing
+import queue
+import random
+import selectors
+import socket
+import threading
+import time
+
+import numpy as np
+
+from direct.directnotify.DirectNotify import DirectNotify
+
+log = DirectNotify().newCategory("SpaceDrive-LoadTest")
+
+HOST = '127.0.0.1'
+DEFAULT_PORT = 2100
+DEFAULT_TICK_RATE = 60.0
+# Ships orbiting SOI 0 at radii spread over the quantization bands
+DEFAULT_SHIPS = 64
+# Seconds between the throttle requests of a client
+REQUEST_INTERVAL = 0.05
+PERCENTILES = (50, 90, 99)
+# Seconds a process may take to report, on top of the test duration
+RESULT_TIMEOUT = 60.0
+# Seconds between the checks of a process dying before it reported
+RESULT_POLL = 0.5
+_DATAGRAM = 65536
+
+
+class Impairment(object):
+    """Network conditions of the relay. latency and jitter are seconds each
+    way, loss and reorder probabilities per datagram. A reordered datagram
+    is held for another latency plus jitter."""
+    def __init__(self, latency=0.0, jitter=0.0, loss=0.0, reorder=0.0,
+                 seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.reorder = reorder
+        self.random = random.Random(seed)
+
+    def get_delay(self):
+        """Returns the seconds to hold a datagram or None to drop it."""
+        if self.random.random() < self.loss:
+            return None
+        delay = self.latency + self.random.uniform(-self.jitter, self.jitter)
+        if self.random.random() < self.reorder:
+            delay += self.latency + self.jitter
+        return max(delay, 0.0)
+
+
+class Relay(threading.Thread):
+    """Forwards datagrams between clients and the server with an
+    Impairment. Each client gets its own socket towards the server, so the
+    server sees one address per client."""
+    def __init__(self, port, server_address, impairment):
+        threading.Thread.__init__(self, name='loadtest-relay')
+        self.daemon = True
+        self.server_address = server_address
+        self.impairment = impairment
+        self.selector = selectors.DefaultSelector()
+        self.front = self.make_socket(port)
+        # client address: socket towards the server
+        self.upstream = {}
+        # (due time, order, socket, data, destination)
+        self.pending = []
+        self.order = 0
+        self.running = True
+
+    def make_socket(self, port=0):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((HOST, port))
+        sock.setblocking(False)
+        self.selector.register(sock, selectors.EVENT_READ)
+        return sock
+
+    def stop(self):
+        self.running = False
+
+    def hold(self, sock, data, destination):
+        delay = self.impairment.get_delay()
+        if delay is not None:
+            self.order += 1
+            heapq.heappush(self.pending, (time.time() + delay, self.order,
+                                          sock, data, destination))
+
+    def run(self):
+        clients = {}
+        while self.running:
+            timeout = 0.01
+            if self.pending:
+                timeout = min(max(self.pending[0][0] - time.time(), 0.0),
+                              timeout)
+            for key, _ in self.selector.select(timeout):
+                sock = key.fileobj
+                while True:
+                    try:
+                        data, address = sock.recvfrom(_DATAGRAM)
+                    except (BlockingIOError, InterruptedError):
+                        break
+                    except OSError:
+                        # Port unreachable of a client that already stopped
+                        continue
+                    if sock is self.front:
+                        upstream = self.upstream.get(address)
+                        if upstream is None:
+                            upstream = self.upstream[address] = \
+                                self.make_socket()
+                            clients[upstream] = address
+                        self.hold(upstream, data, self.server_address)
+                    else:
+                        self.hold(self.front, data, clients[sock])
+            now = time.time()
+            while self.pending and self.pending[0][0] <= now:
+                _, _, sock, data, destination = heapq.heappop(self.pending)
+                try:
+                    sock.sendto(data, destination)
+                except OSError:
+                    pass
+        for key in list(self.selector.get_map().values()):
+            key.fileobj.close()
+        self.selector.close()
+
+
+def make_states(ships, seconds):
+    """Returns the true STATE of ships in circular orbits around SOI 0 at
+    the origin, seconds in."""
+    from .quantize import STATE
+    states = np.zeros(ships, dtype=STATE)
+    states['ship_id'] = np.arange(ships)
+    radii = np.logspace(4, 9, ships) if ships else np.zeros(0)
+    speeds = np.sqrt(3.986e14 / radii)
+    angles = speeds / radii * seconds + np.arange(ships)
+    states['x'] = radii * np.cos(angles)
+    states['y'] = radii * np.sin(angles)
+    states['vx'] = -speeds * np.sin(angles)
+    states['vy'] = speeds * np.cos(angles)
+    # Nose along the velocity, a rotation about z
+    states['qw'] = np.cos((angles + math.pi / 2) / 2)
+    states['qz'] = np.sin((angles + math.pi / 2) / 2)
+    states['wz'] = speeds / radii
+    return states
+
+
+def make_server_system():
+    import sandbox
+
+    from . import outbound
+    from . import protocol
+    from . import quantize
+    from . import replication
+
+    class LoadTestServerSystem(sandbox.UDPNetworkSystem):
+        """Replicates make_states() to every client that logged in, one
+        POS_PHYS_DELTA per tick."""
+        ships = DEFAULT_SHIPS
+        tick_rate = DEFAULT_TICK_RATE
+
+        def init2(self):
+            self.tick = 0
+            self.replicator = replication.Replicator(self.tick_rate)
+            self.quantizer = quantize.get_quantizer()
+            self.clients = []
+            self.bytes_sent = {}
+            self.bytes_received = {}
+            self.login_times = {}
+            self.sent_times = {}
+            self.cpu_times = []
+            self.last_cpu_time = None
+
+        def process_packet(self, msgID, remotePacketCount, ack, acks,
+                           hashID, serialized, address):
+            if msgID == protocol.BATCH:
+                for sub_id, payload in outbound.unpack_batch(serialized):
+                    self.process_packet(sub_id, remotePacketCount, ack, acks,
+                                        hashID, payload, address)
+                return
+            self.bytes_received[address] = \
+                self.bytes_received.get(address, 0) + len(serialized)
+            if msgID == protocol.LOGIN:
+                # A client logging in again starts over from a full snapshot
+                self.replicator.remove_client(address)
+                if address not in self.bytes_sent:
+                    self.clients.append(address)
+                    self.bytes_sent[address] = 0
+                    self.login_times[address] = time.time()
+            elif msgID == protocol.SNAPSHOT_ACK and address in self.bytes_sent:
+                data = protocol.decode(msgID, serialized)
+                if data is not None:
+                    self.replicator.acknowledge(address, data[0].tick)
+
+        def end(self):
+            now = time.process_time()
+            if self.clients and self.last_cpu_time is not None:
+                self.cpu_times.append(now - self.last_cpu_time)
+            self.last_cpu_time = now
+            self.tick += 1
+            states = make_states(self.ships, self.tick / self.tick_rate)
+            zeros = np.zeros((self.ships, 3))
+            records = self.quantizer.encode(states, zeros, zeros)
+            self.sent_times[self.tick] = time.time()
+            for address in self.clients:
+                payload = self.replicator.encode(address, self.tick, records)
+                datagram = self.generateGenericPacket(protocol.POS_PHYS_DELTA)
+                datagram.appendData(payload)
+                self.send_data(datagram, address)
+                self.bytes_sent[address] += len(payload)
+
+    return LoadTestServerSystem
+
+
+def make_client_system(index):
+    from . import protocol
+    from .client_networking import ClientNetworkSystem
+
+    class LoadTestClientSystem(ClientNetworkSystem):
+        """ClientNetworkSystem recording when each tick was decoded."""
+        def init2(self):
+            ClientNetworkSystem.init2(self)
+            self.received = []
+            self.dropped = 0
+            self.bytes_received = 0
+            self.last_request = 0.0
+
+        def process_packet(self, msgID, remotePacketCount, ack, acks,
+                           hashID, serialized, address):
+            self.bytes_received += len(serialized)
+            ClientNetworkSystem.process_packet(
+                self, msgID, remotePacketCount, ack, acks, hashID, serialized,
+                address)
+            if msgID == protocol.POS_PHYS_DELTA:
+                data = protocol.decode(msgID, serialized)
+                tick = None if data is None else data[0].tick
+                if tick in self.receiver.snapshots:
+                    self.received.append((tick, time.time()))
+                else:
+                    self.dropped += 1
+
+        def end(self):
+            now = time.time()
+            if now - self.last_request >= REQUEST_INTERVAL:
+                self.last_request = now
+                self.requestThrottle(random.random(), random.random())
+            ClientNetworkSystem.end(self)
+
+        def sendLogin(self, serverAddress):
+            # universals.username is shared by every client of the worker
+            self.serverAddress = serverAddress
+            self.send_message(protocol.LOGIN,
+                              (protocol.to_bytes(self.username),))
+
+    # Systems are looked up by class, give every client its own
+    return type('LoadTestClientSystem' + str(index), (LoadTestClientSystem,),
+                {'username': 'loadtest' + str(index)})
+
+
+def run_loop(tick_rate, running):
+    """Steps the sandbox task manager at tick_rate while running()
+    returns True."""
+    import sandbox
+    interval = 1.0 / tick_rate
+    next_frame = time.time()
+    while running():
+        sandbox.base.taskMgr.step()
+        next_frame += interval
+        delay = next_frame - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            next_frame = time.time()
+
+
+def run_server(port, ships, tick_rate, stop, results):
+    import spacedrive
+    spacedrive.init(run_server=True, log_level='warning')
+    system = make_server_system()
+    system.ships = ships
+    system.tick_rate = tick_rate
+    server = spacedrive.init_server_net(system, address=HOST, port=port,
+                                        threaded=True)
+    results.put(('ready', None))
+    run_loop(tick_rate, lambda: not stop.is_set())
+    now = time.time()
+    server.stop()
+    results.put(('server', {
+        'sent_times': server.sent_times,
+        'cpu_times': server.cpu_times,
+        'bytes_sent': list(server.bytes_sent.values()),
+        'bytes_received': list(server.bytes_received.values()),
+        'seconds': [now - server.login_times[address]
+                    for address in server.bytes_sent],
+    }))
+
+
+def run_clients(first, count, port, relay_port, tick_rate, duration, start,
+                results):
+    import spacedrive
+    spacedrive.init(run_client=False, log_level='warning')
+    clients = []
+    for index in range(first, first + count):
+        system = make_client_system(index)
+        clients.append(spacedrive.init_client_net(
+            system, address=HOST, port=port + index, threaded=True))
+    # Spawning is not measured, log in once every worker is up
+    results.put(('ready', None))
+    start.wait()
+    for client in clients:
+        client.sendLogin((HOST, relay_port))
+    deadline = time.time() + duration
+    run_loop(tick_rate, lambda: time.time() < deadline)
+    for client in clients:
+        client.stop()
+    results.put(('clients', [{
+        'received': client.received,
+        'dropped': client.dropped,
+        'bytes_received': client.bytes_received,
+    } for client in clients]))
+
+
+def get_result(results, processes, timeout=RESULT_TIMEOUT):
+    """Returns the next item put in results. Raises RuntimeError if one of
+    processes exited with an error or nothing came within timeout
+    seconds."""
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return results.get(timeout=RESULT_POLL)
+        except queue.Empty:
+            pass
+        for process in processes:
+            if process.exitcode:
+                raise RuntimeError(process.name + " exited with code "
+                                   + str(process.exitcode))
+        if time.time() >= deadline:
+            raise RuntimeError("No result within " + str(timeout)
+                               + " seconds")
+
+
+def run(clients=8, workers=None, ships=DEFAULT_SHIPS, duration=10.0,
+        tick_rate=DEFAULT_TICK_RATE, port=DEFAULT_PORT,
+        impairment=None):
+    """Runs a load test and returns its report as a dict."""
+    if workers is None:
+        workers = min(clients, multiprocessing.cpu_count())
+    workers = max(min(workers, clients), 1)
+    impairment = impairment or Impairment()
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    server_port = port - 1
+    relay = Relay(port, (HOST, server_port), impairment)
+    relay.start()
+    stop = context.Event()
+    server = context.Process(target=run_server, args=(
+        server_port, ships, tick_rate, stop, results))
+    server.start()
+    processes = [server]
+    try:
+        # Wait for the server to listen
+        get_result(results, processes)
+        start = context.Event()
+        base = 0
+        for worker in range(workers):
+            count = clients // workers + (worker < clients % workers)
+            process = context.Process(target=run_clients, args=(
+                base, count, port + 1, port, tick_rate, duration, start,
+                results))
+            process.start()
+            processes.append(process)
+            base += count
+        # Clients start together once all of them spawned
+        for _ in range(workers):
+            get_result(results, processes)
+        start.set()
+        client_reports = []
+        for _ in range(workers):
+            client_reports.extend(get_result(
+                results, processes, duration + RESULT_TIMEOUT)[1])
+        stop.set()
+        server_report = get_result(results, processes)[1]
+        for process in processes:
+            process.join()
+    finally:
+        stop.set()
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        relay.stop()
+        relay.join()
+    return make_report(server_report, client_reports)
+
+
+def make_report(server, clients):
+    sent_times = server['sent_times']
+    latencies = np.array([received - sent_times[tick]
+                          for client in clients
+                          for tick, received in client['received']
+                          if tick in sent_times])
+    cpu_times = np.array(server['cpu_times'])
+    report = {
+        'ticks': len(cpu_times),
+        'clients': len(clients),
+        'cpu_mean': cpu_times.mean() if len(cpu_times) else 0.0,
+        'cpu_max': cpu_times.max() if len(cpu_times) else 0.0,
+        'bytes_per_client': (np.mean(np.divide(server['bytes_sent'],
+                                               server['seconds']))
+                             if server['bytes_sent'] else 0.0),
+        'decoded': sum(len(client['received']) for client in clients),
+        'dropped': sum(client['dropped'] for client in clients),
+    }
+    for percentile in PERCENTILES:
+        report['cpu_p' + str(percentile)] = (
+            np.percentile(cpu_times, percentile) if len(cpu_times) else 0.0)
+        report['latency_p' + str(percentile)] = (
+            np.percentile(latencies, percentile) if len(latencies) else 0.0)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--ships', type=int, default=DEFAULT_SHIPS)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--tick-rate', type=float, default=DEFAULT_TICK_RATE)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--loss', type=float, default=0.0)
+    parser.add_argument('--reorder', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+    report = run(args.clients, args.workers, args.ships, args.duration,
+                 args.tick_rate, args.port,
+                 Impairment(args.latency, args.jitter, args.loss,
+                            args.reorder, args.seed))
+    print("{0} clients, {1} server ticks".format(report['clients'],
+                                                  report['ticks']))
+    print("Server process CPU per tick (ms): "
+          "mean {0:.3f} {1} max {2:.3f}".format(
+        report['cpu_mean'] * 1000, ' '.join(
+            "p{0} {1:.3f}".format(p, report['cpu_p' + str(p)] * 1000)
+            for p in PERCENTILES), report['cpu_max'] * 1000))
+    print("Bytes per client per second: {0:.0f}".format(
+        report['bytes_per_client']))
+    print("Latency (ms): " + ' '.join(
+        "p{0} {1:.1f}".format(p, report['latency_p' + str(p)] * 1000)
+        for p in PERCENTILES))
+    print("Ticks decoded {0}, dropped {1}".format(report['decoded'],
+                                                  report['dropped']))
+
+
+if __name__ == '__main__':
+    main()
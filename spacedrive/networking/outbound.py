@@ -0,0 +1,153 @@
+"""Outbound message batching.
+
+Messages are queued per address during a network tick and flushed once at
+its end. Queued messages of a SUPERSEDED type replace the previous one of
+that type to the same address, so only the newest throttle of a dragged
+slider goes out. Everything else to an address is packed into BATCH
+datagrams of at most MTU bytes of payload, one message goes out on its own
+without the batch overhead."""
+
+import struct
+from collections import OrderedDict
+
+from . import protocol
+
+from direct.directnotify.DirectNotify import DirectNotify
+
+log = DirectNotify().newCategory("SpaceDrive-Outbound")
+
+# Payload bytes per datagram, leaves room for IP, UDP and packet headers
+MTU = 1200
+# Message types where only the newest queued one matters
+SUPERSEDED = frozenset((protocol.REQUEST_THROTTLE, protocol.REQUEST_TARGET,
+                        protocol.POS_PHYS_UPDATE, protocol.SNAPSHOT_ACK))
+
+_BATCH = protocol.get_message(protocol.BATCH).header
+# Message id and payload length before every message of a batch
+_ENTRY = struct.Struct('<BH')
+
+
+def pack_batch(messages):
+    """Returns the BATCH payload of a list of (msg_id, payload)."""
+    parts = [_BATCH.pack(len(messages))]
+    for msg_id, payload in messages:
+        parts.append(_ENTRY.pack(msg_id, len(payload)))
+        parts.append(payload)
+    return b''.join(parts)
+
+
+def unpack_batch(data):
+    """Yields (msg_id, payload) of a BATCH payload. Payloads are views of
+    data. Batches inside the batch are skipped and a truncated batch ends at
+    the last whole message."""
+    data = memoryview(data)
+    if len(data) < _BATCH.size:
+        log.warning("Dropping truncated batch")
+        return
+    count, = _BATCH.unpack_from(data)
+    offset = _BATCH.size
+    for _ in range(count):
+        if offset + _ENTRY.size > len(data):
+            log.warning("Dropping the rest of a truncated batch")
+            return
+        msg_id, length = _ENTRY.unpack_from(data, offset)
+        offset += _ENTRY.size
+        if offset + length > len(data):
+            log.warning("Dropping the rest of a truncated batch")
+            return
+        if msg_id == protocol.BATCH:
+            log.warning("Dropping a batch nested in a batch")
+        else:
+            yield msg_id, data[offset:offset + length]
+        offset += length
+
+
+class OutboundQueue(object):
+    """Messages waiting for the next flush, per address."""
+    def __init__(self, mtu=MTU, superseded=SUPERSEDED):
+        self.mtu = mtu
+        self.superseded = superseded
+        self.queues = OrderedDict()
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    def put(self, address, msg_id, payload):
+        """Queues payload, which is copied, for address."""
+        queue = self.queues.get(address)
+        if queue is None:
+            queue = self.queues[address] = []
+        payload = bytes(payload)
+        if msg_id in self.superseded:
+            for entry in queue:
+                if entry[0] == msg_id:
+                    entry[1] = payload
+                    return
+        queue.append([msg_id, payload])
+
+    def flush(self):
+        """Empties the queue. Returns a list of (address, msg_id, payload,
+        ids of the messages in it) datagrams."""
+        datagrams = []
+        limit = self.mtu - _BATCH.size
+        for address, queue in self.queues.items():
+            batch = []
+            size = 0
+            for msg_id, payload in queue:
+                entry_size = _ENTRY.size + len(payload)
+                if batch and size + entry_size > limit:
+                    datagrams.append(self.make_datagram(address, batch))
+                    batch = []
+                    size = 0
+                if entry_size > limit:
+                    log.debug("Message " + str(msg_id) + " of "
+                              + str(len(payload)) + " bytes exceeds the MTU")
+                batch.append((msg_id, payload))
+                size += entry_size
+            if batch:
+                datagrams.append(self.make_datagram(address, batch))
+        self.queues.clear()
+        return datagrams
+
+    def make_datagram(self, address, batch):
+        msg_ids = tuple(msg_id for msg_id, _ in batch)
+        if len(batch) == 1:
+            return (address,) + batch[0] + (msg_ids,)
+        return address, protocol.BATCH, pack_batch(batch), msg_ids
+
+
+class BatchedSender(object):
+    """Mixin for sandbox.UDPNetworkSystem subclasses. queue_message()
+    replaces direct send_data() calls and flush_messages() sends everything
+    queued, call it once per network tick. process_packet implementations
+    pass BATCH payloads to unpack_batch.
+
+    datagram_sent() is called with the sequence of every datagram sent and
+    the ids of the messages in it."""
+    outbound = None
+
+    def queue_message(self, address, msg_id, payload):
+        if self.outbound is None:
+            self.outbound = OutboundQueue()
+        self.outbound.put(address, msg_id, payload)
+
+    def flush_messages(self):
+        """Sends the queued messages. Returns the number of datagrams."""
+        if self.outbound is None:
+            return 0
+        datagrams = self.outbound.flush()
+        for address, msg_id, payload, msg_ids in datagrams:
+            sequence = self.get_sequence(address)
+            datagram = self.generateGenericPacket(msg_id)
+            datagram.appendData(payload)
+            self.send_data(datagram, address)
+            self.datagram_sent(address, sequence, msg_ids)
+        return len(datagrams)
+
+    def get_sequence(self, address):
+        """Returns the sequence the next packet to address is sent with,
+        sandbox.UDPNetworkSystem counts every packet in packetCount."""
+        return self.packetCount
+
+    def datagram_sent(self, address, sequence, msg_ids):
+        """Called after sending a datagram with the messages msg_ids."""
@@ -0,0 +1,197 @@
+"""Binary network protocol.
+
+Every message type is declared once in MESSAGES with the struct format of
+its fixed fields and, for messages carrying a list, of one record. Layouts
+are compiled into struct.Struct and numpy dtypes when the module loads.
+Records are packed as one numpy structured array so a message of any number
+of ships is a single copy into a reused buffer, and decoding returns a view
+of the received bytes instead of one object per field."""
+
+import struct
+from collections import namedtuple
+
+import numpy as np
+
+from direct.directnotify.DirectNotify import DirectNotify
+
+log = DirectNotify().newCategory("SpaceDrive-Protocol")
+
+# Record counts are sent as an unsigned short after the fixed fields
+_COUNT = 'H'
+MAX_RECORDS = 0xFFFF
+NAME_SIZE = 32
+
+
+def to_dtype(fmt):
+    """Returns the little endian numpy type of a struct format letter."""
+    if fmt.endswith('s'):
+        return 'S' + fmt[:-1]
+    return '<' + fmt
+
+
+class Message(object):
+    """Layout of one message type: fields, a list of (name, struct format)
+    sent once, then a count and that many records, a list of (name, struct
+    format) of one record."""
+    def __init__(self, name, msg_id, fields=(), records=()):
+        self.name = name
+        self.id = msg_id
+        self.field_names = tuple(field for field, _ in fields)
+        self.values = namedtuple(name.title().replace('_', ''),
+                                 self.field_names)
+        layout = '<' + ''.join(fmt for _, fmt in fields)
+        if records:
+            layout += _COUNT
+        self.header = struct.Struct(layout)
+        self.dtype = None
+        if records:
+            self.dtype = np.dtype([(field, to_dtype(fmt))
+                                   for field, fmt in records])
+
+    def __repr__(self):
+        return 'Message(' + self.name + ')'
+
+    def empty(self, count):
+        """Returns an array of count zeroed records to fill and encode."""
+        return np.zeros(count, dtype=self.dtype)
+
+    def size(self, count=0):
+        if self.dtype is None:
+            return self.header.size
+        return self.header.size + count * self.dtype.itemsize
+
+    def pack_into(self, buffer, offset, values=(), records=None):
+        """Packs the message into buffer at offset. Returns the offset after
+        it. Raises ValueError for more than MAX_RECORDS records."""
+        if self.dtype is None:
+            self.header.pack_into(buffer, offset, *values)
+            return offset + self.header.size
+        count = 0 if records is None else len(records)
+        if count > MAX_RECORDS:
+            raise ValueError(self.name + " holds at most " + str(MAX_RECORDS)
+                             + " records, not " + str(count))
+        self.header.pack_into(buffer, offset, *(tuple(values) + (count,)))
+        offset += self.header.size
+        if count:
+            end = offset + count * self.dtype.itemsize
+            records = np.asarray(records, dtype=self.dtype)
+            np.frombuffer(buffer, dtype=np.uint8, count=end - offset,
+                          offset=offset)[:] = records.view(np.uint8)
+            offset = end
+        return offset
+
+    def unpack_from(self, data, offset=0):
+        """Returns (values, records, offset after the message). records is a
+        read only view of data, or None for messages without records."""
+        values = self.header.unpack_from(data, offset)
+        offset += self.header.size
+        if self.dtype is None:
+            return self.values._make(values), None, offset
+        count = values[-1]
+        records = np.frombuffer(data, dtype=self.dtype, count=count,
+                                offset=offset)
+        return (self.values._make(values[:-1]), records,
+                offset + count * self.dtype.itemsize)
+
+
+MESSAGES = []
+_by_id = {}
+
+
+def declare(name, fields=(), records=()):
+    """Adds a message type. Ids follow declaration order, append new types
+    at the end."""
+    message = Message(name, len(MESSAGES), fields, records)
+    MESSAGES.append(message)
+    _by_id[message.id] = message
+    return message.id
+
+
+_NAME = str(NAME_SIZE) + 's'
+
+LOGIN = declare('LOGIN', fields=(('username', _NAME),))
+CONFIRM_STATIONS = declare('CONFIRM_STATIONS', fields=(('ship_id', 'I'),),
+                           records=(('station', '16s'),))
+PLAYER_SHIPS = declare('PLAYER_SHIPS', records=(('ship_id', 'I'),
+                                                ('name', _NAME),
+                                                ('ship_class', _NAME)))
+# Ship state quantized relative to the SOI body, see quantize.py
+POS_PHYS_UPDATE = declare(
+    'POS_PHYS_UPDATE', fields=(('tick', 'I'),),
+    records=(('ship_id', 'I'), ('soi_id', 'i'), ('band', 'B'),
+             ('px', 'i'), ('py', 'i'), ('pz', 'i'), ('quat', 'I'),
+             ('vx', 'i'), ('vy', 'i'), ('vz', 'i'),
+             ('wx', 'h'), ('wy', 'h'), ('wz', 'h'),
+             ('thrust', 'f'), ('torque', 'f')))
+SHIP_CLASSES = declare('SHIP_CLASSES', records=(('name', _NAME),))
+REQUEST_CREATE_SHIP = declare('REQUEST_CREATE_SHIP',
+                              fields=(('name', _NAME), ('ship_class', _NAME)))
+REQUEST_STATIONS = declare('REQUEST_STATIONS', fields=(('ship_id', 'I'),),
+                           records=(('station', '16s'),))
+REQUEST_THROTTLE = declare('REQUEST_THROTTLE',
+                           fields=(('normal', 'f'), ('heading', 'f')))
+REQUEST_TARGET = declare('REQUEST_TARGET', fields=(('target_id', 'I'),))
+# Header of a replication delta, the body is written by replication.py
+POS_PHYS_DELTA = declare('POS_PHYS_DELTA',
+                         fields=(('tick', 'I'), ('baseline', 'I'),
+                                 ('changed', 'H'), ('removed', 'H')))
+# Several messages in one datagram, see outbound.py
+BATCH = declare('BATCH', fields=(('count', 'H'),))
+# Newest delta tick a client rebuilt, the baseline of its next delta
+SNAPSHOT_ACK = declare('SNAPSHOT_ACK', fields=(('tick', 'I'),))
+
+
+def get_message(msg_id):
+    return _by_id[msg_id]
+
+
+def to_text(value):
+    """Decodes a fixed size string field."""
+    return value.rstrip(b'\0').decode('utf-8')
+
+
+def to_bytes(text):
+    return text.encode('utf-8')
+
+
+class Codec(object):
+    """Encodes messages into one reused buffer. The memoryview returned by
+    encode() is only valid until the next call."""
+    def __init__(self, size=1500):
+        self.buffer = bytearray(size)
+
+    def reserve(self, size):
+        if len(self.buffer) < size:
+            self.buffer = bytearray(max(size, 2 * len(self.buffer)))
+
+    def encode(self, msg_id, values=(), records=None):
+        message = _by_id[msg_id]
+        self.reserve(message.size(0 if records is None else len(records)))
+        end = message.pack_into(self.buffer, 0, values, records)
+        return memoryview(self.buffer)[:end]
+
+
+_codec = Codec()
+
+
+def encode(msg_id, values=(), records=None):
+    """Encodes with the shared Codec, copy the result before encoding
+    again."""
+    return _codec.encode(msg_id, values, records)
+
+
+def decode(msg_id, data):
+    """Returns (values, records) of a received message. values is a
+    namedtuple of the fields, records a structured array view or None.
+    Returns None for unknown types and payloads too short for their
+    message, the packet should be dropped."""
+    message = _by_id.get(msg_id)
+    if message is None:
+        log.warning("Dropping message of unknown type " + str(msg_id))
+        return None
+    try:
+        values, records, _ = message.unpack_from(data)
+    except (struct.error, ValueError) as error:
+        log.warning("Dropping malformed " + message.name + ": " + str(error))
+        return None
+    return values, records
@@ -0,0 +1,231 @@
+"""Quantized ship state for replication.
+
+Ships are sent relative to the body of their SOI. Positions are fixed point
+integers with a step set by a distance band, so ships close to a body are
+sent to the centimeter and ships far out in a large SOI more coarsely.
+Velocities are relative to the SOI body as well, in fractions of the
+position step of the band, so a position predicted from a sent velocity
+stays within a step for a long time. Orientations use the smallest three
+encoding in 32 bits: the index of the largest component and the other three
+in 10 bits each.
+
+STATE is the float layout of a ship, the POS_PHYS_UPDATE record the
+quantized one. SNAPSHOT adds the remainder of predicted positions below a
+step, kept by both ends of replication but never sent. encode() turns true
+states into records, decode() records into states relative to the SOI body
+and to_true_positions() those into true positions."""
+
+import numpy as np
+from panda3d.core import LPoint3d
+
+from . import protocol
+
+from direct.directnotify.DirectNotify import DirectNotify
+
+log = DirectNotify().newCategory("SpaceDrive-Quantize")
+
+STATE = np.dtype([('ship_id', '<I'), ('soi_id', '<i'),
+                  ('x', '<d'), ('y', '<d'), ('z', '<d'),
+                  ('qw', '<f'), ('qx', '<f'), ('qy', '<f'), ('qz', '<f'),
+                  ('vx', '<f'), ('vy', '<f'), ('vz', '<f'),
+                  ('wx', '<f'), ('wy', '<f'), ('wz', '<f'),
+                  ('thrust', '<f'), ('torque', '<f')])
+RECORD = protocol.get_message(protocol.POS_PHYS_UPDATE).dtype
+SNAPSHOT = np.dtype(RECORD.descr + [('fx', '<i4'), ('fy', '<i4'),
+                                    ('fz', '<i4')])
+
+# (meters from the SOI body up to which the band applies, meters per step).
+# Every band has to fit int32 steps.
+DEFAULT_BANDS = (
+    (2.0e7, 0.01),
+    (2.0e8, 0.1),
+    (2.0e9, 1.0),
+    (2.0e10, 10.0),
+    (2.0e11, 100.0),
+    (2.0e12, 1000.0),
+)
+# Velocities are sent in 1 / VELOCITY_SCALE of the position step of their
+# band per second, and predicted positions keep their remainder in the same
+# unit
+VELOCITY_SCALE = 1024
+# Radians per second
+MAX_SPIN = 16.0
+QUAT_BITS = 10
+
+_STEPS = 2 ** 15 - 1
+_INT32 = np.iinfo(np.int32)
+_QUAT_MAX = (1 << QUAT_BITS) - 1
+_QUAT_RANGE = np.sqrt(0.5)
+_POSITION = ('x', 'y', 'z')
+_STEPS_OF = ('px', 'py', 'pz')
+_VELOCITY = ('vx', 'vy', 'vz')
+_REMAINDERS = ('fx', 'fy', 'fz')
+_ANGULAR = ('wx', 'wy', 'wz')
+_QUAT = ('qw', 'qx', 'qy', 'qz')
+
+
+def get_columns(array, fields):
+    return np.stack([array[field] for field in fields],
+                    axis=1).astype(np.float64)
+
+
+def set_columns(array, fields, values):
+    for column, field in enumerate(fields):
+        array[field] = values[:, column]
+
+
+def with_remainders(records):
+    """Returns a SNAPSHOT copy of records, remainders are kept if records
+    has them and 0 otherwise."""
+    snapshot = np.zeros(len(records), dtype=SNAPSHOT)
+    for field in records.dtype.names:
+        snapshot[field] = records[field]
+    return snapshot
+
+
+def pack_quats(quats):
+    """Returns the smallest three encoding of (n, 4) w, x, y, z quats."""
+    quats = quats / np.linalg.norm(quats, axis=1)[:, None]
+    rows = np.arange(len(quats))
+    largest = np.argmax(np.abs(quats), axis=1)
+    # q and -q are the same rotation, make the dropped component positive
+    quats[quats[rows, largest] < 0] *= -1.0
+    rest = np.ones(quats.shape, dtype=bool)
+    rest[rows, largest] = False
+    values = quats[rest].reshape(-1, 3)
+    values = np.rint((values / _QUAT_RANGE * 0.5 + 0.5) * _QUAT_MAX)
+    values = np.clip(values, 0, _QUAT_MAX).astype(np.uint32)
+    packed = largest.astype(np.uint32) << (3 * QUAT_BITS)
+    for column in range(3):
+        packed |= values[:, column] << ((2 - column) * QUAT_BITS)
+    return packed
+
+
+def unpack_quats(packed):
+    """Returns the (n, 4) quats of an array of pack_quats() values."""
+    packed = np.asarray(packed, dtype=np.uint32)
+    rows = np.arange(len(packed))
+    largest = (packed >> (3 * QUAT_BITS)).astype(np.intp)
+    values = np.stack([(packed >> ((2 - column) * QUAT_BITS)) & _QUAT_MAX
+                       for column in range(3)], axis=1)
+    values = (values / _QUAT_MAX - 0.5) * 2.0 * _QUAT_RANGE
+    quats = np.empty((len(packed), 4), dtype=np.float64)
+    rest = np.ones(quats.shape, dtype=bool)
+    rest[rows, largest] = False
+    quats[rest] = values.ravel()
+    quats[rows, largest] = np.sqrt(np.maximum(
+        1.0 - np.einsum('nj,nj->n', values, values), 0.0))
+    return quats
+
+
+class Quantizer(object):
+    """Converts between states and records with one set of bands and
+    bounds, both ends have to use the same."""
+    def __init__(self, bands=DEFAULT_BANDS, velocity_scale=VELOCITY_SCALE,
+                 max_spin=MAX_SPIN):
+        if len(bands) > 256:
+            raise ValueError("Bands are sent in one byte")
+        self.limits = np.array([band[0] for band in bands])
+        self.steps = np.array([band[1] for band in bands])
+        if np.any(self.limits / self.steps > np.iinfo(np.int32).max):
+            raise ValueError("Band steps do not fit in 32 bits")
+        self.velocity_scale = velocity_scale
+        self.spin_step = max_spin / _STEPS
+
+    def quantize(self, values, step):
+        return np.clip(np.rint(values / step), -_STEPS, _STEPS)
+
+    def encode(self, states, body_positions, body_velocities):
+        """Returns the records of states, with true positions and velocities,
+        in the frame of their SOI bodies at (n, 3) body_positions and
+        body_velocities."""
+        records = np.zeros(len(states), dtype=RECORD)
+        records['ship_id'] = states['ship_id']
+        records['soi_id'] = states['soi_id']
+        positions = get_columns(states, _POSITION) - body_positions
+        bands = np.searchsorted(self.limits, np.abs(positions).max(axis=1))
+        outside = bands >= len(self.limits)
+        if outside.any():
+            log.warning(str(np.count_nonzero(outside))
+                        + " ships beyond the last band, clamping")
+            bands[outside] = len(self.limits) - 1
+            limit = self.limits[-1]
+            positions[outside] = np.clip(positions[outside], -limit, limit)
+        records['band'] = bands
+        set_columns(records, _STEPS_OF,
+                    np.rint(positions / self.steps[bands][:, None]))
+        records['quat'] = pack_quats(get_columns(states, _QUAT))
+        velocities = np.rint((get_columns(states, _VELOCITY)
+                              - body_velocities) * self.velocity_scale
+                             / self.steps[bands][:, None])
+        fast = np.any(np.abs(velocities) > _INT32.max, axis=1)
+        if fast.any():
+            log.warning(str(np.count_nonzero(fast))
+                        + " ships too fast for their band, clamping")
+            velocities = np.clip(velocities, -_INT32.max, _INT32.max)
+        set_columns(records, _VELOCITY, velocities)
+        set_columns(records, _ANGULAR, self.quantize(
+            get_columns(states, _ANGULAR), self.spin_step))
+        records['thrust'] = states['thrust']
+        records['torque'] = states['torque']
+        return records
+
+    def decode(self, records):
+        """Returns the states of records, or snapshots, with positions and
+        velocities relative to the SOI body."""
+        states = np.zeros(len(records), dtype=STATE)
+        states['ship_id'] = records['ship_id']
+        states['soi_id'] = records['soi_id']
+        steps = self.steps[records['band']][:, None]
+        positions = get_columns(records, _STEPS_OF)
+        if 'fx' in records.dtype.names:
+            positions += get_columns(records, _REMAINDERS) / \
+                self.velocity_scale
+        set_columns(states, _POSITION, positions * steps)
+        set_columns(states, _QUAT, unpack_quats(records['quat']))
+        set_columns(states, _VELOCITY, get_columns(records, _VELOCITY)
+                    * steps / self.velocity_scale)
+        set_columns(states, _ANGULAR,
+                    get_columns(records, _ANGULAR) * self.spin_step)
+        states['thrust'] = records['thrust']
+        states['torque'] = records['torque']
+        return states
+
+    def predict(self, records, dt):
+        """Returns a SNAPSHOT copy of records with positions moved along the
+        velocities for dt seconds. Ships keep their band. The movement below
+        a step is kept in the remainders, so predicting in many short hops
+        ends where one long hop does."""
+        predicted = with_remainders(records)
+        scale = self.velocity_scale
+        for position, velocity, remainder in zip(_STEPS_OF, _VELOCITY,
+                                                 _REMAINDERS):
+            total = predicted[remainder].astype(np.int64) + np.rint(
+                predicted[velocity] * dt).astype(np.int64)
+            carry = (total + scale // 2) // scale
+            predicted[position] += carry.astype(np.int32)
+            predicted[remainder] = total - carry * scale
+        return predicted
+
+
+_quantizer = None
+
+
+def get_quantizer():
+    """Returns the shared Quantizer with the default bands."""
+    global _quantizer
+    if _quantizer is None:
+        _quantizer = Quantizer()
+    return _quantizer
+
+
+def to_true_positions(states, soi_index):
+    """Returns the true LPoint3d of each of states, relative to their SOI
+    bodies in soi_index. Ships in SOIs soi_index does not know are left
+    relative to the origin."""
+    positions = get_columns(states, _POSITION)
+    for row, soi_id in enumerate(states['soi_id'].tolist()):
+        index = soi_index.index_of.get(soi_id)
+        if index is not None:
+            positions[row] += soi_index.positions[index]
+    return [LPoint3d(*position) for position in positions.tolist()]
@@ -0,0 +1,318 @@
+"""Delta compressed replication of ship state.
+
+The server sends each client the ships as a delta against the newest
+snapshot that client reported rebuilding in a SNAPSHOT_ACK. Acks of the
+packet header are not used, a packet can arrive and still be dropped when
+the client lacks its baseline. Snapshots are arrays of quantized records, see
+quantize.py. Positions are first moved along the velocities of the baseline,
+so a coasting ship is not sent at all. Predictions keep the part of a step
+they moved in the remainders of the snapshot, so rounding does not add up
+along a chain of baselines.
+Changed fields are sent as one column per field for the ships whose mask has
+that field's bit. When the client has not reported anything recent enough
+the delta is against nothing, a full snapshot. Ships the client lacks are
+left out of a delta beyond MAX_PAYLOAD bytes and sent in the following
+ticks, so a full snapshot of many ships is spread over several datagrams.
+
+Both ends rebuild snapshots with apply_delta, and the server keeps the rebuilt
+snapshot as the next baseline instead of the true state, so the client and
+server baselines are bit identical and errors below the tolerances never
+add up."""
+
+import struct
+from collections import OrderedDict
+
+import numpy as np
+
+from . import protocol
+from .outbound import MTU
+from .quantize import SNAPSHOT, STATE, get_quantizer, with_remainders
+
+from direct.directnotify.DirectNotify import DirectNotify
+
+log = DirectNotify().newCategory("SpaceDrive-Replication")
+
+NO_BASELINE = 0xFFFFFFFF
+# Sequence numbers of the packet header wrap at this
+SEQUENCE_MODULO = 256
+# Snapshots kept per client for acknowledgement and as baselines
+HISTORY = 64
+# Baselines older than this many ticks are not used
+MAX_BASELINE_AGE = 60
+DEFAULT_TICK_RATE = 60.0
+# Position steps a predicted position may be off before it is sent
+POSITION_TOLERANCE = 1
+# Bytes of a delta before ships the client lacks wait for the next tick
+MAX_PAYLOAD = MTU
+
+RECORD = protocol.get_message(protocol.POS_PHYS_UPDATE).dtype
+# Fields with a bit in the change mask, every record field but the id
+FIELDS = RECORD.names[1:]
+_MASK = np.dtype('<u2')
+_ID = np.dtype('<u4')
+_BITS = (1 << np.arange(len(FIELDS))).astype(_MASK)
+_POSITION = ('px', 'py', 'pz')
+_REMAINDER_OF = {'px': 'fx', 'py': 'fy', 'pz': 'fz'}
+_HEADER = protocol.get_message(protocol.POS_PHYS_DELTA).header
+# Bytes of a ship the client lacks: its id, its mask and every field
+_FULL_SIZE = _ID.itemsize + _MASK.itemsize + RECORD.itemsize \
+    - RECORD['ship_id'].itemsize
+
+DEFAULT_TOLERANCES = dict((field, POSITION_TOLERANCE) for field in _POSITION)
+
+
+def empty_snapshot(count=0):
+    return np.zeros(count, dtype=SNAPSHOT)
+
+
+def make_snapshot(ships):
+    """Returns the true STATE of a list of (entity id, BulletPhysicsComponent)
+    from the transform of their last physics tick, sorted by id. Quantize it
+    with quantize.Quantizer.encode before replicating it."""
+    snapshot = np.zeros(len(ships), dtype=STATE)
+    for row, (entity_id, physcomp) in enumerate(ships):
+        record = snapshot[row]
+        record['ship_id'] = entity_id
+        record['soi_id'] = -1 if physcomp.currentSOI is None \
+            else physcomp.currentSOI
+        record['x'], record['y'], record['z'] = physcomp.current_pos
+        record['qw'], record['qx'], record['qy'], record['qz'] = \
+            physcomp.current_quat
+        record['vx'], record['vy'], record['vz'] = \
+            physcomp.node.get_linear_velocity()
+        record['wx'], record['wy'], record['wz'] = \
+            physcomp.node.get_angular_velocity()
+        record['thrust'] = physcomp.currentThrust
+        record['torque'] = physcomp.currentTorque
+    snapshot.sort(order='ship_id')
+    return snapshot
+
+
+def predict(baseline, dt, quantizer=None):
+    """Returns a copy of baseline with positions moved along the velocities
+    for dt seconds, see quantize.Quantizer.predict."""
+    if quantizer is None:
+        quantizer = get_quantizer()
+    return quantizer.predict(baseline, dt)
+
+
+def apply_delta(predicted, ids, masks, removed, columns):
+    """Returns the snapshot made of the predicted baseline without the removed
+    ids and with the changed columns. columns holds, per field, the values of
+    the ships in ids whose mask has the bit of the field."""
+    snapshot = predicted[~np.isin(predicted['ship_id'], removed)]
+    new = ids[~np.isin(ids, snapshot['ship_id'])]
+    if len(new):
+        added = empty_snapshot(len(new))
+        added['ship_id'] = new
+        snapshot = np.concatenate((snapshot, added))
+        snapshot.sort(order='ship_id')
+    rows = np.searchsorted(snapshot['ship_id'], ids)
+    for bit, field, column in zip(_BITS, FIELDS, columns):
+        changed = rows[(masks & bit) != 0]
+        snapshot[field][changed] = column
+        if field in _REMAINDER_OF:
+            # Sent positions are exact
+            snapshot[_REMAINDER_OF[field]][changed] = 0
+    return snapshot
+
+
+def encode_delta(tick, snapshot, baseline_tick=NO_BASELINE, predicted=None,
+                 tolerances=DEFAULT_TOLERANCES):
+    """Encodes snapshot, sorted by ship_id, against predicted, the snapshot of
+    baseline_tick moved up to tick by predict(). Returns (payload, the
+    snapshot the client will rebuild)."""
+    if predicted is None:
+        baseline_tick = NO_BASELINE
+        predicted = empty_snapshot()
+    ids = snapshot['ship_id']
+    rows = np.minimum(np.searchsorted(predicted['ship_id'], ids),
+                      max(len(predicted) - 1, 0))
+    found = np.zeros(len(ids), dtype=bool)
+    if len(predicted):
+        found = predicted['ship_id'][rows] == ids
+    changed = np.ones((len(ids), len(FIELDS)), dtype=bool)
+    for column, field in enumerate(FIELDS):
+        current = snapshot[field][found]
+        previous = predicted[field][rows[found]]
+        tolerance = tolerances.get(field, 0)
+        if tolerance:
+            changed[found, column] = np.abs(current - previous) > tolerance
+        else:
+            changed[found, column] = current != previous
+    sent = changed.any(axis=1)
+    changed = changed[sent]
+    sent_ids = ids[sent].astype(_ID)
+    masks = (changed * _BITS).sum(axis=1).astype(_MASK)
+    removed = predicted['ship_id'][~np.isin(predicted['ship_id'],
+                                            ids)].astype(_ID)
+    columns = [snapshot[field][sent][changed[:, column]]
+               for column, field in enumerate(FIELDS)]
+    parts = [_HEADER.pack(tick, baseline_tick, len(sent_ids), len(removed)),
+             sent_ids.tobytes(), masks.tobytes(), removed.tobytes()]
+    parts.extend(column.tobytes() for column in columns)
+    return b''.join(parts), apply_delta(predicted, sent_ids, masks, removed,
+                                        columns)
+
+
+def read_delta(data):
+    """Returns (tick, baseline tick, ids, masks, removed, columns) of a
+    payload made by encode_delta."""
+    tick, baseline_tick, changed, removed = _HEADER.unpack_from(data)
+    offset = _HEADER.size
+    ids = np.frombuffer(data, dtype=_ID, count=changed, offset=offset)
+    offset += ids.nbytes
+    masks = np.frombuffer(data, dtype=_MASK, count=changed, offset=offset)
+    offset += masks.nbytes
+    removed = np.frombuffer(data, dtype=_ID, count=removed, offset=offset)
+    offset += removed.nbytes
+    columns = []
+    for bit, field in zip(_BITS, FIELDS):
+        column = np.frombuffer(data, dtype=RECORD[field],
+                               count=np.count_nonzero(masks & bit),
+                               offset=offset)
+        offset += column.nbytes
+        columns.append(column)
+    return tick, baseline_tick, ids, masks, removed, columns
+
+
+class ClientState(object):
+    """Snapshots sent to one client by tick and the newest one it
+    rebuilt."""
+    def __init__(self):
+        self.sent = OrderedDict()
+        self.acked_tick = None
+        self.acked = None
+
+
+class Replicator(object):
+    """Server side of delta replication, one ClientState per address."""
+    def __init__(self, tick_rate=DEFAULT_TICK_RATE, history=HISTORY,
+                 max_baseline_age=MAX_BASELINE_AGE,
+                 tolerances=DEFAULT_TOLERANCES, quantizer=None,
+                 max_payload=MAX_PAYLOAD):
+        self.tick_rate = tick_rate
+        self.quantizer = quantizer
+        self.history = history
+        self.max_baseline_age = max_baseline_age
+        self.tolerances = tolerances
+        self.max_payload = max_payload
+        self.clients = {}
+
+    def get_client(self, address):
+        client = self.clients.get(address)
+        if client is None:
+            client = self.clients[address] = ClientState()
+        return client
+
+    def remove_client(self, address):
+        """Forgets the client at address, call it when a client logs in so
+        it starts from a full snapshot."""
+        self.clients.pop(address, None)
+
+    def acknowledge(self, address, tick):
+        """Marks tick, of a SNAPSHOT_ACK, as rebuilt by the client at
+        address. Ticks not sent to it are ignored."""
+        client = self.get_client(address)
+        snapshot = client.sent.get(tick)
+        if snapshot is not None and (client.acked_tick is None
+                                     or tick > client.acked_tick):
+            client.acked_tick = tick
+            client.acked = snapshot
+
+    def encode(self, address, tick, snapshot, selected=None,
+               relevant=None):
+        """Returns the POS_PHYS_DELTA payload of snapshot, quantized
+        records sorted by ship_id, for the client at address.
+
+        With interest management only the ships in selected are updated.
+        Ships in relevant but not selected keep the state the client already
+        has, ones it lacks wait until they are selected, all others are
+        removed from the client. Ships the client lacks that do not fit in
+        max_payload bytes are left for the next ticks."""
+        client = self.get_client(address)
+        baseline_tick = NO_BASELINE
+        predicted = None
+        if (client.acked is not None
+                and tick - client.acked_tick <= self.max_baseline_age):
+            baseline_tick = client.acked_tick
+            predicted = predict(client.acked,
+                                (tick - baseline_tick) / self.tick_rate,
+                                self.quantizer)
+        if relevant is not None:
+            snapshot = self.filter(snapshot, predicted, selected, relevant)
+        payload, rebuilt = encode_delta(tick, snapshot, baseline_tick,
+                                        predicted, self.tolerances)
+        if len(payload) > self.max_payload:
+            snapshot = self.limit(snapshot, predicted,
+                                  len(payload) - self.max_payload)
+            payload, rebuilt = encode_delta(tick, snapshot, baseline_tick,
+                                            predicted, self.tolerances)
+        client.sent.pop(tick, None)
+        client.sent[tick] = rebuilt
+        while len(client.sent) > self.history:
+            client.sent.popitem(last=False)
+        return payload
+
+    def filter(self, snapshot, predicted, selected, relevant):
+        """Returns the snapshot the client should have: the selected ships
+        from snapshot and the other relevant ships it has from predicted.
+        Relevant ships it lacks are new to the InterestManager, which makes
+        them due at once, so they follow within the budget."""
+        current = snapshot[np.isin(snapshot['ship_id'], selected)]
+        if predicted is None:
+            return current
+        kept = predicted[np.isin(predicted['ship_id'], relevant)
+                         & ~np.isin(predicted['ship_id'], selected)]
+        current = np.concatenate((with_remainders(current), kept))
+        current.sort(order='ship_id')
+        return current
+
+    def limit(self, snapshot, predicted, excess):
+        """Returns snapshot without the ships the client lacks, highest ids
+        first, that make its delta excess bytes too long."""
+        lacking = np.ones(len(snapshot), dtype=bool)
+        if predicted is not None:
+            lacking = ~np.isin(snapshot['ship_id'], predicted['ship_id'])
+        rows = np.flatnonzero(lacking)
+        count = min(-(-excess // _FULL_SIZE), len(rows))
+        return np.delete(snapshot, rows[len(rows) - count:])
+
+
+class SnapshotReceiver(object):
+    """Client side of delta replication. Keeps the rebuilt snapshots that may
+    be used as baselines."""
+    def __init__(self, tick_rate=DEFAULT_TICK_RATE, history=HISTORY,
+                 quantizer=None):
+        self.tick_rate = tick_rate
+        self.history = history
+        self.quantizer = quantizer
+        self.snapshots = OrderedDict()
+        self.latest_tick = None
+
+    def decode(self, data):
+        """Returns (tick, snapshot) of a POS_PHYS_DELTA payload or None if its
+        baseline is no longer known or it is malformed."""
+        try:
+            tick, baseline_tick, ids, masks, removed, columns = \
+                read_delta(data)
+        except (struct.error, ValueError) as error:
+            log.warning("Dropping malformed delta: " + str(error))
+            return None
+        if baseline_tick == NO_BASELINE:
+            predicted = empty_snapshot()
+        else:
+            baseline = self.snapshots.get(baseline_tick)
+            if baseline is None:
+                log.warning("Dropping delta against unknown tick "
+                            + str(baseline_tick))
+                return None
+            predicted = predict(baseline, (tick - baseline_tick)
+                                / self.tick_rate, self.quantizer)
+        snapshot = apply_delta(predicted, ids, masks, removed, columns)
+        self.snapshots[tick] = snapshot
+        while len(self.snapshots) > self.history:
+            self.snapshots.popitem(last=False)
+        if self.latest_tick is None or tick > self.latest_tick:
+            self.latest_tick = tick
+        return tick, snapshot
@@ -0,0 +1,277 @@
+"""UDP transport running in its own thread.
+
+An asyncio event loop in a background thread reads the socket whenever it
+is readable, also while a frame of the simulation runs long, so datagrams
+wait in user space instead of overflowing the socket buffer. Each wakeup
+drains up to DRAIN_BATCH datagrams with recvfrom_into straight into one
+preallocated ring buffer and parses their headers there. The simulation
+takes the parsed packets at the start of its frame, copies each payload out
+of the ring and decodes it in process_packet, so only the receiving and the
+header parsing overlap with the simulation.
+
+Packets cross between the threads through deques, whose append and popleft
+are atomic, so neither side takes a lock. The ring is shared as two running
+byte totals, written by the network thread and released by the simulation,
+each only ever assigned by one side.
+
+Both ends of a connection have to use this transport, its packet header is
+HEADER and not the one of sandbox.UDPNetworkSystem. AsyncUDPMixin puts it
+under an existing network system, see make_async() and the threaded flag
+of spacedrive.init_client_net and init_server_net."""
+
+import asyncio
+import collections
+import socket
+import struct
+import threading
+
+import sandbox
+
+from . import replication
+
+from direct.directnotify.DirectNotify import DirectNotify
+
+log = DirectNotify().newCategory("SpaceDrive-Transport")
+
+# Message id, sequence of the packet, newest sequence received from the
+# other end and a bit for each of the 16 before it
+HEADER = struct.Struct('<BBBH')
+# Largest datagram that can be received
+MAX_DATAGRAM = 65507
+# Bytes of the receive ring, many frames of traffic of a busy server
+RING_SIZE = 4 * 1024 * 1024
+# Datagrams read per wakeup before other events get a turn
+DRAIN_BATCH = 64
+# Bytes asked of the kernel for the socket buffers
+SOCKET_BUFFER = 1024 * 1024
+_ACK_BITS = 16
+
+
+class Packet(bytearray):
+    """Datagram built by AsyncUDPNetworkSystem.generateGenericPacket. The
+    sequence and acks of the header are filled in when it is sent."""
+    def appendData(self, data):
+        self.extend(data)
+
+
+class Transport(object):
+    """Socket, network thread and the queues to and from it.
+
+    inbound holds (msg_id, sequence, ack, acks, start, end, address,
+    released) of every received packet, its payload is ring[start:end].
+    Setting self.released to released after handling the packet frees its
+    bytes for the network thread."""
+    def __init__(self, address, port, ring_size=RING_SIZE):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for option in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+            try:
+                self.sock.setsockopt(socket.SOL_SOCKET, option, SOCKET_BUFFER)
+            except OSError:
+                pass
+        self.sock.bind((address, port))
+        self.sock.setblocking(False)
+        self.ring = bytearray(ring_size)
+        self.view = memoryview(self.ring)
+        self.written = 0
+        self.released = 0
+        self.head = 0
+        self.inbound = collections.deque()
+        self.outbound = collections.deque()
+        self.wake_pending = False
+        self.paused = False
+        # address: [newest sequence, ack bits], only used by the thread
+        self.received = {}
+        self.loop = asyncio.SelectorEventLoop()
+        self.thread = threading.Thread(target=self.run,
+                                       name='spacedrive-transport')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.add_reader(self.sock.fileno(), self.receive)
+        self.loop.run_forever()
+        self.loop.close()
+
+    def stop(self):
+        if self.thread.is_alive():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+        self.sock.close()
+
+    def reserve(self):
+        """Returns the ring offset with room for a datagram or None if the
+        simulation has not released enough yet."""
+        size = len(self.ring)
+        head = self.head
+        if head + MAX_DATAGRAM > size:
+            # Skip the end of the ring, the skipped bytes count as written
+            if self.written + size - head - self.released + MAX_DATAGRAM \
+                    > size:
+                return None
+            self.written += size - head
+            head = self.head = 0
+        if self.written - self.released + MAX_DATAGRAM > size:
+            return None
+        return head
+
+    def receive(self):
+        """Drains up to DRAIN_BATCH datagrams into the ring."""
+        packets = []
+        for _ in range(DRAIN_BATCH):
+            start = self.reserve()
+            if start is None:
+                # The simulation is behind, leave the rest in the kernel
+                self.loop.remove_reader(self.sock.fileno())
+                self.paused = True
+                break
+            try:
+                count, address = self.sock.recvfrom_into(
+                    self.view[start:start + MAX_DATAGRAM])
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as error:
+                # Port unreachable of a peer that went away
+                log.debug("Receive failed: " + str(error))
+                continue
+            if count < HEADER.size:
+                continue
+            msg_id, sequence, ack, acks = HEADER.unpack_from(self.ring, start)
+            self.acknowledge(address, sequence)
+            self.head = start + count
+            self.written += count
+            packets.append((msg_id, sequence, ack, acks,
+                            start + HEADER.size, start + count, address,
+                            self.written))
+        if packets:
+            self.inbound.extend(packets)
+
+    def acknowledge(self, address, sequence):
+        """Adds sequence to the acks sent back to address."""
+        received = self.received.get(address)
+        if received is None:
+            self.received[address] = [sequence, 0]
+            return
+        newest, bits = received
+        ahead = (sequence - newest) % replication.SEQUENCE_MODULO
+        if 0 < ahead < replication.SEQUENCE_MODULO // 2:
+            bits = (bits << ahead) | (1 << (ahead - 1))
+            received[0] = sequence
+        else:
+            behind = (newest - sequence) % replication.SEQUENCE_MODULO
+            if 0 < behind <= _ACK_BITS:
+                bits |= 1 << (behind - 1)
+        received[1] = bits & ((1 << _ACK_BITS) - 1)
+
+    def resume(self):
+        if self.paused:
+            self.paused = False
+            self.loop.add_reader(self.sock.fileno(), self.receive)
+            self.receive()
+
+    def send(self, packet, address):
+        """Queues packet for the network thread."""
+        self.outbound.append((packet, address))
+        if not self.wake_pending:
+            self.wake_pending = True
+            self.loop.call_soon_threadsafe(self.send_queued)
+
+    def send_queued(self):
+        self.wake_pending = False
+        outbound = self.outbound
+        while outbound:
+            packet, address = outbound.popleft()
+            received = self.received.get(address)
+            if received is not None:
+                struct.pack_into('<BH', packet, 2, received[0], received[1])
+            try:
+                self.sock.sendto(packet, address)
+            except (BlockingIOError, InterruptedError):
+                # Retry once the socket buffer has room
+                outbound.appendleft((packet, address))
+                self.loop.add_writer(self.sock.fileno(), self.writable)
+                return
+            except OSError as error:
+                log.debug("Send to " + str(address) + " failed: "
+                          + str(error))
+
+    def writable(self):
+        self.loop.remove_writer(self.sock.fileno())
+        self.send_queued()
+
+
+class AsyncUDPMixin(object):
+    """Replaces the socket of a sandbox.UDPNetworkSystem with Transport,
+    put it before the system in the bases.
+
+    Keeps its interface: init(address, port) opens the socket and calls
+    init2(), process_packet() is called for every received packet, now at
+    the start of the frame, and packets are built with
+    generateGenericPacket() and sent with send_data()."""
+    transport = None
+
+    def init(self, address=None, port=None):
+        if address is None:
+            return
+        self.sequences = {}
+        self.transport = Transport(address, port)
+        self.init2()
+
+    def begin(self):
+        self.drain()
+
+    def drain(self):
+        """Handles every packet received so far. Payloads are copied out of
+        the ring first, handlers may keep views of them."""
+        transport = self.transport
+        if transport is None:
+            return
+        inbound = transport.inbound
+        view = transport.view
+        while inbound:
+            msg_id, sequence, ack, acks, start, end, address, released = \
+                inbound.popleft()
+            payload = bytes(view[start:end])
+            transport.released = released
+            self.process_packet(msg_id, sequence, ack, acks, None, payload,
+                                address)
+        if transport.paused:
+            transport.loop.call_soon_threadsafe(transport.resume)
+
+    def get_sequence(self, address):
+        """Returns the sequence the next packet to address is sent with."""
+        return self.sequences.get(address, 0)
+
+    def generateGenericPacket(self, msgID):
+        return Packet(HEADER.pack(msgID, 0, 0, 0))
+
+    def send_data(self, packet, address):
+        sequence = self.get_sequence(address)
+        self.sequences[address] = (sequence + 1) % \
+            replication.SEQUENCE_MODULO
+        packet[1] = sequence
+        self.transport.send(packet, address)
+
+    def stop(self):
+        if self.transport is not None:
+            self.transport.stop()
+            self.transport = None
+
+
+class AsyncUDPNetworkSystem(AsyncUDPMixin, sandbox.EntitySystem):
+    """Base of new network systems on Transport."""
+    def init2(self):
+        pass
+
+    def process_packet(self, msgID, remotePacketCount, ack, acks, hashID,
+                       serialized, address):
+        pass
+
+
+def make_async(system):
+    """Returns a subclass of the network system class system running on
+    Transport, or system if it already does."""
+    if issubclass(system, AsyncUDPMixin):
+        return system
+    return type(system.__name__, (AsyncUDPMixin, system),
+                {'__module__': system.__module__})
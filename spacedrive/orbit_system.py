@@ -1,6 +1,8 @@
 import sandbox
 
+from collections import OrderedDict
 from math import sin, cos, radians, degrees, sqrt, atan2
+import numpy as np
 from panda3d.core import LPoint3d, Vec3
 import yaml
 
@@ -9,6 +11,7 @@ from .import render_components as render_comps
 from .import surface_mesh
 from .import universals
 from .utils import blackbody
+from .utils.expression import compile_expression
 
 from .renderpipeline.rpcore import PointLight as DirectionalLight
 #TODO: Switch to the sun direction manager or as tobias for info
@@ -22,47 +25,74 @@ log.setSeverity(3)
 
 is2d = False
 
+# Kilometers in an astronomical unit
+AU = 149598000
+# Convergence threshold of the eccentric anomaly, matches compute_e
+KEPLER_TOLERANCE = radians(0.001)
+KEPLER_MAX_ITERATIONS = 16
+# Orbital elements in the order they are stored by OrbitBatch. Angles are
+# given in degrees by the yaml.
+ORBIT_ELEMENTS = ('a', 'e', 'i', 'N', 'w', 'M')
+# Orbit path sampling, see OrbitBatch.path_samples
+PATH_SAMPLES_PER_ORBIT = 64
+MIN_PATH_SAMPLES = 16
+MAX_PATH_SAMPLES = 4096
+PATH_CACHE_SIZE = 8
+
 
 class OrbitSystem(sandbox.EntitySystem):
-    """Positions and moves celestial bodies in orbit."""
-    def add_parent_pos(self, displacement, child_component):
-        parent_node_path = child_component.node_path.get_parent()
-        parent_entity = parent_node_path.get_python_tag('entity')
-        if parent_entity:
-            parent_component = parent_entity.get_component(cel_comp.CelestialComponent)
-            if parent_component:
-                displacement += self.add_parent_pos(displacement, parent_component)
-                displacement += parent_component.true_pos
-        return displacement
+    """Positions and moves celestial bodies in orbit.
 
-    def process(self, entity):
-        """Gets the xyz position of the body, relative to its parent, on the
-        given day before/after the date of element. Units will be in AU."""
+    Every orbiting body is solved at once in begin() by an OrbitBatch, which
+    also converts the positions to heliocentric coordinates parent before
+    child. Nothing is left for process() so the entity order of sandbox does
+    not matter."""
+    batch = None
+    bodies = None
+
+    def begin(self):
         # Static bodies for now
         # Also clock should not be here. Put in another system.
         # universals.day += globalClock.getDt() / 86400 * universals.TIMEFACTOR
-        component = entity.get_component(cel_comp.CelestialComponent)
-        if component.orbit:
-            # print component.nodePath, self.get2DBodyPosition(component.nodePath, universals.day)
-            # component.nodePath.setPos(self.get2DBodyPosition(component, universals.day))
-            component.true_pos = calc_body_pos(component, universals.day)
-            # NOTE: truePos is only get position relative to the parent body. We need
-            # to convert this to heliocentric
-            # This only computes to the position of the parent body
-            # We want to put moons into heliocentric coords as well
-            # Iterate through parents and add their positions
-            #TODO: Do we really need to do this? If not this should be moved
-            #to the end step function to prevent celestial motion jitters
-            #as we have no guarantee of order
-            component.true_pos += self.add_parent_pos(LPoint3d(0, 0, 0),
-                                                      component)
+        components = [component for component in
+                      sandbox.get_components(cel_comp.CelestialComponent)
+                      if component.orbit]
+        if components != self.bodies:
+            # The body tree only changes when solar systems are loaded
+            self.bodies = components
+            self.batch = OrbitBatch(components)
+        elif not self.batch.is_current():
+            self.batch.load_elements()
+        self.batch.update(universals.day)
+
+    def invalidate(self):
+        """Rebuilds the batch next frame. Replaced orbits are picked up on
+        their own, this is only needed after changing a body in place."""
+        self.bodies = None
+
+    def get_paths(self, start, end, samples=None, heliocentric=True,
+                  grouped=False):
+        """Returns (components, days, positions) of the orbiting bodies from
+        day start to day end. positions is a (bodies, samples, 3) array in
+        meters ordered like components, see OrbitBatch.paths. With grouped
+        returns a list of them, one per sample density."""
+        if self.batch is None:
+            self.begin()
+        paths = self.batch.paths(start, end, samples, heliocentric, grouped)
+        if not grouped:
+            return (self.batch.components,) + paths
+        return [([self.batch.components[index] for index in indexes.tolist()],
+                 days, positions) for indexes, days, positions in paths]
+
+    def process(self, entity):
+        """Positions were already set for every body in begin()."""
 
 
 def create_from_yaml_file(self, filename):
     with open(filename) as f:
         data = f.read()
     if data:
-        solardb = yaml.load(data)
+        solardb = yaml.safe_load(data)
         for system_name, db in solardb.items():
             create_solar_system(name=system_name, database=db)
     else:
@@ -94,6 +124,7 @@ def generate_node(name, database, parent_component):
         components.append(star_component)
     if 'orbit' in database:
         celestial_component.orbit = database['orbit']
+        celestial_component.orbit_elements = compile_orbit(database['orbit'])
         celestial_component.period = database['period']
         celestial_component.true_pos = calc_body_pos(celestial_component,
                                                      universals.day)
@@ -116,55 +147,15 @@ def generate_node(name, database, parent_component):
         celestial_component.node_path.reparent_to(parent_component.node_path)
     celestial_component.node_path.set_python_tag('entity', body_entity)
 
-    #FIXME: Does not factor parent positions for nested objects.
     if celestial_component.orbit:
         true_pos = calc_body_pos(celestial_component, universals.day)
+        # Parents are generated first so their true_pos is heliocentric
+        if isinstance(parent_component, cel_comp.CelestialComponent):
+            true_pos += parent_component.true_pos
         celestial_component.true_pos = true_pos
 
     if universals.run_client:
-        render_component = render_comps.CelestialRenderComponent()
-        components.append(render_component)
-
-        #For porting to new render system only
-        if database['type'] != 'star':
-            render_component.mesh = surface_mesh.make_planet(name=name)
-            if 'atmosphere' in database:
-                #render_component.atmosphere = Scattering(sandbox.render_pipeline)
-                #render_component.atmosphere.setSettings({
-                #    'radiusGround': database['radius']/1000.0,
-                #    'radiusAtmosphere': database['radius']/1000.0 + database['atmosphere']['height']/1000.0,
-                #})
-                #render_component.atmosphere.precompute()
-                '''render_component.atmosphere.bindTo(sandbox.render_pipeline.lightingComputeContainer, "scatteringOptions")
-                sandbox.base.render_pipeline.lightingComputeContainer.setShaderInput(
-                    "transmittanceSampler", render_component.atmosphere.getTransmittanceResult())
-                sandbox.base.render_pipeline.lightingComputeContainer.setShaderInput(
-                    "inscatterSampler", render_component.atmosphere.getInscatterTexture())'''
-
-        #sandbox.send('make pickable', [render_component.mesh])
-        if database['type'] == 'star':
-            color = blackbody.convert_K_to_RGB_float(database['temperature'])
-            render_component.mesh = surface_mesh.make_star(name=name, color=color)
-            #Debug prototype purposes only
-            render_component.mesh.set_pos(0, 0, 0)
-            #/Debug
-            render_component.temperature = database['temperature']
-            render_component.light = DirectionalLight()
-            #render_component.light.setAmbientColor(Vec3(0))
-            #render_component.light.setColor(Vec3(color))
-            #TODO: Fix Lines below
-            #render_component.light.setDirection(render_component.mesh.get_pos())
-            #render_component.light.setShadowMapResolution(1024)
-            #render_component.light.setCastsShadows(True)
-            sandbox.render_pipeline.add_light(render_component.light)
-
-        elif database['type'] == 'solid' or database['type'] == 'moon':
-            render_component.mesh.set_textures(database['textures'])
-            #render_component.mesh.set_ambient(1, 1, 1, 1)
-            #render_component.mesh.set_diffuse(1, 1, 1, 1)
-            #render_component.mesh.set_specular(1, 1, 1, 1)
-            #render_component.mesh.set_shininess(100)
-        render_component.mesh.reparent_to(sandbox.base.render)
+        components.append(create_render_component(name, database))
 
     for component in components:
         body_entity.add_component(component)
@@ -174,21 +165,89 @@ def generate_node(name, database, parent_component):
             generate_node(body_name, body_database, celestial_component)
 
 
+def create_render_component(name, database):
+    """Creates the CelestialRenderComponent of a body from its yaml entry.
+    Only stars get their mesh now, other bodies start as an impostor and the
+    GraphicsSystem loads their mesh on demand."""
+    render_component = render_comps.CelestialRenderComponent()
+
+    #For porting to new render system only
+    if database['type'] != 'star':
+        render_component.impostor = surface_mesh.make_impostor(name=name)
+        render_component.impostor.reparent_to(sandbox.base.render)
+        if 'atmosphere' in database:
+            #render_component.atmosphere = Scattering(sandbox.render_pipeline)
+            #render_component.atmosphere.setSettings({
+            #    'radiusGround': database['radius']/1000.0,
+            #    'radiusAtmosphere': database['radius']/1000.0 + database['atmosphere']['height']/1000.0,
+            #})
+            #render_component.atmosphere.precompute()
+            '''render_component.atmosphere.bindTo(sandbox.render_pipeline.lightingComputeContainer, "scatteringOptions")
+            sandbox.base.render_pipeline.lightingComputeContainer.setShaderInput(
+                "transmittanceSampler", render_component.atmosphere.getTransmittanceResult())
+            sandbox.base.render_pipeline.lightingComputeContainer.setShaderInput(
+                "inscatterSampler", render_component.atmosphere.getInscatterTexture())'''
+
+    #sandbox.send('make pickable', [render_component.mesh])
+    if database['type'] == 'star':
+        color = blackbody.convert_K_to_RGB_float(database['temperature'])
+        render_component.mesh = surface_mesh.make_star(name=name, color=color)
+        #Debug prototype purposes only
+        render_component.mesh.set_pos(0, 0, 0)
+        #/Debug
+        render_component.temperature = database['temperature']
+        render_component.light = DirectionalLight()
+        #render_component.light.setAmbientColor(Vec3(0))
+        #render_component.light.setColor(Vec3(color))
+        #TODO: Fix Lines below
+        #render_component.light.setDirection(render_component.mesh.get_pos())
+        #render_component.light.setShadowMapResolution(1024)
+        #render_component.light.setCastsShadows(True)
+        sandbox.render_pipeline.add_light(render_component.light)
+        render_component.mesh.reparent_to(sandbox.base.render)
+
+    elif database['type'] == 'solid' or database['type'] == 'moon':
+        # Loaded with the mesh, see GraphicsSystem.load_mesh
+        render_component.textures = database['textures']
+    return render_component
+
+
 def calculate_soi(semimajor_axis, mass_body, mass_parent):
     """Calculates the sphere of influence of a body for patch conic
     approximation."""
     return semimajor_axis * (mass_body / mass_parent) ** (2 / 5.0)
 
 
+def compile_orbit(orbit):
+    """Compiles the element formulas of a yaml orbit into Expressions, keyed
+    by element name."""
+    elements = {}
+    for key in ORBIT_ELEMENTS:
+        try:
+            elements[key] = compile_expression(orbit[key])
+        except ValueError as error:
+            raise ValueError("Orbital element " + key + ": " + str(error))
+    return elements
+
+
+def get_orbit_elements(component):
+    """Returns the compiled orbit of a component, compiling and caching it on
+    first use."""
+    if component.orbit_elements is None:
+        component.orbit_elements = compile_orbit(component.orbit)
+    return component.orbit_elements
+
+
 def calc_body_pos(component, time):
     """Returns celestial position relative to the parent."""
+    elements = get_orbit_elements(component)
     # Convert to radians
-    M = radians(eval(component.orbit['M'])(time))
-    w = radians(eval(component.orbit['w'])(time))
-    i = radians(eval(component.orbit['i'])(time))
-    N = radians(eval(component.orbit['N'])(time))
-    a = component.orbit['a']
-    e = eval(component.orbit['e'])(time)
+    M = radians(elements['M'](time))
+    w = radians(elements['w'](time))
+    i = radians(elements['i'](time))
+    N = radians(elements['N'](time))
+    a = elements['a'](time)
+    e = elements['e'](time)
     # Compute eccentric anomaly
     E = M + e * sin(M) * (1.0 + e * cos(M))
     if degrees(E) > 0.05:
@@ -216,13 +275,36 @@ def calc_body_pos(component, time):
     else:
         yh = r * (sin(v + w) * sin(i))'''
     position = LPoint3d(xh, yh, zh)
+    position *= orbit_unit_scale(component)
+    return position
+
+
+def calc_body_path(component, days):
+    """Vectorized calc_body_pos of one body over an array of days. Returns a
+    (len(days), 3) array of positions in meters relative to the parent."""
+    days = np.asarray(days, dtype=np.float64)
+    elements = get_orbit_elements(component)
+    values = np.empty((len(ORBIT_ELEMENTS), days.size), dtype=np.float64)
+    for row, key in enumerate(ORBIT_ELEMENTS):
+        expression = elements[key]
+        if expression.linear is None:
+            values[row] = [expression(day) for day in days.ravel().tolist()]
+        else:
+            base, rate = expression.linear
+            values[row] = base + rate * days.ravel()
+    np.radians(values[2:], out=values[2:])
+    a, e, i, N, w, M = values
+    return calc_body_positions(a, e, M, w, i, N, orbit_unit_scale(component))
+
+
+def orbit_unit_scale(component):
+    """Returns the factor converting the orbit units of a body to meters."""
     # If we are not a moon then our orbits are done in au.
     # Moons are done in km
     # Our units in panda are m, so we convert to m
     if component.kind != cel_comp.TYPES['moon']:
-        position *= 149598000
-    position *= 1000
-    return position
+        return AU * 1000.0
+    return 1000.0
 
 
 def compute_e(E0, M, e):
@@ -230,4 +312,365 @@ def compute_e(E0, M, e):
     E1 = E0 - (E0 - e * sin(E0) - M) / (1 - e * cos(E0))
     if abs(abs(degrees(E1)) - abs(degrees(E0))) > 0.001:
         E1 = compute_e(E1, M, e)
-    return E1
\ No newline at end of file
+    return E1
+
+
+def get_parent_component(component):
+    """Returns the CelestialComponent the body orbits, None for top level
+    bodies of a solar system."""
+    parent_entity = component.parent_entity
+    if parent_entity is not None and parent_entity.has_component(
+            cel_comp.CelestialComponent):
+        return parent_entity.get_component(cel_comp.CelestialComponent)
+    return None
+
+
+def build_body_tree(components):
+    """Orders components parent before child by parent_entity.
+
+    Returns the ordered list of components, an array with the index of each
+    parent in that list, -1 if the parent is not in it, and an array with the
+    depth of each body in the tree."""
+    indexes = dict((id(component), index)
+                   for index, component in enumerate(components))
+    children = [[] for _ in components]
+    roots = []
+    for index, component in enumerate(components):
+        parent = get_parent_component(component)
+        if parent is not None and id(parent) in indexes:
+            children[indexes[id(parent)]].append(index)
+        else:
+            roots.append(index)
+    order = []
+    parents = []
+    depths = []
+    level = [(index, -1) for index in roots]
+    depth = 0
+    while level:
+        next_level = []
+        for index, parent in level:
+            position = len(order)
+            order.append(index)
+            parents.append(parent)
+            depths.append(depth)
+            next_level.extend((child, position) for child in children[index])
+        level = next_level
+        depth += 1
+    if len(order) != len(components):
+        log.warning("Orbit tree has a cycle, ignoring "
+                    + str(len(components) - len(order)) + " bodies")
+    return ([components[index] for index in order],
+            np.array(parents, dtype=np.intp), np.array(depths, dtype=np.intp))
+
+
+class OrbitBatch(object):
+    """Orbital elements of many bodies packed into arrays so their positions
+    can be solved in one vectorized pass. calc_body_pos remains the reference
+    implementation for a single body.
+
+    Bodies are kept in body tree order so heliocentric positions can be
+    accumulated one tree level at a time."""
+    sources = None
+
+    def __init__(self, components=()):
+        self.components, self.parents, self.depths = build_body_tree(
+            list(components))
+        # Bodies orbiting something outside of the batch, like a static star
+        self.anchors = []
+        for index in np.flatnonzero(self.parents < 0):
+            parent = get_parent_component(self.components[index])
+            if parent is not None:
+                self.anchors.append((index, parent))
+        self.levels = [np.flatnonzero(self.depths == depth)
+                       for depth in range(1, int(self.depths.max(initial=0)) + 1)]
+        # Every body paired with itself and each of its ancestors, and the
+        # top ancestor of every body in the batch
+        owners = []
+        chain = []
+        roots = []
+        for index in range(len(self.components)):
+            body = index
+            while body >= 0:
+                owners.append(index)
+                chain.append(body)
+                root = body
+                body = self.parents[body]
+            roots.append(root)
+        self.chain_owners = np.array(owners, dtype=np.intp)
+        self.chain = np.array(chain, dtype=np.intp)
+        self.roots = np.array(roots, dtype=np.intp)
+        self.load_elements()
+
+    def load_elements(self):
+        """Reads the orbit elements of every body. Called again when an orbit
+        was replaced."""
+        count = len(self.components)
+        # Linear elements evaluate as base + rate * day for all bodies at
+        # once. Anything else is kept as (row, column, expression).
+        self.base = np.zeros((len(ORBIT_ELEMENTS), count), dtype=np.float64)
+        self.rate = np.zeros((len(ORBIT_ELEMENTS), count), dtype=np.float64)
+        self.nonlinear = []
+        for column, component in enumerate(self.components):
+            if self.sources is not None:
+                orbit, elements = self.sources[column]
+                if (component.orbit is not orbit
+                        and component.orbit_elements is elements):
+                    # The yaml orbit was replaced, compile it again
+                    component.orbit_elements = None
+            elements = get_orbit_elements(component)
+            for row, key in enumerate(ORBIT_ELEMENTS):
+                expression = elements[key]
+                if expression.linear is None:
+                    self.nonlinear.append((row, column, expression))
+                else:
+                    self.base[row, column], self.rate[row, column] = \
+                        expression.linear
+        self.scale = np.array([orbit_unit_scale(component)
+                               for component in self.components],
+                              dtype=np.float64)
+        self.sources = [(component.orbit, component.orbit_elements)
+                        for component in self.components]
+        self.path_cache = OrderedDict()
+
+    def __len__(self):
+        return len(self.components)
+
+    def is_current(self):
+        """Returns False if the orbit of a body was replaced since the
+        elements were loaded."""
+        return all(component.orbit is orbit
+                   and component.orbit_elements is elements
+                   for component, (orbit, elements)
+                   in zip(self.components, self.sources))
+
+    def elements(self, time, columns=None):
+        """Returns a (6, n) array of the elements of every body on the given
+        day, rows ordered as ORBIT_ELEMENTS with the angles in radians. If
+        time is an array of k days the result is (6, n, k). columns limits
+        the bodies to an ascending array of indexes."""
+        base, rate, nonlinear = self.base, self.rate, self.nonlinear
+        if columns is not None:
+            local = dict((column, position) for position, column
+                         in enumerate(columns.tolist()))
+            base = base[:, columns]
+            rate = rate[:, columns]
+            nonlinear = [(row, local[column], expression)
+                         for row, column, expression in nonlinear
+                         if column in local]
+        if np.ndim(time):
+            time = np.asarray(time, dtype=np.float64)
+            values = base[:, :, None] + rate[:, :, None] * time
+            for row, column, expression in nonlinear:
+                values[row, column] = [expression(day)
+                                       for day in time.tolist()]
+        else:
+            values = base + rate * time
+            for row, column, expression in nonlinear:
+                values[row, column] = expression(time)
+        np.radians(values[2:], out=values[2:])
+        return values
+
+    def solve(self, time, columns=None):
+        """Returns an (n, 3) array of positions in meters relative to the
+        parent of each body, (n, k, 3) for an array of k days."""
+        a, e, i, N, w, M = self.elements(time, columns)
+        scale = self.scale if columns is None else self.scale[columns]
+        if np.ndim(time):
+            scale = scale[:, None]
+        return calc_body_positions(a, e, M, w, i, N, scale)
+
+    def solve_rows(self, columns, days):
+        """Returns a (len(columns), k, 3) array of positions in meters
+        relative to the parent of the bodies at columns, which may repeat,
+        each on its own row of the (len(columns), k) array days."""
+        values = self.base[:, columns, None] + \
+            self.rate[:, columns, None] * days
+        for row, column, expression in self.nonlinear:
+            for position in np.flatnonzero(columns == column).tolist():
+                values[row, position] = [expression(day) for day
+                                         in days[position].tolist()]
+        np.radians(values[2:], out=values[2:])
+        a, e, i, N, w, M = values
+        return calc_body_positions(a, e, M, w, i, N,
+                                   self.scale[columns][:, None])
+
+    def with_ancestors(self, columns):
+        """Returns the ascending indexes of columns and all their
+        ancestors."""
+        bodies = set(columns.tolist())
+        for column in columns.tolist():
+            parent = self.parents[column]
+            while parent >= 0 and parent not in bodies:
+                bodies.add(int(parent))
+                parent = self.parents[parent]
+        return np.array(sorted(bodies), dtype=np.intp)
+
+    def heliocentric(self, time, columns=None):
+        """Returns an (n, 3) array of heliocentric positions in meters,
+        (n, k, 3) for an array of k days. columns limits the bodies to an
+        ascending array of indexes, their ancestors are solved as well."""
+        if columns is not None:
+            bodies = self.with_ancestors(columns)
+            positions = self.solve(time, bodies)
+            local = np.full(len(self), -1, dtype=np.intp)
+            local[bodies] = np.arange(len(bodies))
+            for index, parent in self.anchors:
+                if local[index] >= 0:
+                    true_pos = parent.true_pos
+                    positions[local[index]] += (true_pos.get_x(),
+                                                true_pos.get_y(),
+                                                true_pos.get_z())
+            for level in self.levels:
+                level = level[local[level] >= 0]
+                parents = local[self.parents[level]]
+                positions[local[level]] += positions[parents]
+            return positions[local[columns]]
+        positions = self.solve(time)
+        for index, parent in self.anchors:
+            true_pos = parent.true_pos
+            positions[index] += (true_pos.get_x(), true_pos.get_y(),
+                                 true_pos.get_z())
+        for level in self.levels:
+            positions[level] += positions[self.parents[level]]
+        return positions
+
+    def update(self, time):
+        """Solves every body and writes the heliocentric result to its
+        true_pos."""
+        positions = self.heliocentric(time)
+        for component, (x, y, z) in zip(self.components, positions.tolist()):
+            component.true_pos = LPoint3d(x, y, z)
+
+    def path_samples(self, start, end):
+        """Returns an (n,) array of how many samples the path of each body
+        from day start to day end needs.
+
+        Every body gets PATH_SAMPLES_PER_ORBIT for each orbit it completes in
+        the range, multiplied by (1 + e) / (1 - e) as eccentric orbits sweep
+        around periapsis much faster than their mean motion."""
+        row = ORBIT_ELEMENTS.index
+        eccentricity = np.clip(self.base[row('e')] + self.rate[row('e')] * start,
+                               0.0, 0.99)
+        mean_motion = np.abs(self.rate[row('M')])
+        for element_row, column, expression in self.nonlinear:
+            if element_row == row('e'):
+                eccentricity[column] = min(max(expression(start), 0.0), 0.99)
+            elif element_row == row('M'):
+                mean_motion[column] = abs(expression(start + 1.0)
+                                          - expression(start))
+        orbits = np.maximum(mean_motion * abs(end - start) / 360.0, 1.0)
+        needed = PATH_SAMPLES_PER_ORBIT * orbits * (1.0 + eccentricity) / \
+            (1.0 - eccentricity)
+        return np.clip(np.ceil(needed), MIN_PATH_SAMPLES,
+                       MAX_PATH_SAMPLES).astype(np.intp)
+
+    def paths(self, start, end, samples=None, heliocentric=True,
+              grouped=False):
+        """Returns (days, positions) sampling every body from day start to
+        day end in one vectorized pass. positions is a read only
+        (n, k, 3) array in meters in batch order and days the (n, k) days of
+        its samples. Each body gets its path_samples evenly spaced days, so
+        one eccentric comet does not make every moon use thousands of
+        samples, and repeats its last day up to the k of the densest body.
+        With samples every body gets that many.
+
+        With grouped returns a list of (indexes, days, positions) instead,
+        bodies grouped by the power of two above their path_samples and each
+        group solved with its own 1d days and no padding.
+
+        Results are cached until the orbit of a body changes."""
+        if not self.is_current():
+            self.load_elements()
+        key = (start, end, samples, heliocentric, grouped)
+        cached = self.path_cache.get(key)
+        if cached is not None:
+            self.path_cache.move_to_end(key)
+            return cached
+        if samples is None:
+            counts = self.path_samples(start, end)
+            counts = np.minimum(2 ** np.ceil(np.log2(counts)),
+                                MAX_PATH_SAMPLES).astype(np.intp)
+        else:
+            counts = np.full(len(self), samples, dtype=np.intp)
+        if grouped:
+            result = self.grouped_paths(start, end, counts, heliocentric)
+        else:
+            result = self.padded_paths(start, end, counts, heliocentric)
+        self.path_cache[key] = result
+        if len(self.path_cache) > PATH_CACHE_SIZE:
+            self.path_cache.popitem(last=False)
+        return result
+
+    def padded_paths(self, start, end, counts, heliocentric):
+        steps = np.minimum(np.arange(counts.max(initial=1)),
+                           counts[:, None] - 1)
+        days = start + (end - start) * steps / \
+            np.maximum(counts[:, None] - 1, 1)
+        if not heliocentric:
+            positions = self.solve_rows(np.arange(len(self)), days)
+        else:
+            # A body and its ancestors are solved on the days of the body
+            positions = np.zeros(days.shape + (3,), dtype=np.float64)
+            np.add.at(positions, self.chain_owners,
+                      self.solve_rows(self.chain, days[self.chain_owners]))
+            origins = np.zeros((len(self), 3), dtype=np.float64)
+            for index, parent in self.anchors:
+                true_pos = parent.true_pos
+                origins[index] = (true_pos.get_x(), true_pos.get_y(),
+                                  true_pos.get_z())
+            positions += origins[self.roots][:, None]
+        days.flags.writeable = False
+        positions.flags.writeable = False
+        return days, positions
+
+    def grouped_paths(self, start, end, counts, heliocentric):
+        groups = []
+        for count in np.unique(counts).tolist():
+            indexes = np.flatnonzero(counts == count)
+            days = np.linspace(start, end, count)
+            if heliocentric:
+                positions = self.heliocentric(days, indexes)
+            else:
+                positions = self.solve(days, indexes)
+            for array in (indexes, days, positions):
+                array.flags.writeable = False
+            groups.append((indexes, days, positions))
+        return groups
+
+
+def solve_kepler(M, e, tolerance=KEPLER_TOLERANCE,
+                 max_iterations=KEPLER_MAX_ITERATIONS):
+    """Vectorized Newton solver of Kepler's equation M = E - e sin(E). Returns
+    the eccentric anomaly for arrays of mean anomalies and eccentricities."""
+    E = M + e * np.sin(M) * (1.0 + e * np.cos(M))
+    for _ in range(max_iterations):
+        delta = (E - e * np.sin(E) - M) / (1.0 - e * np.cos(E))
+        E -= delta
+        if not np.any(np.abs(delta) > tolerance):
+            break
+    return E
+
+
+def calc_body_positions(a, e, M, w, i, N, scale=1.0):
+    """Vectorized calc_body_pos. Takes arrays of elements, angles in radians,
+    and returns an (..., 3) array of positions relative to the parents
+    multiplied by scale."""
+    E = solve_kepler(M, e)
+    xv = a * (np.cos(E) - e)
+    yv = a * (np.sqrt(1.0 - e * e) * np.sin(E))
+    v = np.arctan2(yv, xv)
+    r = np.hypot(xv, yv)
+    cos_N = np.cos(N)
+    sin_N = np.sin(N)
+    cos_vw = np.cos(v + w)
+    sin_vw = np.sin(v + w)
+    cos_i = np.cos(i)
+    positions = np.empty(np.shape(r) + (3,), dtype=np.float64)
+    positions[..., 0] = r * (cos_N * cos_vw - sin_N * sin_vw * cos_i)
+    positions[..., 1] = r * (sin_N * cos_vw + cos_N * sin_vw * cos_i)
+    if is2d:
+        positions[..., 2] = 0
+    else:
+        positions[..., 2] = r * (sin_vw * np.sin(i))
+    positions *= np.expand_dims(scale, -1)
+    return positions
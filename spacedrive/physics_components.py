@@ -1,9 +1,22 @@
+from panda3d.core import LPoint3d, Quat
+
+from . import floating_origin
+
+
 class BulletPhysicsComponent(object):
     """Contains reference to bullet shape and node as well as SOI for
     planetary gravitational influence.
 
-    zonex and zoney is the id of the bullet world. The true
-    position is is worldx + nodePath.getX()"""
+    zone is the physics_zones.Zone holding the bullet world. nodePath is
+    attached to the FloatingOrigin of that world, the shared one if origin is
+    None. The true position is the origin plus nodePath.getPos()
+
+    The physics system stores the transform of the last two ticks in
+    previous_pos/quat and current_pos/quat. If render_node_path is set it is
+    drawn between the two instead of at the transform of the rigid body.
+
+    on_rails is True while physics_rails moves the ship instead of Bullet,
+    zone is None then."""
     bulletShape = None
     node = None
     nodePath = None
@@ -12,19 +25,57 @@ class BulletPhysicsComponent(object):
     currentThrust = 0
     currentTorque = 0
     currentSOI = None  # EntityID
-    zonex = 0
-    zoney = 0
+    zone = None
+    origin = None
+    previous_pos = None
+    previous_quat = None
+    current_pos = None
+    current_quat = None
+    render_node_path = None
+    on_rails = False
+
+    def get_origin(self):
+        if self.origin is None:
+            return floating_origin.get_origin()
+        return self.origin
 
     def get_true_pos(self, debug=False):
         '''Returns the "true" position of this object'''
+        true_pos = self.get_origin().get_true_pos(self.nodePath)
         if debug:
-            print(self.nodePath.getName(), self.zoney * physics.ZONESIZE, self.nodePath.getY(), self.zoney * physics.ZONESIZE + self.nodePath.getY())
-        return LPoint3d(
-            self.zonex * physics.ZONESIZE + self.nodePath.getX(),
-            self.zoney * physics.ZONESIZE + self.nodePath.getY(),
-            self.nodePath.getZ()
-        )
+            print(self.nodePath.getName(), self.get_origin().origin, self.nodePath.getPos(), true_pos)
+        return true_pos
+
+    def set_true_pos(self, true_pos):
+        '''Places the object at a true position'''
+        self.get_origin().set_true_pos(self.nodePath, true_pos)
 
     def setTruePos(self, truex, truey):
         '''Converts the true pos into the proper zone system'''
-        physics.setZone(self, truex, truey)
+        self.set_true_pos(LPoint3d(truex, truey, self.get_true_pos().get_z()))
+
+    def store_transform(self):
+        """Moves the current transform to previous and reads the new one from
+        nodePath. True positions are kept so rebasing a zone between ticks
+        does not show."""
+        self.previous_pos = self.current_pos
+        self.previous_quat = self.current_quat
+        self.current_pos = self.get_true_pos()
+        self.current_quat = self.nodePath.get_quat(self.get_origin().root)
+        if self.previous_pos is None:
+            self.previous_pos = self.current_pos
+            self.previous_quat = self.current_quat
+
+    def get_interpolated_transform(self, alpha):
+        """Returns (true_pos, quat) alpha of the way from the previous to the
+        current tick."""
+        true_pos = self.previous_pos + (self.current_pos - self.previous_pos) \
+            * alpha
+        previous = self.previous_quat
+        current = self.current_quat
+        # Take the short way around
+        sign = -1.0 if previous.dot(current) < 0 else 1.0
+        quat = Quat(*[a * (1.0 - alpha) + sign * b * alpha
+                      for a, b in zip(previous, current)])
+        quat.normalize()
+        return true_pos, quat
@@ -0,0 +1,226 @@
+"""On rails propagation of ships far from every player.
+
+A ship that is not thrusting and is far from every player does not need a
+rigid body. It is taken out of its Bullet world, its state relative to its
+SOI body is turned into Keplerian elements and it is moved along that orbit
+with the same Kepler solver orbit_system uses for celestial bodies. Once it
+thrusts, a player comes near or it enters another SOI it is put back into a
+Bullet world with the position and velocity of the orbit.
+
+The orbit treats the frame of the SOI body as inertial, while Bullet ships
+move heliocentrically under the gravity of their SOI body alone and so drift
+relative to a body that is itself accelerating around its parent. Rails
+follow the body exactly, Bullet does not, so a ship may be off by that drift
+when it comes off rails. With PhysicsSystem.nbody the gravity of the
+ancestors is summed and the drift shrinks, but the two still differ."""
+
+import numpy as np
+from panda3d.core import LPoint3d
+
+from . import orbit_system
+
+from direct.directnotify.DirectNotify import DirectNotify
+
+log = DirectNotify().newCategory("SpaceDrive-PhysicsRails")
+
+# Coasting ships further than this from every player go on rails, in meters
+RAILS_DISTANCE = 200000.0
+# Ships on rails closer than this to a player get a rigid body again. Smaller
+# than RAILS_DISTANCE so ships at the edge do not flip every check.
+MATERIALIZE_DISTANCE = 150000.0
+# Physics ticks between checks of which ships should go on rails
+RAILS_CHECK_INTERVAL = 15
+
+_EPSILON = 1e-12
+
+
+def calc_orbit_elements(positions, velocities, mu):
+    """Converts (k, 3) arrays of positions and velocities relative to the
+    bodies orbited, in meters and meters per second, to elements.
+
+    mu is the (k,) gravitational parameter of each body. Returns a (6, k)
+    array in ORBIT_ELEMENTS order, a in meters and angles in radians, and a
+    (k,) mask of the orbits that are closed. Equatorial orbits get an
+    ascending node of 0 and circular orbits a perihelion of 0."""
+    positions = np.asarray(positions, dtype=np.float64)
+    velocities = np.asarray(velocities, dtype=np.float64)
+    r = np.linalg.norm(positions, axis=1)
+    speed_squared = np.einsum('kj,kj->k', velocities, velocities)
+    momentum = np.cross(positions, velocities)
+    h = np.linalg.norm(momentum, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        normal = momentum / h[:, None]
+        eccentricity = ((speed_squared - mu / r)[:, None] * positions
+                        - np.einsum('kj,kj->k', positions,
+                                    velocities)[:, None] * velocities) / \
+            mu[:, None]
+        e = np.linalg.norm(eccentricity, axis=1)
+        a = -mu / (2.0 * (speed_squared / 2.0 - mu / r))
+        i = np.arccos(np.clip(normal[:, 2], -1.0, 1.0))
+    # Line of nodes, the x axis when the orbit is equatorial
+    nodes = np.stack((-momentum[:, 1], momentum[:, 0],
+                      np.zeros(len(h))), axis=1)
+    node_length = np.linalg.norm(nodes, axis=1)
+    equatorial = node_length <= _EPSILON * np.maximum(h, _EPSILON)
+    nodes[equatorial] = (1.0, 0.0, 0.0)
+    nodes /= np.linalg.norm(nodes, axis=1)[:, None]
+    N = np.arctan2(nodes[:, 1], nodes[:, 0])
+
+    def angle_from_node(vectors):
+        return np.arctan2(
+            np.einsum('kj,kj->k', np.cross(nodes, vectors), normal),
+            np.einsum('kj,kj->k', nodes, vectors))
+
+    # Argument of latitude of the position and argument of perihelion
+    u = angle_from_node(positions)
+    w = np.where(e > _EPSILON, angle_from_node(eccentricity), 0.0)
+    v = u - w
+    closed = np.isfinite(a) & (a > 0) & (e < 1.0) & (h > 0)
+    with np.errstate(invalid='ignore'):
+        E = np.arctan2(np.sqrt(1.0 - e * e) * np.sin(v), e + np.cos(v))
+    M = E - e * np.sin(E)
+    return np.array([a, e, i, N, w, M]), closed
+
+
+def calc_orbit_velocities(a, e, M, w, i, N, mu):
+    """Velocities, in meters per second, matching the positions of
+    orbit_system.calc_body_positions for elements in meters and radians."""
+    E = orbit_system.solve_kepler(M, e)
+    v = np.arctan2(np.sqrt(1.0 - e * e) * np.sin(E), np.cos(E) - e)
+    speed = np.sqrt(mu / (a * (1.0 - e * e)))
+    cos_N = np.cos(N)
+    sin_N = np.sin(N)
+    cos_w = np.cos(w)
+    sin_w = np.sin(w)
+    cos_i = np.cos(i)
+    # Perifocal axes toward perihelion and 90 degrees after it
+    p = np.stack((cos_N * cos_w - sin_N * sin_w * cos_i,
+                  sin_N * cos_w + cos_N * sin_w * cos_i,
+                  sin_w * np.sin(i)), axis=-1)
+    q = np.stack((-cos_N * sin_w - sin_N * cos_w * cos_i,
+                  -sin_N * sin_w + cos_N * cos_w * cos_i,
+                  cos_w * np.sin(i)), axis=-1)
+    velocities = (np.expand_dims(-speed * np.sin(v), -1) * p
+                  + np.expand_dims(speed * (e + np.cos(v)), -1) * q)
+    if orbit_system.is2d:
+        velocities[..., 2] = 0
+    return velocities
+
+
+class Rails(object):
+    """Ships moving along fixed orbits instead of through Bullet.
+
+    elements is a (6, k) array in ORBIT_ELEMENTS order of the orbit of each
+    ship at epoch, in physics seconds, around the body with entity id in
+    soi_ids. positions and velocities hold the state relative to those bodies
+    at the last propagate(). angular_velocities keeps the spin to give back
+    to the rigid body."""
+    def __init__(self):
+        self.components = []
+        self.soi_ids = []
+        self.elements = np.empty((6, 0), dtype=np.float64)
+        self.motion = np.empty(0, dtype=np.float64)
+        self.mu = np.empty(0, dtype=np.float64)
+        self.epoch = np.empty(0, dtype=np.float64)
+        self.angular_velocities = np.empty((0, 3), dtype=np.float64)
+        self.positions = np.empty((0, 3), dtype=np.float64)
+        self.velocities = np.empty((0, 3), dtype=np.float64)
+        self.time = 0.0
+        self.soi_index = None
+        self.body_indexes = None
+
+    def __len__(self):
+        return len(self.components)
+
+    def add(self, components, soi_ids, elements, mu, time,
+            angular_velocities):
+        """Puts components on rails with (6, k) elements at time."""
+        self.components.extend(components)
+        self.soi_ids.extend(soi_ids)
+        self.elements = np.concatenate((self.elements, elements), axis=1)
+        self.motion = np.append(self.motion, np.sqrt(mu / elements[0] ** 3))
+        self.mu = np.append(self.mu, mu)
+        self.epoch = np.append(self.epoch, np.full(len(components), time))
+        self.angular_velocities = np.concatenate(
+            (self.angular_velocities,
+             np.asarray(angular_velocities, dtype=np.float64).reshape(-1, 3)))
+        # Filled in by the next propagate()
+        padding = np.zeros((len(components), 3), dtype=np.float64)
+        self.positions = np.concatenate((self.positions, padding))
+        self.velocities = np.concatenate((self.velocities, padding))
+        self.body_indexes = None
+        for component in components:
+            component.on_rails = True
+
+    def remove(self, components):
+        """Takes components off rails. Returns the components in rails order,
+        the SOI entity ids of their orbits and (k, 3) arrays of their
+        positions and velocities relative to those bodies and their angular
+        velocities, at the last propagate()."""
+        removed = set(id(component) for component in components)
+        rows = np.array([id(component) in removed
+                         for component in self.components], dtype=bool)
+        a, e, i, N, w, M = self.get_elements(self.time)[:, rows]
+        velocities = calc_orbit_velocities(a, e, M, w, i, N, self.mu[rows])
+        positions = orbit_system.calc_body_positions(a, e, M, w, i, N)
+        result = ([component for component, row in
+                   zip(self.components, rows.tolist()) if row],
+                  [soi_id for soi_id, row in zip(self.soi_ids, rows.tolist())
+                   if row], positions, velocities,
+                  self.angular_velocities[rows])
+        keep = (~rows).tolist()
+        self.components = [component for component, kept in
+                           zip(self.components, keep) if kept]
+        self.soi_ids = [soi_id for soi_id, kept in zip(self.soi_ids, keep)
+                        if kept]
+        keep = ~rows
+        self.elements = self.elements[:, keep]
+        self.motion = self.motion[keep]
+        self.mu = self.mu[keep]
+        self.epoch = self.epoch[keep]
+        self.angular_velocities = self.angular_velocities[keep]
+        self.positions = self.positions[keep]
+        self.velocities = self.velocities[keep]
+        self.body_indexes = None
+        for component in components:
+            component.on_rails = False
+        return result
+
+    def get_velocity(self, component):
+        """Returns the velocity of component relative to its SOI body at the
+        last propagate()."""
+        row = self.components.index(component)
+        a, e, i, N, w, M = self.get_elements(self.time)[:, row]
+        return calc_orbit_velocities(a, e, M, w, i, N, self.mu[row])
+
+    def get_orphans(self, soi_index):
+        """Returns the components orbiting a body soi_index no longer has."""
+        return [component for component, soi_id in
+                zip(self.components, self.soi_ids)
+                if soi_id not in soi_index.index_of]
+
+    def get_elements(self, time):
+        """Returns the elements of every ship at time, only M changes."""
+        elements = self.elements.copy()
+        elements[5] += self.motion * (time - self.epoch)
+        return elements
+
+    def propagate(self, time, soi_index):
+        """Moves every ship to its place on its orbit at time. Every ship
+        has to orbit a body of soi_index, take the get_orphans() off first."""
+        self.time = time
+        a, e, i, N, w, M = self.get_elements(time)
+        self.positions = orbit_system.calc_body_positions(a, e, M, w, i, N)
+        self.velocities = calc_orbit_velocities(a, e, M, w, i, N, self.mu)
+        if not self.components:
+            return
+        if self.body_indexes is None or self.soi_index is not soi_index:
+            self.soi_index = soi_index
+            self.body_indexes = np.array(
+                [soi_index.index_of[soi_id] for soi_id in self.soi_ids],
+                dtype=np.intp)
+        true_positions = self.positions + \
+            soi_index.positions[self.body_indexes]
+        for component, true_pos in zip(self.components,
+                                       true_positions.tolist()):
+            component.set_true_pos(LPoint3d(*true_pos))
@@ -0,0 +1,208 @@
+"""Ring buffer of physics state for rollback.
+
+PhysicsSystem records the state of every ship at the end of each tick into
+arrays allocated up front, one row per buffered tick and one slot per ship.
+Recording only copies into the arrays, restoring copies back into the rigid
+bodies. Slots of removed ships are reused, a generation per slot keeps old
+rows from being restored into the new ship. The day and the positions of the
+SOI bodies are kept with each tick so a replay sees the bodies where they
+were."""
+
+import numpy as np
+from panda3d.core import LPoint3d, Quat, Vec3
+
+from direct.directnotify.DirectNotify import DirectNotify
+
+log = DirectNotify().newCategory("SpaceDrive-PhysicsSnapshots")
+
+# Ticks kept, two seconds at the default tick rate
+DEFAULT_CAPACITY = 128
+# Ship slots allocated up front, doubled when they run out
+DEFAULT_SHIPS = 64
+
+
+class SnapshotBuffer(object):
+    """Last capacity ticks of ship positions, orientations, velocities, SOI
+    and thrust inputs.
+
+    Row tick % capacity holds tick. generations is 0 for slots without a ship
+    in that tick. on_rails records which ships were on rails, ships on rails
+    then and now are not restored, they follow their orbit from the restored
+    time. days and bodies hold the day and the SOIIndex positions of the
+    bodies during each tick, soi_indexes the SOIIndex they belong to."""
+    def __init__(self, capacity=DEFAULT_CAPACITY, ships=DEFAULT_SHIPS):
+        self.capacity = capacity
+        self.ticks = np.full(capacity, -1, dtype=np.int64)
+        self.times = np.zeros(capacity, dtype=np.float64)
+        self.days = np.zeros(capacity, dtype=np.float64)
+        self.bodies = [None] * capacity
+        self.soi_indexes = [None] * capacity
+        self.slots = {}
+        self.components = []
+        self.free = []
+        self.ships = 0
+        self.allocate(ships)
+
+    def allocate(self, ships):
+        """Grows the buffers to ships slots keeping their content."""
+        shapes = {
+            'positions': ((3,), np.float64),
+            'quats': ((4,), np.float64),
+            'linear_velocities': ((3,), np.float64),
+            'angular_velocities': ((3,), np.float64),
+            'soi_ids': ((), np.int64),
+            'thrust': ((), np.float64),
+            'torque': ((), np.float64),
+            'on_rails': ((), bool),
+            'generations': ((), np.int64),
+        }
+        for name, (shape, dtype) in shapes.items():
+            array = np.zeros((self.capacity, ships) + shape, dtype=dtype)
+            if self.ships:
+                array[:, :self.ships] = getattr(self, name)
+            setattr(self, name, array)
+        generation = np.zeros(ships, dtype=np.int64)
+        if self.ships:
+            generation[:self.ships] = self.generation
+        self.generation = generation
+        self.components.extend([None] * (ships - self.ships))
+        self.free.extend(range(ships - 1, self.ships - 1, -1))
+        self.ships = ships
+
+    def get_slot(self, component):
+        slot = self.slots.get(component)
+        if slot is None:
+            if not self.free:
+                self.allocate(self.ships * 2)
+            slot = self.free.pop()
+            self.slots[component] = slot
+            self.components[slot] = component
+            self.generation[slot] += 1
+        return slot
+
+    def release(self, component):
+        """Frees the slot of a removed ship."""
+        slot = self.slots.pop(component, None)
+        if slot is not None:
+            self.components[slot] = None
+            self.generation[slot] += 1
+            self.free.append(slot)
+
+    def find(self, tick):
+        """Returns the row of tick or None if it is not buffered."""
+        row = tick % self.capacity
+        if self.ticks[row] != tick:
+            return None
+        return row
+
+    def get_time(self, tick):
+        return float(self.times[self.find(tick)])
+
+    def record(self, tick, time, components, day=0.0, soi_index=None):
+        """Stores the state of components at the end of tick. Uses the
+        transform BulletPhysicsComponent.store_transform read this tick.
+        day and the body positions of soi_index are the ones the tick was
+        stepped with."""
+        for component in components:
+            if component not in self.slots:
+                self.get_slot(component)
+        row = tick % self.capacity
+        self.ticks[row] = tick
+        self.times[row] = time
+        self.days[row] = day
+        self.soi_indexes[row] = soi_index
+        if soi_index is not None:
+            bodies = self.bodies[row]
+            if bodies is not None and bodies.shape == \
+                    soi_index.positions.shape:
+                bodies[:] = soi_index.positions
+            else:
+                self.bodies[row] = soi_index.positions.copy()
+        generations = self.generations[row]
+        generations[:] = 0
+        positions = self.positions[row]
+        quats = self.quats[row]
+        linear_velocities = self.linear_velocities[row]
+        angular_velocities = self.angular_velocities[row]
+        soi_ids = self.soi_ids[row]
+        thrust = self.thrust[row]
+        torque = self.torque[row]
+        on_rails = self.on_rails[row]
+        for component in components:
+            slot = self.slots[component]
+            generations[slot] = self.generation[slot]
+            positions[slot] = component.current_pos
+            quats[slot] = component.current_quat
+            linear_velocities[slot] = component.node.get_linear_velocity()
+            angular_velocities[slot] = component.node.get_angular_velocity()
+            soi_ids[slot] = -1 if component.currentSOI is None \
+                else component.currentSOI
+            thrust[slot] = component.currentThrust
+            torque[slot] = component.currentTorque
+            on_rails[slot] = component.on_rails
+
+    def present(self, row):
+        """Returns the slots of row recorded for the ship still in them."""
+        return np.flatnonzero((self.generations[row] != 0)
+                              & (self.generations[row] == self.generation))
+
+    def get_bodies(self, tick):
+        """Returns the day, SOIIndex and (k, 3) body positions tick was
+        stepped with, the SOIIndex is None if tick is not buffered."""
+        row = self.find(tick)
+        if row is None:
+            return 0.0, None, None
+        return float(self.days[row]), self.soi_indexes[row], self.bodies[row]
+
+    def get_rails_changes(self, tick):
+        """Returns the ships recorded in tick that were on rails then and are
+        not now, and those on rails now that were not then."""
+        row = self.find(tick)
+        railed = []
+        woken = []
+        if row is None:
+            return railed, woken
+        for slot in self.present(row).tolist():
+            component = self.components[slot]
+            if self.on_rails[row, slot] and not component.on_rails:
+                railed.append(component)
+            elif component.on_rails and not self.on_rails[row, slot]:
+                woken.append(component)
+        return railed, woken
+
+    def restore(self, tick):
+        """Puts every ship recorded in tick and not on rails now back to its
+        state. Returns False if tick is not buffered."""
+        row = self.find(tick)
+        if row is None:
+            return False
+        for slot in self.present(row).tolist():
+            component = self.components[slot]
+            if component.on_rails:
+                continue
+            true_pos = LPoint3d(*self.positions[row, slot].tolist())
+            quat = Quat(*self.quats[row, slot].tolist())
+            component.set_true_pos(true_pos)
+            component.nodePath.set_quat(component.get_origin().root, quat)
+            component.node.set_linear_velocity(
+                Vec3(*self.linear_velocities[row, slot].tolist()))
+            component.node.set_angular_velocity(
+                Vec3(*self.angular_velocities[row, slot].tolist()))
+            soi_id = int(self.soi_ids[row, slot])
+            component.currentSOI = None if soi_id < 0 else soi_id
+            component.currentThrust = float(self.thrust[row, slot])
+            component.currentTorque = float(self.torque[row, slot])
+            component.previous_pos = component.current_pos = true_pos
+            component.previous_quat = component.current_quat = quat
+        return True
+
+    def apply_inputs(self, tick):
+        """Sets the thrust and torque every ship had during tick."""
+        row = self.find(tick)
+        if row is None:
+            return False
+        for slot in self.present(row).tolist():
+            component = self.components[slot]
+            component.currentThrust = float(self.thrust[row, slot])
+            component.currentTorque = float(self.torque[row, slot])
+        return True
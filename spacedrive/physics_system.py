@@ -1,10 +1,20 @@
-from panda3d.core import NodePath, Point3, Vec3
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from panda3d.core import LPoint3d, NodePath, Point3, Vec3
 
 import sandbox
 
 import spacedrive.celestial_components as cel_comps
 import spacedrive.physics_components as phys_comps
 import spacedrive.universals
+from spacedrive.ephemeris import get_ephemeris
+from spacedrive.floating_origin import get_origin
+from spacedrive import physics_rails
+from spacedrive import physics_snapshots
+from spacedrive import physics_zones
+from spacedrive.soi_index import SOIIndex
+from spacedrive.trajectory import get_predictor
 
 from direct.directnotify.DirectNotify import DirectNotify
 log = DirectNotify().newCategory("SpaceDrive-Physics")
@@ -12,93 +22,494 @@ log = DirectNotify().newCategory("SpaceDrive-Physics")
 
 def get_physics():
     return sandbox.get_system(PhysicsSystem)
-'''notes:
-76543.21 for a float cm precision
-100,000 positive, and negative, so world size is 200,000 meters, or 200km'''
-
-
-class FloatingPhysicsSystem(sandbox.EntitySystem):
-    """Floating bullet worlds. Inspired by KSP and CCP physics system.
 
-    Each ship is centered in a 100kmx100kmx100km bullet world.
-    Bullet world origin has a soi relative pos. Ship true pos calculated from
-    world origin true + relative position in world + soi position.
 
-    If the ship enters a distance threshold in bullet world (say 25km) the
-    heliocentric physics data is stored, old bullet world destroyed, new one
-    created that matches current physics. Bullet worlds do not hpr, only pos.
+def calc_central_forces(ship_positions, ship_masses, body_positions,
+                        body_masses, forward, thrust):
+    """Returns the (n, 3) gravity plus thrust force, in newtons, on n ships.
 
-    If the grid touches a ship in another grid, destroy and make a
-    200x200x200km grid to hold all ships on grid. Grid position and velocity is
-    average of all ships on new grid."""
+    body_positions is (n, k, 3) and body_masses (n, k) with the k bodies
+    pulling on each ship, unused slots have a mass of 0. forward is the (n, 3)
+    unit forward vector of each ship and thrust its (n,) thrust."""
+    offsets = body_positions - ship_positions[:, None, :]
+    distances = np.linalg.norm(offsets, axis=2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        strength = spacedrive.universals.G * body_masses * \
+            ship_masses[:, None] / distances ** 3
+    # Ships at the center of a body and padding slots feel nothing
+    strength[~np.isfinite(strength)] = 0.0
+    gravity = np.einsum('nkj,nk->nj', offsets, strength)
+    return gravity + forward * thrust[:, None]
 
 
 class PhysicsSystem(sandbox.EntitySystem):
     """System that interacts with the Bullet physics world.
-    Meshes are made in standard SI (meters, newtons, kg)."""
+    Meshes are made in standard SI (meters, newtons, kg).
+
+    All ships share one Zone around the shared floating origin.
+
+    With workers set above 1 the zones are stepped concurrently on a thread
+    pool, Bullet releases the GIL while stepping. end() waits for every zone
+    before returning.
+
+    Physics runs at a fixed tick_rate whatever the frame rate. Frame time is
+    added to an accumulator and whole ticks are stepped out of it, at most
+    max_substeps per frame so a slow frame does not snowball into ever longer
+    ones. Ships with a render_node_path are drawn between their last two
+    ticks by the fraction of a tick left in the accumulator.
+
+    Coasting ships further than rails_distance from every player are moved
+    along their orbit by physics_rails instead of Bullet. Players are the
+    entities in player_ships and, on a client, universals.shipid. Set
+    rails_distance to None to simulate every ship.
+
+    The state of every ship at the end of each tick is kept in a
+    physics_snapshots.SnapshotBuffer so the world can be restored to a recent
+    tick and resimulated, for lag compensation and client reconciliation.
+    The SOI bodies, the day and which ships are on rails are rewound with
+    them, and no ship goes on or off rails while resimulating."""
+    workers = 0
+    executor = None
+    tick_rate = 60.0
+    max_substeps = 5
+    accumulator = 0.0
+    alpha = 0.0
+    tick_count = 0
+    time = 0.0
+    resimulating = False
+    rails_distance = physics_rails.RAILS_DISTANCE
+    materialize_distance = physics_rails.MATERIALIZE_DISTANCE
+    # Sum the gravity of the SOI body, its ancestors and its moons instead of
+    # only the SOI body
+    nbody = False
+
     def init(self):
         #self.accept("addSpaceship", self.addSpaceship)
         self.accept('setThrottle', self.setThrottle)
         self.counter = 0
+        self.soi_index = None
+        self.celestial_bodies = None
+        self.zones = []
+        self.rails = physics_rails.Rails()
+        self.player_ships = set()
+        self.snapshots = physics_snapshots.SnapshotBuffer()
+
+    def add_ship(self, component):
+        """Puts the rigid body of a BulletPhysicsComponent into a world."""
+        if not self.zones:
+            zone = physics_zones.Zone(get_origin().origin)
+            # Share the render origin instead of a private one
+            zone.origin = get_origin()
+            self.zones.append(zone)
+        self.zones[0].add(component)
+
+    def remove_ship(self, component):
+        self.snapshots.release(component)
+        if component.on_rails:
+            self.rails.remove([component])
+        if component.zone is not None:
+            component.zone.remove(component)
 
     def begin(self):
-        """Nab a copy of the solar system coordinates. No because of threading"""
+        """Nab a copy of the solar system coordinates. No because of threading
 
-    def process(self, entity):
-        physcomp = entity.get_component(phys_comps.BulletPhysicsComponent)
-        if not physcomp.node.is_active():
-            physcomp.node.setActive(True)
-        celestial_bodies = sandbox.get_entities_by_component_type(cel_comps.CelestialComponent)
-        # Probably very expensive. Will need optimization later
-        soi = False
-        previousR = 0
-        for body in celestial_bodies:
-            body_component = body.get_component(cel_comps.CelestialComponent)
-            distance = (body_component.true_pos
-                - physcomp.get_true_pos()).length()
-            if distance < body_component.soi:
-                if not soi:
-                    previousR = distance
-                    soi = True
-                    physcomp.currentSOI = body.id
-                elif distance < previousR:
-                    physcomp.currentSOI = body.id
-        if not soi:
-            #shipPhysics.currentSOI = universals.defaultSOIid
-            log.warning("No SOI for " + str(entity))
-
-        celestial_component = sandbox.entities[physcomp.currentSOI].get_component(
+        Resolves the SOI of every ship in one batch query."""
+        celestial_bodies = sandbox.get_entities_by_component_type(
             cel_comps.CelestialComponent)
-        vector = celestial_component.truePos - physcomp.get_true_pos()
-        distance = vector.length() * 1000
-        gravityForce = Vec3(0, 0, 0)
-        if distance:
-            gravity = universals.G * celestial_component.mass * physcomp.node.getMass() / distance ** 2
-            #print "Gravity", universals.G, celestial.mass, shipPhysics.node.getMass(), distance, gravity
-            gravityForce = vector * -gravity
-
-        thrust = universals.solarSystemRoot.getRelativeVector(shipPhysics.nodePath,
-            (0, shipPhysics.currentThrust, 0))
-
-        #force = (gravityForce + thrust) / 1000.0
-        #print gravityForce, thrust / 1000.0
-        #force = thrust / 1000.0
-        force = thrust
-        shipPhysics.node.applyCentralForce(force)
-        shipPhysics.node.applyTorque(Vec3(0, 0, -shipPhysics.currentTorque))
-        #shipPhysics.node.applyTorque(Vec3(0, 0, -1.3e+7))
-        #print "beat", shipPhysics.nodePath.getHpr(), shipPhysics.node.getAngularVelocity()
-        #print "Physics", shipPhysics.nodePath.getHpr(), shipPhysics.currentTorque, shipPhysics.node.getAngularVelocity()
-        #print "Physics", shipPhysics.nodePath.getPos(), shipPhysics.node.getLinier
-        #self.world.setDebugNode(shipPhysics.debugNode)
+        if celestial_bodies != self.celestial_bodies:
+            self.celestial_bodies = celestial_bodies
+            self.soi_index = SOIIndex(celestial_bodies)
+        else:
+            self.soi_index.update()
+        self.update_soi(sandbox.get_components(
+            phys_comps.BulletPhysicsComponent))
+
+    def update_soi(self, components):
+        """Sets currentSOI of each BulletPhysicsComponent. The previous SOI is
+        the starting point of the search so most ships only check the bodies
+        orbiting it."""
+        if not components:
+            return
+        positions = []
+        for physcomp in components:
+            true_pos = physcomp.get_true_pos()
+            positions.append((true_pos.get_x(), true_pos.get_y(),
+                              true_pos.get_z()))
+        soi_ids = self.soi_index.find_all(
+            positions, [physcomp.currentSOI for physcomp in components])
+        for physcomp, soi_id in zip(components, soi_ids):
+            physcomp.currentSOI = soi_id
+
+    def apply_forces(self, components):
+        """Computes gravity and thrust of every ship in one pass with
+        calc_central_forces and applies them to the rigid bodies."""
+        ships = []
+        for physcomp in components:
+            if not physcomp.node.is_active():
+                physcomp.node.setActive(True)
+            if physcomp.currentSOI not in self.soi_index.index_of:
+                #shipPhysics.currentSOI = universals.defaultSOIid
+                log.warning("No SOI for " + str(physcomp.nodePath))
+                continue
+            ships.append(physcomp)
+        if not ships:
+            return
+        count = len(ships)
+        positions = np.empty((count, 3), dtype=np.float64)
+        masses = np.empty(count, dtype=np.float64)
+        forward = np.empty((count, 3), dtype=np.float64)
+        thrust = np.empty(count, dtype=np.float64)
+        soi_indexes = []
+        for row, physcomp in enumerate(ships):
+            positions[row] = tuple(physcomp.get_true_pos())
+            masses[row] = physcomp.node.getMass()
+            # Bullet worlds do not hpr so the zone root is aligned with the
+            # solar system
+            forward[row] = tuple(physcomp.nodePath.get_quat(
+                physcomp.get_origin().root).get_forward())
+            thrust[row] = physcomp.currentThrust
+            soi_indexes.append(
+                self.soi_index.index_of[physcomp.currentSOI])
+        bodies = self.get_gravity_bodies(soi_indexes)
+        # Index -1 of the padding picks the zero mass row at the end
+        body_positions = np.vstack((self.soi_index.positions,
+                                    np.zeros((1, 3))))
+        body_masses = np.append(self.soi_index.masses, 0.0)
+        forces = calc_central_forces(positions, masses, body_positions[bodies],
+                                     body_masses[bodies], forward, thrust)
+        for physcomp, force in zip(ships, forces.tolist()):
+            physcomp.node.applyCentralForce(Vec3(*force))
+            physcomp.node.applyTorque(Vec3(0, 0, -physcomp.currentTorque))
+
+    def get_gravity_bodies(self, soi_indexes):
+        """Returns an (n, k) array of the SOIIndex bodies pulling on each ship,
+        padded with -1."""
+        if not self.nbody:
+            return np.array(soi_indexes, dtype=np.intp)[:, None]
+        rows = [self.soi_index.perturbers(index) for index in soi_indexes]
+        bodies = np.full((len(rows), max(len(row) for row in rows)), -1,
+                         dtype=np.intp)
+        for row, perturbers in enumerate(rows):
+            bodies[row, :len(perturbers)] = perturbers
+        return bodies
+
+    def process(self, entity):
+        """Forces are applied to every ship at once in step()."""
+
+    def set_workers(self, workers):
+        """Sets how many threads step zones, 0 or 1 steps on the main
+        thread."""
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        self.workers = workers
+        if workers > 1:
+            self.executor = ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix='SpaceDrive-Physics')
 
     def end(self):
-        dt = globalClock.getDt()
-        for zonex in worlds:
-            for zoney in worlds[zonex]:
-                worlds[zonex][zoney][0].doPhysics(dt)
+        self.advance(globalClock.getDt())
         #self.world.doPhysics(dt, 10, 1.0 / 180.0)
 
+    def advance(self, dt):
+        """Adds dt seconds to the accumulator and steps the whole ticks in it.
+        Returns the number of ticks stepped."""
+        tick = 1.0 / self.tick_rate
+        self.accumulator += dt
+        ticks = 0
+        while self.accumulator >= tick and ticks < self.max_substeps:
+            self.step(tick)
+            self.accumulator -= tick
+            ticks += 1
+        if self.accumulator >= tick:
+            log.debug("Physics behind, dropping " + str(self.accumulator)
+                      + " seconds")
+            self.accumulator %= tick
+        self.alpha = self.accumulator / tick
+        self.interpolate(sandbox.get_components(
+            phys_comps.BulletPhysicsComponent), self.alpha)
+        return ticks
+
+    def step(self, dt):
+        """Applies forces and steps every zone by one tick of dt seconds."""
+        components = sandbox.get_components(phys_comps.BulletPhysicsComponent)
+        if self.rails_distance is not None and self.soi_index is not None \
+                and not self.resimulating:
+            if self.tick_count % physics_rails.RAILS_CHECK_INTERVAL == 0:
+                self.update_rails(components)
+            else:
+                thrusting = [physcomp for physcomp in self.rails.components
+                             if physcomp.currentThrust
+                             or physcomp.currentTorque]
+                if thrusting:
+                    self.take_off_rails(thrusting)
+        self.apply_forces([physcomp for physcomp in components
+                           if not physcomp.on_rails])
+        self.step_zones(dt)
+        self.time += dt
+        self.propagate_rails()
+        for physcomp in components:
+            physcomp.store_transform()
+        self.tick_count += 1
+        self.snapshots.record(self.tick_count, self.time, components,
+                              spacedrive.universals.day, self.soi_index)
+
+    def restore(self, tick):
+        """Puts every ship, on or off rails, the SOI bodies and the day back
+        to their state at the end of tick. Returns False if tick is no longer
+        buffered."""
+        if self.snapshots.find(tick) is None:
+            return False
+        railed, woken = self.snapshots.get_rails_changes(tick)
+        if woken:
+            self.take_off_rails(woken)
+        self.rewind_bodies(tick)
+        self.snapshots.restore(tick)
+        self.tick_count = tick
+        self.time = self.snapshots.get_time(tick)
+        railed = [physcomp for physcomp in railed
+                  if physcomp.zone is not None
+                  and physcomp.currentSOI in self.soi_index.index_of]
+        if railed:
+            self.put_on_rails(railed, np.array(
+                [tuple(physcomp.get_true_pos()) for physcomp in railed],
+                dtype=np.float64))
+        self.propagate_rails()
+        return True
+
+    def rewind_bodies(self, tick):
+        """Puts the SOI bodies and the day back to where they were while
+        tick was stepped. Kept as they are if the SOIIndex changed since."""
+        day, soi_index, bodies = self.snapshots.get_bodies(tick)
+        if soi_index is None or soi_index is not self.soi_index:
+            return
+        soi_index.positions[:] = bodies
+        spacedrive.universals.day = day
+
+    def propagate_rails(self):
+        """Moves the ships on rails to self.time. Ships orbiting a body that
+        left the SOIIndex get their rigid body back first."""
+        if not len(self.rails):
+            return
+        if self.rails.soi_index is not self.soi_index:
+            orphans = self.rails.get_orphans(self.soi_index)
+            if orphans:
+                self.take_off_rails(orphans)
+        if len(self.rails):
+            self.rails.propagate(self.time, self.soi_index)
+            # The rigid bodies are out of the worlds, keep the orbit velocity
+            # on them for the snapshots
+            velocities = self.rails.velocities + self.get_body_velocities(
+                self.rails.body_indexes.tolist())
+            for physcomp, velocity in zip(self.rails.components,
+                                          velocities.tolist()):
+                physcomp.node.set_linear_velocity(Vec3(*velocity))
+
+    def resimulate(self, tick, on_tick=None):
+        """Restores tick and steps forward again to the current tick with the
+        recorded thrust and torque of each tick. on_tick(tick) is called
+        before stepping each tick and may change the inputs, such as with
+        corrected client input. Returns False if tick is not buffered."""
+        current = self.tick_count
+        if not self.restore(tick):
+            return False
+        dt = 1.0 / self.tick_rate
+        self.resimulating = True
+        try:
+            while self.tick_count < current:
+                self.snapshots.apply_inputs(self.tick_count + 1)
+                self.rewind_bodies(self.tick_count + 1)
+                if on_tick is not None:
+                    on_tick(self.tick_count + 1)
+                self.step(dt)
+        finally:
+            self.resimulating = False
+        return True
+
+    def get_player_ships(self):
+        """Returns the BulletPhysicsComponents of the player ships."""
+        entity_ids = set(self.player_ships)
+        if spacedrive.universals.shipid is not None:
+            entity_ids.add(spacedrive.universals.shipid)
+        players = []
+        for entity_id in entity_ids:
+            entity = sandbox.entities.get(entity_id)
+            if entity is not None and entity.has_component(
+                    phys_comps.BulletPhysicsComponent):
+                players.append(entity.get_component(
+                    phys_comps.BulletPhysicsComponent))
+        return players
+
+    def update_rails(self, components):
+        """Puts coasting ships far from every player on rails. Ships on
+        rails near a player, thrusting or in another SOI than their orbit get
+        their rigid body back."""
+        if not components:
+            return
+        positions = np.array([tuple(physcomp.get_true_pos())
+                              for physcomp in components], dtype=np.float64)
+        players = self.get_player_ships()
+        if players:
+            player_positions = np.array([tuple(physcomp.get_true_pos())
+                                         for physcomp in players],
+                                        dtype=np.float64)
+            distances = np.linalg.norm(
+                positions[:, None, :] - player_positions[None, :, :],
+                axis=2).min(axis=1).tolist()
+        else:
+            distances = [np.inf] * len(components)
+        player_ids = set(id(physcomp) for physcomp in players)
+        rails_soi = dict((id(physcomp), soi_id) for physcomp, soi_id in
+                         zip(self.rails.components, self.rails.soi_ids))
+        wake = []
+        coasting = []
+        for row, physcomp in enumerate(components):
+            thrusting = physcomp.currentThrust or physcomp.currentTorque
+            if physcomp.on_rails:
+                if (thrusting or distances[row] < self.materialize_distance
+                        or physcomp.currentSOI != rails_soi[id(physcomp)]):
+                    wake.append(physcomp)
+            elif (not thrusting and id(physcomp) not in player_ids
+                    and distances[row] > self.rails_distance
+                    and physcomp.zone is not None
+                    and physcomp.currentSOI in self.soi_index.index_of):
+                coasting.append(row)
+        if wake:
+            self.take_off_rails(wake)
+        if coasting:
+            self.put_on_rails([components[row] for row in coasting],
+                              positions[coasting])
+
+    def get_body_velocities(self, soi_indexes):
+        """Returns the (k, 3) heliocentric velocities of SOIIndex bodies."""
+        ephemeris = get_ephemeris()
+        day = spacedrive.universals.day
+        velocities = {}
+        for index in set(soi_indexes):
+            velocities[index] = tuple(ephemeris.heliocentric_velocity(
+                self.soi_index.components[index], day))
+        return np.array([velocities[index] for index in soi_indexes],
+                        dtype=np.float64).reshape(-1, 3)
+
+    def get_frames(self, soi_ids):
+        """Returns (k, 3) true positions and velocities of the SOI bodies
+        of a list of SOI entity ids, zero for unknown ids. Pass them to
+        networking.quantize.Quantizer.encode."""
+        positions = np.zeros((len(soi_ids), 3), dtype=np.float64)
+        velocities = np.zeros((len(soi_ids), 3), dtype=np.float64)
+        rows = [row for row, soi_id in enumerate(soi_ids)
+                if soi_id in self.soi_index.index_of]
+        if rows:
+            indexes = [self.soi_index.index_of[soi_ids[row]] for row in rows]
+            positions[rows] = self.soi_index.positions[indexes]
+            velocities[rows] = self.get_body_velocities(indexes)
+        return positions, velocities
+
+    def put_on_rails(self, components, positions):
+        """Takes ships at (k, 3) true positions out of Bullet if their orbit
+        around their SOI body is closed, clear of the body and inside the
+        SOI."""
+        soi_indexes = [self.soi_index.index_of[physcomp.currentSOI]
+                       for physcomp in components]
+        velocities = np.array([tuple(physcomp.node.get_linear_velocity())
+                               for physcomp in components], dtype=np.float64)
+        mu = spacedrive.universals.G * self.soi_index.masses[soi_indexes]
+        elements, closed = physics_rails.calc_orbit_elements(
+            positions - self.soi_index.positions[soi_indexes],
+            velocities - self.get_body_velocities(soi_indexes), mu)
+        a, e = elements[0], elements[1]
+        radii = np.array([self.soi_index.components[index].radius
+                          for index in soi_indexes], dtype=np.float64)
+        with np.errstate(invalid='ignore'):
+            closed &= (a * (1.0 - e) > radii) & \
+                (a * (1.0 + e) < self.soi_index.radii[soi_indexes])
+        rows = np.flatnonzero(closed).tolist()
+        if not rows:
+            return
+        railed = [components[row] for row in rows]
+        angular_velocities = [tuple(physcomp.node.get_angular_velocity())
+                              for physcomp in railed]
+        for physcomp in railed:
+            # Keeps the snapshot slot, unlike remove_ship
+            physcomp.zone.remove(physcomp)
+            true_pos = physcomp.get_true_pos()
+            physcomp.origin = None
+            get_origin().attach(physcomp.nodePath)
+            physcomp.set_true_pos(true_pos)
+        self.rails.add(railed, [physcomp.currentSOI for physcomp in railed],
+                       elements[:, rows], mu[rows], self.time,
+                       angular_velocities)
+        log.debug(str(len(railed)) + " ships on rails")
+
+    def take_off_rails(self, components):
+        """Gives ships on rails their rigid body back with the position and
+        velocity of their orbit."""
+        components, soi_ids, positions, velocities, angular_velocities = \
+            self.rails.remove(components)
+        known = [soi_id in self.soi_index.index_of for soi_id in soi_ids]
+        soi_indexes = [self.soi_index.index_of[soi_id]
+                       for soi_id, found in zip(soi_ids, known) if found]
+        mask = np.array(known, dtype=bool)
+        positions = (positions[mask]
+                     + self.soi_index.positions[soi_indexes]).tolist()
+        velocities = (velocities[mask]
+                      + self.get_body_velocities(soi_indexes)).tolist()
+        row = 0
+        for physcomp, found, spin in zip(components, known,
+                                         angular_velocities.tolist()):
+            if found:
+                physcomp.set_true_pos(LPoint3d(*positions[row]))
+                physcomp.node.set_linear_velocity(Vec3(*velocities[row]))
+                row += 1
+            else:
+                log.warning("SOI of the orbit of " + str(physcomp.nodePath)
+                            + " is gone, leaving it at rest")
+                physcomp.node.set_linear_velocity(Vec3(0, 0, 0))
+            physcomp.node.set_angular_velocity(Vec3(*spin))
+            self.add_ship(physcomp)
+            physcomp.node.setActive(True)
+
+    def predict(self, component, duration):
+        """Returns the trajectory.Trajectory of a ship for the next duration
+        seconds, cached by the shared TrajectoryPredictor."""
+        position = np.array(tuple(component.get_true_pos()), dtype=np.float64)
+        if component.on_rails:
+            soi_index = self.soi_index.index_of[
+                self.rails.soi_ids[self.rails.components.index(component)]]
+            velocity = self.rails.get_velocity(component) + \
+                self.get_body_velocities([soi_index])[0]
+        else:
+            velocity = np.array(tuple(component.node.get_linear_velocity()),
+                                dtype=np.float64)
+        forward = tuple(component.nodePath.get_quat(
+            component.get_origin().root).get_forward())
+        return get_predictor().predict(component, duration, self.soi_index,
+                                       self.time, position, velocity, forward)
+
+    def interpolate(self, components, alpha):
+        """Places the render_node_path of every ship alpha of the way from
+        its previous to its current tick."""
+        origin = get_origin()
+        for physcomp in components:
+            if physcomp.render_node_path is None or \
+                    physcomp.current_pos is None:
+                continue
+            true_pos, quat = physcomp.get_interpolated_transform(alpha)
+            origin.set_true_pos(physcomp.render_node_path, true_pos)
+            physcomp.render_node_path.set_quat(origin.root, quat)
+
+    def step_zones(self, dt):
+        """Steps every zone, in parallel if there is an executor. Zones only
+        touch their own world so results are the same as stepping them in
+        order, and errors are raised in zone order."""
+        if self.executor is None or len(self.zones) < 2:
+            for zone in self.zones:
+                zone.step(dt)
+            return
+        futures = [self.executor.submit(zone.step, dt) for zone in self.zones]
+        for future in futures:
+            future.result()
+
     def setThrottle(self, shipid, data):
         if abs(data.normal) > 100 or abs(data.heading) > 100:
             print("Invalid")
@@ -117,3 +528,38 @@ class PhysicsSystem(sandbox.EntitySystem):
         #shipPhysics.currentTorque = shipThrust.heading / (100.0 * 4) * data.heading
         #print "SetPhysics", shipPhysics.nodePath.getHpr(), shipPhysics.currentTorque, shipPhysics.node.getAngularVelocity()
         #print shipPhysics.nodePath.getPos(), shipPhysics.node.getLinearVelocity()
+
+
+class FloatingPhysicsSystem(PhysicsSystem):
+    """Floating bullet worlds. Inspired by KSP and CCP physics system.
+
+    Each ship is centered in its own bullet world, see physics_zones, with a
+    FloatingOrigin holding the true position of the world origin. Ship true
+    pos is the world origin true pos + relative position in world.
+
+    If the ship gets further than REBASE_DISTANCE (25km) from the world origin
+    the world is rebased around its ships. Bullet worlds do not hpr, only pos.
+
+    If a ship comes within MERGE_DISTANCE of a ship in another world both go
+    into one world, centered on the average of its ships. A ship further than
+    SPLIT_DISTANCE from every other ship of its world is split off into a
+    new world. Moving a ship keeps its true position and velocities."""
+    def add_ship(self, component):
+        zone = physics_zones.Zone(component.get_true_pos())
+        zone.add(component)
+        self.zones.append(zone)
+
+    def step(self, dt):
+        """Steps one tick and partitions the worlds after it, so ships that
+        close in on each other during the ticks of one frame share a world
+        from the next tick on."""
+        PhysicsSystem.step(self, dt)
+        self.update_zones()
+
+    def update_zones(self):
+        """Merges, splits and recenters the worlds after a tick."""
+        components = [component for component in sandbox.get_components(
+            phys_comps.BulletPhysicsComponent) if component.zone is not None]
+        self.zones = physics_zones.partition(self.zones, components)
+        for zone in self.zones:
+            zone.recenter()
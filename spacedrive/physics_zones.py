@@ -0,0 +1,165 @@
+"""Floating Bullet worlds for FloatingPhysicsSystem.
+
+Every ship, or cluster of nearby ships, lives in its own Bullet world with
+its own FloatingOrigin so simulation always happens close to a float
+origin. Zones are re-clustered every tick: ships that come close share a
+zone, ships that drift apart get their own."""
+
+import numpy as np
+from panda3d.bullet import BulletWorld
+from panda3d.core import LPoint3d
+
+from .floating_origin import FloatingOrigin
+
+from direct.directnotify.DirectNotify import DirectNotify
+
+log = DirectNotify().newCategory("SpaceDrive-PhysicsZones")
+
+'''notes:
+76543.21 for a float cm precision
+100,000 positive, and negative, so world size is 200,000 meters, or 200km'''
+# Side of the world around a single ship, in meters
+ZONE_SIZE = 100000.0
+# Ships in different zones closer than this share a zone
+MERGE_DISTANCE = ZONE_SIZE
+# Ships of one zone further apart than this, from every other ship of the
+# zone, get split off. Larger than MERGE_DISTANCE so zones do not flicker.
+SPLIT_DISTANCE = 1.5 * ZONE_SIZE
+# A zone is recentered on its ships when they drift this far from its origin
+REBASE_DISTANCE = 25000.0
+
+_NEIGHBOR_CELLS = [(x, y, z) for x in (-1, 0, 1) for y in (-1, 0, 1)
+                   for z in (-1, 0, 1)]
+
+
+class Zone(object):
+    """A Bullet world and the FloatingOrigin of the ships in it."""
+    def __init__(self, origin, threshold=REBASE_DISTANCE):
+        self.world = BulletWorld()
+        self.origin = FloatingOrigin(origin, threshold, name='zone')
+        self.components = []
+
+    def __len__(self):
+        return len(self.components)
+
+    def add(self, component):
+        """Moves a BulletPhysicsComponent into this zone keeping its true
+        position. The rigid body keeps its velocities."""
+        true_pos = component.get_true_pos()
+        if component.zone is not None:
+            component.zone.remove(component)
+        self.origin.attach(component.nodePath)
+        component.origin = self.origin
+        component.zone = self
+        component.set_true_pos(true_pos)
+        self.world.attach(component.node)
+        self.components.append(component)
+
+    def remove(self, component):
+        """Takes a component out of the zone, leaving its NodePath where it
+        is."""
+        self.world.remove(component.node)
+        self.components.remove(component)
+        component.zone = None
+
+    def center(self):
+        """Returns the average true position of the ships in the zone."""
+        center = LPoint3d(0, 0, 0)
+        for component in self.components:
+            center += component.get_true_pos()
+        return center * (1.0 / len(self.components))
+
+    def recenter(self):
+        """Rebases the zone around its ships once they drift away from the
+        origin."""
+        if self.components:
+            self.origin.update(self.center())
+
+    def step(self, dt):
+        """Steps the world by exactly one internal step of dt seconds."""
+        self.world.do_physics(dt, 1, dt)
+
+
+def cluster_positions(positions, groups, merge_distance=MERGE_DISTANCE,
+                      split_distance=SPLIT_DISTANCE):
+    """Single linkage clustering of an (n, 3) array of positions. Points
+    closer than merge_distance are linked, points of the same group, such as
+    the current zone, stay linked up to split_distance. Returns a cluster
+    label per point.
+
+    Points are bucketed in a grid of split_distance cells so only
+    neighboring cells are compared."""
+    count = len(positions)
+    labels = list(range(count))
+
+    def find(index):
+        while labels[index] != index:
+            labels[index] = labels[labels[index]]
+            index = labels[index]
+        return index
+
+    cells = {}
+    keys = np.floor(positions / split_distance).astype(np.int64).tolist()
+    for index, key in enumerate(keys):
+        cells.setdefault(tuple(key), []).append(index)
+    groups = np.asarray(groups)
+    for (x, y, z), members in cells.items():
+        members = np.array(members)
+        for dx, dy, dz in _NEIGHBOR_CELLS:
+            others = cells.get((x + dx, y + dy, z + dz))
+            if others is None:
+                continue
+            others = np.array(others)
+            distances = np.linalg.norm(positions[members][:, None, :]
+                                       - positions[others][None, :, :],
+                                       axis=2)
+            same_group = groups[members][:, None] == groups[others][None, :]
+            linked = (distances < merge_distance) | \
+                (same_group & (distances < split_distance))
+            for first, second in zip(*np.nonzero(linked)):
+                first = find(members[first])
+                second = find(others[second])
+                if first != second:
+                    labels[max(first, second)] = min(first, second)
+    return [find(index) for index in range(count)]
+
+
+def partition(zones, components, zone_factory=Zone):
+    """Regroups components into zones by cluster_positions. Existing zones
+    are reused for the cluster holding most of their ships, new zones are
+    made with zone_factory for the rest. Ships that are no longer in
+    components are taken out of their zone. Returns the new list of zones."""
+    current = set(id(component) for component in components)
+    for zone in zones:
+        for component in list(zone.components):
+            if id(component) not in current:
+                zone.remove(component)
+    if not components:
+        return []
+    positions = np.array([tuple(component.get_true_pos())
+                          for component in components], dtype=np.float64)
+    groups = [id(component.zone) for component in components]
+    labels = cluster_positions(positions, groups)
+    clusters = {}
+    for component, label in zip(components, labels):
+        clusters.setdefault(label, []).append(component)
+    claimed = set()
+    result = []
+    # Biggest clusters pick their zone first so merges keep the busiest world
+    for members in sorted(clusters.values(), key=len, reverse=True):
+        counts = {}
+        for component in members:
+            if component.zone is not None and id(component.zone) not in claimed:
+                counts[component.zone] = counts.get(component.zone, 0) + 1
+        if counts:
+            zone = max(counts, key=counts.get)
+        else:
+            center = members[0].get_true_pos()
+            zone = zone_factory(center)
+            log.debug("New zone at " + str(center))
+        claimed.add(id(zone))
+        for component in members:
+            if component.zone is not zone:
+                zone.add(component)
+        result.append(zone)
+    return result
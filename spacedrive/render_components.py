@@ -2,10 +2,17 @@ from panda3d.core import PerlinNoise2
 
 
 class CelestialRenderComponent(object):
+    """Bodies other than stars start with only a point sized impostor. The
+    GraphicsSystem creates the full mesh and textures once the body is close
+    enough to be seen and releases them again when no longer needed."""
     body = None
     atmosphere = None
     light = None
     noise = PerlinNoise2(64, 64)
     noise_texture = None
     mesh = None
+    impostor = None
+    textures = None
+    # Seconds the mesh has been off screen and far away
+    idle_time = 0
     temperature = 0
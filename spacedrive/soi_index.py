@@ -0,0 +1,143 @@
+"""Sphere of influence hierarchy for patched conic physics.
+
+Bodies are stored in body tree order with their sphere of influence radius
+so a ship only has to be checked against the SOI it was in last tick and
+the children of it, instead of against every celestial body."""
+
+import numpy as np
+
+from .celestial_components import CelestialComponent
+from . import orbit_system
+
+
+class SOIIndex(object):
+    """Hierarchy of the celestial bodies that can capture ships.
+
+    Top level bodies of the tree have an infinite SOI. Bodies without a SOI,
+    such as barycenters, are left out and their children attached to the
+    closest ancestor that has one. Call update() once per tick after the
+    bodies moved, then find() or find_all()."""
+    def __init__(self, entities):
+        components = [entity.get_component(CelestialComponent)
+                      for entity in entities]
+        entity_ids = dict((id(component), entity.id)
+                          for entity, component in zip(entities, components))
+        ordered, parents, _ = orbit_system.build_body_tree(components)
+        parents = parents.tolist()
+        # Keep bodies that capture ships and map every body to the closest
+        # capturing ancestor, parents always come first in ordered
+        capturing = {}
+        self.components = []
+        self.ids = []
+        parent_indexes = []
+        radii = []
+        masses = []
+        for position, component in enumerate(ordered):
+            parent = parents[position]
+            ancestor = -1
+            while parent >= 0:
+                if parent in capturing:
+                    ancestor = capturing[parent]
+                    break
+                parent = parents[parent]
+            if ancestor >= 0 and component.soi <= 0:
+                continue
+            capturing[position] = len(self.components)
+            self.components.append(component)
+            self.ids.append(entity_ids[id(component)])
+            parent_indexes.append(ancestor)
+            radii.append(component.soi if ancestor >= 0 else np.inf)
+            masses.append(component.mass)
+        self.parents = np.array(parent_indexes, dtype=np.intp)
+        self.radii = np.array(radii, dtype=np.float64)
+        self.masses = np.array(masses, dtype=np.float64)
+        self.roots = np.flatnonzero(self.parents < 0)
+        self.children = [np.flatnonzero(self.parents == index)
+                         for index in range(len(self.components))]
+        self.index_of = dict((entity_id, index)
+                             for index, entity_id in enumerate(self.ids))
+        self.positions = np.zeros((len(self.components), 3), dtype=np.float64)
+        self._perturbers = {}
+        self.update()
+
+    def __len__(self):
+        return len(self.components)
+
+    def update(self):
+        """Copies the current true_pos of every body."""
+        for index, component in enumerate(self.components):
+            true_pos = component.true_pos
+            self.positions[index] = (true_pos.get_x(), true_pos.get_y(),
+                                     true_pos.get_z())
+
+    def perturbers(self, index):
+        """Returns the indexes of the bodies pulling on a ship in the SOI of
+        index: the body, its ancestors and the bodies orbiting it."""
+        bodies = self._perturbers.get(index)
+        if bodies is None:
+            bodies = [index]
+            parent = self.parents[index]
+            while parent >= 0:
+                bodies.append(int(parent))
+                parent = self.parents[parent]
+            bodies.extend(self.children[index].tolist())
+            self._perturbers[index] = bodies
+        return bodies
+
+    def closest_root(self, positions):
+        """Returns the closest top level body to each of an (m, 3) array of
+        positions."""
+        distances = np.linalg.norm(
+            positions[:, None, :] - self.positions[self.roots][None, :, :],
+            axis=2)
+        return self.roots[np.argmin(distances, axis=1)]
+
+    def find(self, position, entity_id=None):
+        """Returns the entity id of the body whose SOI contains position.
+        entity_id is the previous SOI, from where the search starts."""
+        return self.find_all([position], [entity_id])[0]
+
+    def find_all(self, positions, entity_ids=None):
+        """Batch find(). positions is a sequence of m points and entity_ids
+        the previous SOI of each or None. Returns a list of m entity ids."""
+        positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+        if not len(self) or not len(positions):
+            return [None] * len(positions)
+        if entity_ids is None:
+            entity_ids = [None] * len(positions)
+        current = np.array([self.index_of.get(entity_id, -1)
+                            for entity_id in entity_ids], dtype=np.intp)
+        unknown = current < 0
+        if unknown.any():
+            current[unknown] = self.closest_root(positions[unknown])
+        # Climb out of every SOI the ship left
+        while True:
+            distances = np.linalg.norm(positions - self.positions[current],
+                                       axis=1)
+            outside = (distances > self.radii[current]) & \
+                (self.parents[current] >= 0)
+            if not outside.any():
+                break
+            current[outside] = self.parents[current[outside]]
+        if len(self.roots) > 1:
+            top = self.parents[current] < 0
+            current[top] = self.closest_root(positions[top])
+        # Descend into the closest child SOI, grouped by body
+        pending = np.ones(len(positions), dtype=bool)
+        while pending.any():
+            for index in np.unique(current[pending]):
+                ships = np.flatnonzero(pending & (current == index))
+                children = self.children[index]
+                if not len(children):
+                    pending[ships] = False
+                    continue
+                distances = np.linalg.norm(
+                    positions[ships][:, None, :]
+                    - self.positions[children][None, :, :], axis=2)
+                distances[distances >= self.radii[children]] = np.inf
+                closest = np.argmin(distances, axis=1)
+                inside = np.isfinite(distances[np.arange(len(ships)),
+                                               closest])
+                current[ships[inside]] = children[closest[inside]]
+                pending[ships[~inside]] = False
+        return [self.ids[index] for index in current.tolist()]
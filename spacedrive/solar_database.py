@@ -0,0 +1,312 @@
+"""Precompiled binary solar system databases.
+
+Parsing a large solar system yaml dominates startup, so the yaml is compiled
+once into a single binary file: a json header with the strings of every body
+followed by aligned arrays of orbital elements, hierarchy and physical
+constants. Loading reads the file in one call, views the arrays in place and
+creates every entity in one pass. The header remembers the size and
+modification time of the yaml, a stale database is ignored and the yaml is
+used instead.
+
+Bodies are stored in the order generate_node would create them, parents
+before children."""
+
+import json
+import os
+import struct
+
+import numpy as np
+import yaml
+
+import sandbox
+
+from . import celestial_components as cel_comp
+from . import orbit_system
+from . import universals
+from .utils.expression import compile_expression, linear_expression
+
+from direct.directnotify.DirectNotify import DirectNotify
+
+log = DirectNotify().newCategory("SpaceDrive-SolarDatabase")
+
+MAGIC = b'SDSOLDB\x00'
+VERSION = 1
+EXTENSION = '.sdb'
+ALIGNMENT = 64
+_HEADER_SIZE = struct.Struct('<Q')
+
+# Float columns of the body table and the yaml key they come from
+FLOAT_COLUMNS = (
+    ('period', 'period'),
+    ('mass', 'mass'),
+    ('radius', 'radius'),
+    ('rotation', 'rotation'),
+    ('absolute_magnitude', 'absolute magnitude'),
+    ('temperature', 'temperature'),
+)
+
+
+def get_database_filename(filename):
+    """Returns the default database path for a yaml file."""
+    return os.path.splitext(filename)[0] + EXTENSION
+
+
+def load(filename, database_filename=None, write=True):
+    """Creates the solar systems of a yaml file, from its database when it is
+    up to date. Otherwise the yaml is loaded and, if write is True, compiled
+    for the next start."""
+    if database_filename is None:
+        database_filename = get_database_filename(filename)
+    if is_current(database_filename, filename):
+        log.info("Loading solar system database " + database_filename)
+        return create_from_database(database_filename)
+    log.info("Solar system database missing or stale, loading " + filename)
+    with open(filename) as f:
+        solardb = yaml.safe_load(f.read())
+    if not solardb:
+        log.warning("No yaml file with that name")
+        return
+    for system_name, db in solardb.items():
+        orbit_system.create_solar_system(name=system_name, database=db)
+    if write:
+        try:
+            write_database(database_filename,
+                           *compile_systems(solardb, filename))
+        except (OSError, ValueError) as error:
+            log.warning("Could not write " + database_filename + ": "
+                        + str(error))
+
+
+def compile_database(filename, database_filename=None):
+    """Compiles a solar system yaml file into a database."""
+    if database_filename is None:
+        database_filename = get_database_filename(filename)
+    with open(filename) as f:
+        solardb = yaml.safe_load(f.read())
+    write_database(database_filename, *compile_systems(solardb, filename))
+    return database_filename
+
+
+def source_stamp(filename):
+    stat = os.stat(filename)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def is_current(database_filename, filename):
+    """Returns True if the database exists, is complete and was compiled
+    from the current version of filename."""
+    try:
+        header, data_start = read_header(database_filename)
+        if (header['version'] != VERSION
+                or header['source'] != source_stamp(filename)):
+            return False
+        end = data_start
+        for entry in header['arrays'].values():
+            end = max(end, data_start + entry['offset']
+                      + int(np.prod(entry['shape']))
+                      * np.dtype(entry['dtype']).itemsize)
+        return os.path.getsize(database_filename) >= end
+    except (OSError, ValueError, KeyError, TypeError, struct.error):
+        return False
+
+
+def compile_systems(solardb, filename=None):
+    """Flattens the parsed yaml of create_from_yaml_file into a header and a
+    dict of arrays for write_database."""
+    header = {'version': VERSION, 'systems': [], 'names': [], 'kinds': [],
+              'spectral': [], 'orbits': [], 'render': []}
+    if filename is not None:
+        header['source'] = source_stamp(filename)
+    system = []
+    parents = []
+    floats = dict((column, []) for column, _ in FLOAT_COLUMNS)
+    soi = []
+    base = []
+    rate = []
+
+    def add_body(name, database, system_index, parent_index, parent_mass):
+        index = len(header['names'])
+        header['names'].append(name)
+        header['kinds'].append(database['type'])
+        header['spectral'].append(database.get('spectral', ''))
+        render = dict((key, database[key]) for key in
+                      ('type', 'temperature', 'textures', 'atmosphere')
+                      if key in database)
+        header['render'].append(render)
+        system.append(system_index)
+        parents.append(parent_index)
+        for column, key in FLOAT_COLUMNS:
+            floats[column].append(float(database.get(key, 0)))
+        orbit = database.get('orbit')
+        element_base = [np.nan] * len(orbit_system.ORBIT_ELEMENTS)
+        element_rate = [np.nan] * len(orbit_system.ORBIT_ELEMENTS)
+        if orbit:
+            header['orbits'].append(dict((key, orbit[key]) for key in
+                                         orbit_system.ORBIT_ELEMENTS))
+            elements = orbit_system.compile_orbit(orbit)
+            for row, key in enumerate(orbit_system.ORBIT_ELEMENTS):
+                if elements[key].linear is not None:
+                    element_base[row], element_rate[row] = elements[key].linear
+        else:
+            header['orbits'].append(None)
+        base.append(element_base)
+        rate.append(element_rate)
+        mass = float(database.get('mass', 0))
+        # Same as generate_node, barycenters have no SOI
+        if (database['type'] != 'barycenter' and parent_index >= 0
+                and parent_mass > 0 and orbit):
+            soi.append(orbit_system.calculate_soi(elements['a'](0), mass,
+                                                  parent_mass))
+        else:
+            soi.append(0.0)
+        for body_name, body_database in database.get('bodies', {}).items():
+            add_body(body_name, body_database, system_index, index, mass)
+
+    for system_name, db in solardb.items():
+        system_index = len(header['systems'])
+        header['systems'].append(system_name)
+        for body_name, body_database in db[system_name].items():
+            add_body(body_name, body_database, system_index, -1, 0.0)
+
+    arrays = {
+        'system': np.array(system, dtype=np.int32),
+        'parent': np.array(parents, dtype=np.int32),
+        'soi': np.array(soi, dtype=np.float64),
+        'base': np.array(base, dtype=np.float64).reshape(
+            -1, len(orbit_system.ORBIT_ELEMENTS)),
+        'rate': np.array(rate, dtype=np.float64).reshape(
+            -1, len(orbit_system.ORBIT_ELEMENTS)),
+    }
+    for column, values in floats.items():
+        arrays[column] = np.array(values, dtype=np.float64)
+    return header, arrays
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def write_database(database_filename, header, arrays):
+    """Writes header and arrays to database_filename, replacing it
+    atomically."""
+    header = dict(header)
+    entries = {}
+    offset = 0
+    for name, array in arrays.items():
+        offset = _align(offset)
+        entries[name] = {'dtype': array.dtype.str, 'shape': list(array.shape),
+                         'offset': offset}
+        offset += array.nbytes
+    header['arrays'] = entries
+    header_bytes = json.dumps(header).encode('utf-8')
+    data_start = _align(len(MAGIC) + _HEADER_SIZE.size + len(header_bytes))
+    temporary = database_filename + '.tmp'
+    with open(temporary, 'wb') as f:
+        f.write(MAGIC)
+        f.write(_HEADER_SIZE.pack(len(header_bytes)))
+        f.write(header_bytes)
+        for name, array in arrays.items():
+            f.write(b'\0' * (data_start + entries[name]['offset'] - f.tell()))
+            f.write(np.ascontiguousarray(array).tobytes())
+    os.replace(temporary, database_filename)
+
+
+def read_header(database_filename):
+    """Returns (header, offset of the array data)."""
+    with open(database_filename, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(database_filename + " is not a solar database")
+        size, = _HEADER_SIZE.unpack(f.read(_HEADER_SIZE.size))
+        header = json.loads(f.read(size).decode('utf-8'))
+    return header, _align(len(MAGIC) + _HEADER_SIZE.size + size)
+
+
+def read_database(database_filename):
+    """Returns (header, arrays) with the arrays as read only views of one
+    buffer of the whole file. Every column is turned into component
+    attributes, so the file is read at once rather than memory mapped."""
+    header, data_start = read_header(database_filename)
+    with open(database_filename, 'rb') as f:
+        data = f.read()
+    arrays = {}
+    for name, entry in header['arrays'].items():
+        dtype = np.dtype(entry['dtype'])
+        count = int(np.prod(entry['shape']))
+        arrays[name] = np.frombuffer(
+            data, dtype=dtype, count=count,
+            offset=data_start + entry['offset']).reshape(entry['shape'])
+    return header, arrays
+
+
+def create_from_database(database_filename):
+    """Creates every solar system and body of a database. Positions are solved
+    for all bodies at once at the end. Returns the CelestialComponents."""
+    header, arrays = read_database(database_filename)
+    system_entities = []
+    system_components = []
+    for name in header['systems']:
+        log.info("Generating solarsystem: " + name)
+        entity = sandbox.create_entity()
+        component = cel_comp.SolarSystemComponent(name)
+        entity.add_component(component)
+        system_entities.append(entity)
+        system_components.append(component)
+
+    columns = dict((column, arrays[column].tolist())
+                   for column, _ in FLOAT_COLUMNS)
+    systems = arrays['system'].tolist()
+    parents = arrays['parent'].tolist()
+    soi = arrays['soi'].tolist()
+    base = arrays['base'].tolist()
+    rate = arrays['rate'].tolist()
+    entities = []
+    components = []
+    for index, name in enumerate(header['names']):
+        kind = header['kinds'][index]
+        parent = parents[index]
+        if parent < 0:
+            parent_entity = system_entities[systems[index]]
+            parent_node = system_components[systems[index]].root_node
+        else:
+            parent_entity = entities[parent]
+            parent_node = components[parent].node_path
+        body_entity = sandbox.create_entity()
+        celestial_component = cel_comp.CelestialComponent(name, parent_entity,
+                                                          kind=kind)
+        body_components = [celestial_component]
+        if kind == 'star':
+            body_components.append(cel_comp.StarComponent(
+                columns['absolute_magnitude'][index],
+                header['spectral'][index],
+                temperature=columns['temperature'][index]))
+        orbit = header['orbits'][index]
+        if orbit:
+            celestial_component.orbit = orbit
+            elements = {}
+            for row, key in enumerate(orbit_system.ORBIT_ELEMENTS):
+                if base[index][row] != base[index][row]:
+                    # NaN marks formulas that are not linear
+                    elements[key] = compile_expression(orbit[key])
+                else:
+                    elements[key] = linear_expression(
+                        base[index][row], rate[index][row], str(orbit[key]))
+            celestial_component.orbit_elements = elements
+            celestial_component.period = columns['period'][index]
+        if kind != 'barycenter':
+            celestial_component.mass = columns['mass'][index]
+            celestial_component.radius = columns['radius'][index]
+            celestial_component.rotation = columns['rotation'][index]
+            celestial_component.soi = soi[index]
+        celestial_component.node_path.reparent_to(parent_node)
+        celestial_component.node_path.set_python_tag('entity', body_entity)
+        if universals.run_client:
+            body_components.append(orbit_system.create_render_component(
+                name, header['render'][index]))
+        for component in body_components:
+            body_entity.add_component(component)
+        entities.append(body_entity)
+        components.append(celestial_component)
+
+    orbit_system.OrbitBatch([component for component in components
+                             if component.orbit]).update(universals.day)
+    return components
@@ -11,7 +11,7 @@ from panda3d.core import Geom, GeomNode, GeomTriangles, GeomVertexArrayFormat
 from panda3d.core import GeomVertexData, GeomVertexFormat, GeomVertexWriter
 from panda3d.core import CardMaker, InternalName
 from panda3d.core import Material, NodePath, PerlinNoise3, PNMImage, Point3
-from panda3d.core import Shader, Texture, TextureStage
+from panda3d.core import Shader, Texture, TexturePool, TextureStage
 from panda3d.core import VBase4, Vec3
 
 import sandbox
@@ -1026,6 +1026,13 @@ class Body:
     def set_shader_input(self, *args, **kwargs):
         self.node_path.set_shader_input(*args, **kwargs)
 
+    def release(self):
+        """Removes the body from the scene and drops its textures from the
+        texture pool so their memory can be freed."""
+        for texture in self.node_path.find_all_textures():
+            TexturePool.release_texture(texture)
+        self.node_path.remove_node()
+
 
 class BitmapSurface(Body):
     """Planet is a parent nodepath that the 6 side mesh nodepaths will parent
@@ -1259,5 +1266,18 @@ def make_star(name='star', scale=1, color=Vec3(1), texture_size=64, debug=False)
     return final_node_path
 
 
+def make_impostor(name='impostor', color=Vec3(1)):
+    """Returns a camera facing card used in place of a body that is too far
+    away to need its mesh."""
+    card_maker = CardMaker(name)
+    card_maker.set_frame(-1, 1, -1, 1)
+    node_path = NodePath(card_maker.generate())
+    node_path.set_billboard_point_eye()
+    material = Material()
+    material.set_emission(VBase4(color, 1.0))
+    node_path.set_material(material)
+    return node_path
+
+
 def make_planet(name='planet', scale=1, debug=False):
     return BitmapSurface(name, scale, debug)
@@ -0,0 +1,300 @@
+"""Trajectory prediction of ships.
+
+The state of a ship is integrated forward under the gravity of its SOI body
+and its current thrust with an adaptive Dormand-Prince 5(4) Runge-Kutta
+integrator. Body positions come from the ephemeris so moving bodies and SOI
+transitions along the way are predicted too. The ship is assumed to keep its
+current heading. Results are cached until the inputs of the ship change or it
+leaves the predicted path."""
+
+from collections import OrderedDict
+
+import numpy as np
+
+from . import universals
+from .ephemeris import get_ephemeris
+
+from direct.directnotify.DirectNotify import DirectNotify
+
+log = DirectNotify().newCategory("SpaceDrive-Trajectory")
+
+# Allowed error of a step relative to the distance and relative speed to
+# the SOI body
+RELATIVE_TOLERANCE = 1e-9
+# Allowed error of a step in meters and meters per second, for ships very
+# close to or at rest relative to the body
+ABSOLUTE_TOLERANCE = 1e-3
+MIN_STEP = 1e-3
+MAX_POINTS = 2048
+# A cached trajectory is recomputed once the ship is further than this many
+# meters from it
+MAX_DEVIATION = 100.0
+# Seconds to which SOI transitions are located
+TRANSITION_PRECISION = 0.01
+DEFAULT_CACHE_SIZE = 256
+# Decimals of the unit heading a cached trajectory is kept for, about a
+# milliradian of turn
+HEADING_DECIMALS = 3
+
+_predictor = None
+
+# Dormand-Prince 5(4) tableau
+_C = (0.0, 1.0 / 5, 3.0 / 10, 4.0 / 5, 8.0 / 9, 1.0, 1.0)
+_A = (
+    (),
+    (1.0 / 5,),
+    (3.0 / 40, 9.0 / 40),
+    (44.0 / 45, -56.0 / 15, 32.0 / 9),
+    (19372.0 / 6561, -25360.0 / 2187, 64448.0 / 6561, -212.0 / 729),
+    (9017.0 / 3168, -355.0 / 33, 46732.0 / 5247, 49.0 / 176,
+     -5103.0 / 18656),
+    (35.0 / 384, 0.0, 500.0 / 1113, 125.0 / 192, -2187.0 / 6784,
+     11.0 / 84),
+)
+# Difference of the fifth and fourth order weights
+_E = np.array((71.0 / 57600, 0.0, -71.0 / 16695, 71.0 / 1920,
+               -17253.0 / 339200, 22.0 / 525, -1.0 / 40))
+
+
+def get_predictor():
+    """Returns the shared TrajectoryPredictor."""
+    global _predictor
+    if _predictor is None:
+        _predictor = TrajectoryPredictor()
+    return _predictor
+
+
+def hermite(t0, y0, t1, y1, t):
+    """Cubic Hermite interpolation of the (6,) state, or (n, 6) states,
+    between two steps."""
+    h = t1 - t0
+    s = (t - t0) / h
+    s2 = s * s
+    s3 = s2 * s
+    p0, v0 = y0[..., :3], y0[..., 3:]
+    p1, v1 = y1[..., :3], y1[..., 3:]
+    position = ((2 * s3 - 3 * s2 + 1) * p0 + (s3 - 2 * s2 + s) * h * v0
+                + (-2 * s3 + 3 * s2) * p1 + (s3 - s2) * h * v1)
+    velocity = ((6 * s2 - 6 * s) / h * p0 + (3 * s2 - 4 * s + 1) * v0
+                + (-6 * s2 + 6 * s) / h * p1 + (3 * s2 - 2 * s) * v1)
+    return np.concatenate((position, velocity), axis=-1)
+
+
+class Trajectory(object):
+    """Predicted path of a ship.
+
+    times are seconds since start and positions and velocities (k, 3)
+    arrays of true positions and velocities at them. soi_ids is the entity
+    id of the SOI at every point and transitions a list of (time, from id, to
+    id). impact is the time the ship hits its SOI body or None. horizon is
+    the time the prediction was asked up to, the path ends before it after
+    an impact or MAX_POINTS."""
+    def __init__(self, start, times, positions, velocities, soi_ids,
+                 transitions, impact=None, horizon=None):
+        self.start = start
+        self.horizon = horizon
+        self.times = times
+        self.positions = positions
+        self.velocities = velocities
+        self.soi_ids = soi_ids
+        self.transitions = transitions
+        self.impact = impact
+        self.inputs = None
+
+    def __len__(self):
+        return len(self.times)
+
+    @property
+    def end(self):
+        return self.start + self.times[-1]
+
+    def state_at(self, time):
+        """Returns the (6,) interpolated position and velocity at time."""
+        t = min(max(time - self.start, 0.0), self.times[-1])
+        index = min(max(int(np.searchsorted(self.times, t)) - 1, 0),
+                    len(self.times) - 2)
+        if index < 0:
+            return np.concatenate((self.positions[0], self.velocities[0]))
+        return hermite(
+            self.times[index], np.concatenate((self.positions[index],
+                                               self.velocities[index])),
+            self.times[index + 1], np.concatenate(
+                (self.positions[index + 1], self.velocities[index + 1])), t)
+
+    def position_at(self, time):
+        return self.state_at(time)[:3]
+
+
+class TrajectoryPredictor(object):
+    """Integrates ship trajectories and caches them per ship.
+
+    Bodies and their SOI come from a soi_index.SOIIndex. Only the gravity of
+    the SOI body at each point is used, as in PhysicsSystem."""
+    def __init__(self, tolerance=RELATIVE_TOLERANCE, max_points=MAX_POINTS,
+                 cache_size=DEFAULT_CACHE_SIZE):
+        self.tolerance = tolerance
+        self.max_points = max_points
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+    def clear(self, component=None):
+        """Drops every cached trajectory, or only the one of component."""
+        if component is None:
+            self.cache.clear()
+        else:
+            self.cache.pop(component, None)
+
+    def predict(self, component, duration, soi_index, time, position,
+                velocity, forward, day=None):
+        """Returns the Trajectory of a BulletPhysicsComponent from time, in
+        physics seconds, for duration seconds. position and velocity are the
+        true state now and forward the unit heading.
+
+        A cached trajectory is reused while the thrust, torque and mass of the
+        ship, and its heading while thrusting, are unchanged, it covers the
+        requested time and the ship is within MAX_DEVIATION of it."""
+        heading = None
+        if component.currentThrust:
+            heading = tuple(np.round(np.asarray(forward, dtype=np.float64),
+                                     HEADING_DECIMALS).tolist())
+        inputs = (component.currentThrust, component.currentTorque,
+                  component.node.getMass(), heading)
+        trajectory = self.cache.get(component)
+        if (trajectory is not None and trajectory.inputs == inputs
+                and trajectory.start <= time
+                and trajectory.horizon >= time + duration
+                and np.linalg.norm(trajectory.position_at(time)
+                                   - position) <= MAX_DEVIATION):
+            self.cache.move_to_end(component)
+            return trajectory
+        if day is None:
+            day = universals.day
+        thrust = np.asarray(forward, dtype=np.float64) * \
+            component.currentThrust / inputs[2]
+        trajectory = self.integrate(
+            soi_index, soi_index.index_of[component.currentSOI],
+            np.concatenate((position, velocity)), thrust, time, day,
+            duration)
+        trajectory.inputs = inputs
+        self.cache[component] = trajectory
+        self.cache.move_to_end(component)
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return trajectory
+
+    def integrate(self, soi_index, soi, state, thrust, start, day, duration):
+        """Integrates the (6,) state for duration seconds starting in the
+        SOIIndex body soi on the given day. thrust is a constant (3,)
+        acceleration. Returns a Trajectory."""
+        ephemeris = get_ephemeris()
+        bodies = {}
+
+        def body_position(index, t):
+            component = soi_index.components[index]
+            key = (index, t)
+            position = bodies.get(key)
+            if position is None:
+                position = np.array(tuple(ephemeris.heliocentric_position(
+                    component, day + t / universals.SECONDSINDAY)))
+                bodies[key] = position
+            return position
+
+        def derivative(t, y, soi):
+            offset = y[:3] - body_position(soi, t)
+            r = np.sqrt(offset.dot(offset))
+            gravity = -universals.G * soi_index.masses[soi] / r ** 3 * offset
+            return np.concatenate((y[3:], gravity + thrust))
+
+        def distance(index, t, y):
+            offset = y[:3] - body_position(index, t)
+            return np.sqrt(offset.dot(offset))
+
+        def next_soi(t, y, soi):
+            """Returns the SOI at t if it is another than soi, else None."""
+            parent = soi_index.parents[soi]
+            if parent >= 0 and distance(soi, t, y) > soi_index.radii[soi]:
+                return parent
+            for child in soi_index.children[soi].tolist():
+                if distance(child, t, y) < soi_index.radii[child]:
+                    return child
+            return None
+
+        def error_scale(t, y, soi):
+            offset = y[:3] - body_position(soi, t)
+            return (ABSOLUTE_TOLERANCE
+                    + self.tolerance * np.sqrt(offset.dot(offset)),
+                    ABSOLUTE_TOLERANCE
+                    + self.tolerance * np.sqrt(y[3:].dot(y[3:])))
+
+        t = 0.0
+        y = np.asarray(state, dtype=np.float64)
+        times = [t]
+        states = [y]
+        soi_ids = [soi_index.ids[soi]]
+        transitions = []
+        impact = None
+        f = derivative(t, y, soi)
+        # First step from the time to cross a tenth of the distance to the
+        # body
+        h = 0.1 * distance(soi, t, y) / max(np.sqrt(f[:3].dot(f[:3])), 1.0)
+        h = min(max(h, MIN_STEP), duration)
+        while t < duration and len(times) < self.max_points:
+            h = min(h, duration - t)
+            stages = [f]
+            for row in range(1, 7):
+                y_stage = y + h * sum(a * k for a, k in
+                                      zip(_A[row], stages))
+                stages.append(derivative(t + _C[row] * h, y_stage, soi))
+            y_new = y_stage
+            f_new = stages[6]
+            error = h * np.tensordot(_E, np.array(stages), axes=1)
+            scale_position, scale_velocity = error_scale(t + h, y_new, soi)
+            norm = max(np.sqrt(error[:3].dot(error[:3])) / scale_position,
+                       np.sqrt(error[3:].dot(error[3:])) / scale_velocity)
+            if norm > 1.0 and h > MIN_STEP:
+                h = max(h * max(0.2, 0.9 * norm ** -0.2), MIN_STEP)
+                continue
+            t_new = t + h
+            target = next_soi(t_new, y_new, soi)
+            hit = distance(soi, t_new, y_new) < \
+                soi_index.components[soi].radius
+            if target is not None or hit:
+                # Bisect the crossing on the interpolated path
+                low, high = t, t_new
+                while high - low > TRANSITION_PRECISION:
+                    middle = (low + high) / 2.0
+                    y_middle = hermite(t, y, t_new, y_new, middle)
+                    if hit:
+                        crossed = distance(soi, middle, y_middle) < \
+                            soi_index.components[soi].radius
+                    else:
+                        crossed = next_soi(middle, y_middle, soi) is not None
+                    if crossed:
+                        high = middle
+                    else:
+                        low = middle
+                t_new = high
+                y_new = hermite(t, y, t + h, y_new, high)
+                if hit:
+                    impact = float(start + t_new)
+                else:
+                    transitions.append((float(start + t_new),
+                                        soi_index.ids[soi],
+                                        soi_index.ids[target]))
+                    soi = target
+                f_new = derivative(t_new, y_new, soi)
+            t = t_new
+            y = y_new
+            f = f_new
+            times.append(t)
+            states.append(y)
+            soi_ids.append(soi_index.ids[soi])
+            if impact is not None:
+                break
+            h *= min(5.0, 0.9 * max(norm, 1e-10) ** -0.2)
+            # Body positions of rejected and old stages are not needed again
+            bodies.clear()
+        states = np.array(states)
+        return Trajectory(start, np.array(times), states[:, :3],
+                          states[:, 3:], soi_ids, transitions, impact,
+                          start + duration)
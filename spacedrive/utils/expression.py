@@ -0,0 +1,174 @@
+"""Restricted compiler for the small arithmetic formulas found in data files,
+such as the orbital elements of the solar system yaml. Only numbers, one
+variable, arithmetic operators and a handful of math functions are accepted,
+so loading a data file can never run arbitrary code."""
+
+import ast
+import math
+import operator
+
+__author__ = 'croxis'
+
+FUNCTIONS = dict((name, getattr(math, name)) for name in (
+    'sin', 'cos', 'tan', 'asin', 'acos', 'atan', 'atan2', 'sqrt', 'exp',
+    'log', 'log10', 'radians', 'degrees', 'fabs', 'floor', 'ceil'))
+CONSTANTS = {'pi': math.pi}
+
+BINARY_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.Mod: operator.mod,
+    ast.Pow: operator.pow,
+}
+UNARY_OPERATORS = {
+    ast.UAdd: operator.pos,
+    ast.USub: operator.neg,
+}
+
+
+class Expression(object):
+    """A compiled formula of one variable. Formulas of the form
+    base + rate * variable also keep their coefficients in linear so they can
+    be evaluated in bulk."""
+    def __init__(self, function, linear=None, source=''):
+        self.function = function
+        self.linear = linear
+        self.source = source
+
+    def __call__(self, value):
+        return self.function(value)
+
+    def __repr__(self):
+        return 'Expression(' + repr(self.source) + ')'
+
+
+def linear_expression(base, rate, source=''):
+    """Returns the Expression base + rate * variable without parsing, for
+    formulas that were compiled before."""
+    base = float(base)
+    rate = float(rate)
+    return Expression(lambda value: base + rate * value, (base, rate), source)
+
+
+def compile_expression(source, variable='d'):
+    """Compiles source into an Expression. source may be a number, an
+    expression of variable or a one argument lambda such as
+    'lambda d: 115.3654 + 13.0649929509 * d'. Raises ValueError for anything
+    outside of the allowed subset."""
+    if isinstance(source, bool):
+        raise ValueError("Not a formula: " + repr(source))
+    if isinstance(source, (int, float)):
+        value = float(source)
+        return Expression(lambda _: value, (value, 0.0), repr(source))
+    text = str(source).strip()
+    try:
+        tree = ast.parse(text, mode='eval').body
+    except SyntaxError as error:
+        raise ValueError("Invalid formula " + repr(text) + ": " + str(error))
+    if isinstance(tree, ast.Lambda):
+        arguments = tree.args
+        if (len(arguments.args) != 1 or arguments.vararg or arguments.kwarg
+                or arguments.kwonlyargs or arguments.defaults
+                or getattr(arguments, 'posonlyargs', None)):
+            raise ValueError("Formula lambdas take exactly one argument: "
+                             + repr(text))
+        variable = arguments.args[0].arg
+        tree = tree.body
+    _validate(tree, variable, text)
+    code = compile(ast.Expression(body=tree), '<formula>', 'eval')
+    namespace = {'__builtins__': {}}
+    namespace.update(FUNCTIONS)
+    namespace.update(CONSTANTS)
+
+    def function(value):
+        scope = {variable: value}
+        return eval(code, namespace, scope)
+    return Expression(function, _linear(tree, variable), text)
+
+
+def _validate(node, variable, text):
+    """Raises ValueError if node uses anything beyond plain arithmetic."""
+    if isinstance(node, ast.Constant):
+        if isinstance(node.value, bool) or not isinstance(node.value,
+                                                          (int, float)):
+            raise ValueError("Only numbers are allowed in " + repr(text))
+        # Float math so huge integer powers overflow instead of hanging
+        node.value = float(node.value)
+    elif isinstance(node, ast.Name):
+        if node.id != variable and node.id not in CONSTANTS:
+            raise ValueError("Unknown name " + repr(node.id) + " in "
+                             + repr(text))
+    elif isinstance(node, ast.BinOp):
+        if type(node.op) not in BINARY_OPERATORS:
+            raise ValueError("Operator not allowed in " + repr(text))
+        _validate(node.left, variable, text)
+        _validate(node.right, variable, text)
+    elif isinstance(node, ast.UnaryOp):
+        if type(node.op) not in UNARY_OPERATORS:
+            raise ValueError("Operator not allowed in " + repr(text))
+        _validate(node.operand, variable, text)
+    elif isinstance(node, ast.Call):
+        if (not isinstance(node.func, ast.Name)
+                or node.func.id not in FUNCTIONS or node.keywords):
+            raise ValueError("Function call not allowed in " + repr(text))
+        for argument in node.args:
+            _validate(argument, variable, text)
+    else:
+        raise ValueError(type(node).__name__ + " not allowed in "
+                         + repr(text))
+
+
+def _linear(node, variable):
+    """Returns (base, rate) if node reduces to base + rate * variable,
+    otherwise None."""
+    if isinstance(node, ast.Constant):
+        return float(node.value), 0.0
+    if isinstance(node, ast.Name):
+        if node.id == variable:
+            return 0.0, 1.0
+        return CONSTANTS[node.id], 0.0
+    if isinstance(node, ast.UnaryOp):
+        operand = _linear(node.operand, variable)
+        if operand is None:
+            return None
+        if isinstance(node.op, ast.USub):
+            return -operand[0], -operand[1]
+        return operand
+    if isinstance(node, ast.BinOp):
+        left = _linear(node.left, variable)
+        right = _linear(node.right, variable)
+        if left is None or right is None:
+            return None
+        if isinstance(node.op, ast.Add):
+            return left[0] + right[0], left[1] + right[1]
+        if isinstance(node.op, ast.Sub):
+            return left[0] - right[0], left[1] - right[1]
+        if isinstance(node.op, ast.Mult):
+            if left[1] == 0:
+                return left[0] * right[0], left[0] * right[1]
+            if right[1] == 0:
+                return left[0] * right[0], left[1] * right[0]
+            return None
+        if isinstance(node.op, ast.Div):
+            if right[1] == 0 and right[0] != 0:
+                return left[0] / right[0], left[1] / right[0]
+            return None
+        if left[1] == 0 and right[1] == 0:
+            try:
+                return BINARY_OPERATORS[type(node.op)](left[0], right[0]), 0.0
+            except (ArithmeticError, ValueError):
+                return None
+        return None
+    if isinstance(node, ast.Call):
+        arguments = [_linear(argument, variable) for argument in node.args]
+        if any(argument is None or argument[1] != 0
+               for argument in arguments):
+            return None
+        try:
+            return FUNCTIONS[node.func.id](
+                *[argument[0] for argument in arguments]), 0.0
+        except (ArithmeticError, ValueError, TypeError):
+            return None
+    return None
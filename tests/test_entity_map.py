@@ -0,0 +1,79 @@
+"""Tests of the server to client entity id map."""
+
+import numpy as np
+import pytest
+
+from spacedrive.networking import entity_map
+from spacedrive.networking.entity_map import NO_ENTITY
+
+
+def test_add_and_remove():
+    entities = entity_map.EntityMap()
+    entities.add(10, 3)
+    entities.add(11, 4)
+    assert len(entities) == 2
+    assert entities.get_client(10) == 3
+    assert entities.get_server(4) == 11
+    assert entities.remove_server(10) == 3
+    assert entities.remove_client(4) == 11
+    assert entities.remove_server(10) == NO_ENTITY
+    assert len(entities) == 0
+
+
+def test_generation_invalidates_handle_on_reuse():
+    entities = entity_map.EntityMap()
+    handle = entities.add(10, 3)
+    assert entities.is_valid(handle)
+    assert entities.get_handle(3) == handle
+    entities.remove_server(10)
+    assert not entities.is_valid(handle)
+    assert entities.get_handle(3) is None
+    # The client id is reused for another server entity
+    reused = entities.add(20, 3)
+    assert reused[0] == handle[0]
+    assert reused[1] != handle[1]
+    assert not entities.is_valid(handle)
+    assert entities.is_valid(reused)
+
+
+def test_remapping_replaces_both_sides():
+    entities = entity_map.EntityMap()
+    handle = entities.add(10, 3)
+    entities.add(10, 5)
+    assert entities.get_server(3) == NO_ENTITY
+    assert not entities.is_valid(handle)
+    entities.add(11, 5)
+    assert entities.get_client(10) == NO_ENTITY
+    assert len(entities) == 1
+
+
+def test_reserve_grows_arrays():
+    entities = entity_map.EntityMap(size=4)
+    handle = entities.add(2, 1)
+    entities.add(1000, 300)
+    assert len(entities.server_to_client) > 1000
+    assert len(entities.client_to_server) > 300
+    assert len(entities.generations) == len(entities.client_to_server)
+    # Earlier mappings and generations survive the growth
+    assert entities.get_client(2) == 1
+    assert entities.is_valid(handle)
+    assert entities.get_client(1000) == 300
+
+
+def test_to_client_of_unmapped_and_out_of_range_ids():
+    entities = entity_map.EntityMap(size=8)
+    entities.add(2, 7)
+    ids = np.array([2, 3, 8, 1 << 40, -1])
+    assert entities.to_client(ids).tolist() == [7] + [NO_ENTITY] * 4
+    assert entities.to_server([7, 0, 100, -5]).tolist() == \
+        [2] + [NO_ENTITY] * 3
+    assert entities.get_client(1 << 40) == NO_ENTITY
+    assert not entities.is_valid((1 << 40, 1))
+
+
+def test_negative_ids_are_rejected():
+    entities = entity_map.EntityMap()
+    with pytest.raises(ValueError):
+        entities.add(-1, 3)
+    with pytest.raises(ValueError):
+        entities.add(3, -1)
@@ -0,0 +1,136 @@
+"""Tests of the restricted formula compiler used for yaml orbits."""
+
+import math
+
+import pytest
+import yaml
+
+from spacedrive.utils.expression import compile_expression
+
+# Orbits in the format of the solar system yaml, semimajor axes of planets in
+# AU and of moons in km, elements of http://stjarnhimlen.se/comp/tutorial.html
+SOLAR_SYSTEM = """
+Mercury:
+  orbit:
+    a: 0.387098
+    e: 'lambda d: 0.205635 + 5.59E-10 * d'
+    i: 'lambda d: 7.0047 + 5.00E-8 * d'
+    N: 'lambda d: 48.3313 + 3.24587E-5 * d'
+    w: 'lambda d: 29.1241 + 1.01444E-5 * d'
+    M: 'lambda d: 168.6562 + 4.0923344368 * d'
+Venus:
+  orbit:
+    a: 0.723330
+    e: 'lambda d: 0.006773 - 1.302E-9 * d'
+    i: 'lambda d: 3.3946 + 2.75E-8 * d'
+    N: 'lambda d: 76.6799 + 2.46590E-5 * d'
+    w: 'lambda d: 54.8910 + 1.38374E-5 * d'
+    M: 'lambda d: 48.0052 + 1.6021302244 * d'
+Earth:
+  orbit:
+    a: 1.0
+    e: 'lambda d: 0.016709 - 1.151E-9 * d'
+    i: 'lambda d: 0.0'
+    N: 'lambda d: 0.0'
+    w: 'lambda d: 282.9404 + 4.70935E-5 * d'
+    M: 'lambda d: 356.0470 + 0.9856002585 * d'
+Moon:
+  orbit:
+    a: 384400
+    e: 'lambda d: 0.054900'
+    i: 'lambda d: 5.1454'
+    N: 'lambda d: 125.1228 - 0.0529538083 * d'
+    w: 'lambda d: 318.0634 + 0.1643573223 * d'
+    M: 'lambda d: 115.3654 + 13.0649929509 * d'
+Mars:
+  orbit:
+    a: 1.523688
+    e: 'lambda d: 0.093405 + 2.516E-9 * d'
+    i: 'lambda d: 1.8497 - 1.78E-8 * d'
+    N: 'lambda d: 49.5574 + 2.11081E-5 * d'
+    w: 'lambda d: 286.5016 + 2.92961E-5 * d'
+    M: 'lambda d: 18.6021 + 0.5240207766 * d'
+Jupiter:
+  orbit:
+    a: 5.20256
+    e: 'lambda d: 0.048498 + 4.469E-9 * d'
+    i: 'lambda d: 1.3030 - 1.557E-7 * d'
+    N: 'lambda d: 100.4542 + 2.76854E-5 * d'
+    w: 'lambda d: 273.8777 + 1.64505E-5 * d'
+    M: 'lambda d: 19.8950 + 0.0830853001 * d'
+"""
+DAYS = (-3000.5, 0.0, 1.0, 9031.25, 36525.0)
+
+
+def get_formulas():
+    """Returns (body, element, formula) of every orbit formula."""
+    bodies = yaml.safe_load(SOLAR_SYSTEM)
+    return [(body, element, formula)
+            for body, database in sorted(bodies.items())
+            for element, formula in sorted(database['orbit'].items())]
+
+
+@pytest.mark.parametrize('body, element, formula', get_formulas())
+def test_yaml_formulas_match_eval(body, element, formula):
+    expression = compile_expression(formula)
+    assert expression.linear is not None
+    base, rate = expression.linear
+    for day in DAYS:
+        if isinstance(formula, str):
+            expected = eval(formula)(day)
+        else:
+            expected = formula
+        assert expression(day) == pytest.approx(expected, rel=1e-15)
+        assert base + rate * day == pytest.approx(expected, rel=1e-12,
+                                                  abs=1e-12)
+
+
+@pytest.mark.parametrize('formula, expected', [
+    ('sin(radians(d)) + 2 ** 0.5', math.sin(math.radians(3.0)) + 2 ** 0.5),
+    ('lambda t: atan2(t, 1) * pi', math.atan2(3.0, 1) * math.pi),
+    ('-d % 2', -3.0 % 2),
+    (12, 12.0),
+])
+def test_nonlinear_formulas(formula, expected):
+    assert compile_expression(formula)(3.0) == pytest.approx(expected)
+
+
+@pytest.mark.parametrize('formula', [
+    # Calls of anything but the math functions
+    "__import__('os').system('true')",
+    'open(d)',
+    'eval(d)',
+    'sin(x=d)',
+    '(lambda: 1)()',
+    # Attribute access
+    'd.real',
+    'd.__class__.__subclasses__()',
+    'math.pi',
+    # Subscripts
+    'd[0]',
+    '(1, 2)[0]',
+    # Strings and other constants
+    "'text'",
+    "b'bytes'",
+    'True',
+    'None',
+    # Other names and lambdas of other shapes
+    'x + 1',
+    'lambda d, x: d',
+    'lambda *d: d',
+    'lambda: 1',
+    '[d for d in (1, 2)]',
+    'd if d else 1',
+    'd < 1',
+    'd // 2',
+    'not d',
+])
+def test_rejected(formula):
+    with pytest.raises(ValueError):
+        compile_expression(formula)
+
+
+@pytest.mark.parametrize('formula', [True, None, [1.0]])
+def test_rejected_values(formula):
+    with pytest.raises(ValueError):
+        compile_expression(formula)
@@ -0,0 +1,116 @@
+"""Tests of the vectorized orbit solver against calc_body_pos."""
+
+import numpy as np
+from panda3d.core import LPoint3d
+
+from spacedrive import celestial_components
+from spacedrive import orbit_system
+
+# calc_body_pos only refines positive eccentric anomalies, keep the mean
+# anomalies of every body positive
+DAYS = (0.0, 1234.5, 9031.25, 20000.0)
+# Meters, and the part of the distance from the origin, the two solvers may
+# differ by. Both stop once a Newton step is below KEPLER_TOLERANCE, the
+# vectorized one only once every body of the call is, which leaves the
+# eccentric anomaly of a comet about 1e-11 apart.
+ATOL = 1e-3
+RTOL = 1e-10
+
+
+class Entity(object):
+    """Parent entity of a body, holding its CelestialComponent."""
+    def __init__(self, component=None):
+        self.component = component
+
+    def has_component(self, component_type):
+        return self.component is not None
+
+    def get_component(self, component_type):
+        return self.component
+
+
+def make_body(name, kind, orbit, parent):
+    return celestial_components.CelestialComponent(
+        name, Entity(parent), kind=celestial_components.TYPES[kind],
+        orbit=orbit)
+
+
+def make_bodies():
+    """Returns a star off the origin and its bodies, children before their
+    parents: a moon of a moon, an eccentric moon, an elliptical planet and
+    a comet."""
+    star = celestial_components.CelestialComponent(
+        'Star', Entity(), true_pos=LPoint3d(1.0e9, -2.0e9, 3.0e8),
+        kind=celestial_components.TYPES['star'])
+    planet = make_body('Planet', 'solid', {
+        'a': 1.2, 'e': '0.2 + 1.0E-9 * d', 'i': 3.5, 'N': 48.3,
+        'w': '29.1 + 1.0E-5 * d', 'M': '168.6 + 0.9 * d'}, star)
+    moon = make_body('Moon', 'moon', {
+        'a': 384400, 'e': 0.3, 'i': 5.1, 'N': '125.1 - 0.05 * d',
+        'w': 318.1, 'M': '115.4 + 13.06 * d'}, planet)
+    submoon = make_body('Submoon', 'moon', {
+        'a': 20000, 'e': 0.1, 'i': 40.0, 'N': 10.0, 'w': 20.0,
+        'M': '0.0 + 90.0 * d'}, moon)
+    comet = make_body('Comet', 'solid', {
+        'a': 17.8, 'e': 0.967, 'i': 162.3, 'N': 58.4, 'w': 111.3,
+        'M': '38.4 + 0.013 * d'}, star)
+    return star, [submoon, comet, moon, planet]
+
+
+def reference(component, day):
+    """Returns the heliocentric position of component from calc_body_pos of
+    it and its ancestors."""
+    position = np.zeros(3)
+    while component is not None and component.orbit:
+        position += tuple(orbit_system.calc_body_pos(component, day))
+        component = orbit_system.get_parent_component(component)
+    if component is not None:
+        position += tuple(component.true_pos)
+    return position
+
+
+def assert_close(position, expected, message=None):
+    error = np.linalg.norm(position - expected)
+    assert error <= ATOL + RTOL * np.linalg.norm(expected), (message, error)
+
+
+def test_parents_before_children():
+    _, bodies = make_bodies()
+    batch = orbit_system.OrbitBatch(bodies)
+    names = [component.name for component in batch.components]
+    for index, parent in enumerate(batch.parents.tolist()):
+        assert parent < index
+    assert names.index('Planet') < names.index('Moon') \
+        < names.index('Submoon')
+
+
+def test_batch_matches_calc_body_pos():
+    _, bodies = make_bodies()
+    batch = orbit_system.OrbitBatch(bodies)
+    for day in DAYS:
+        positions = batch.heliocentric(day)
+        for component, position in zip(batch.components, positions):
+            assert_close(position, reference(component, day),
+                         (component.name, day))
+
+
+def test_columns_and_days_match_calc_body_pos():
+    _, bodies = make_bodies()
+    batch = orbit_system.OrbitBatch(bodies)
+    columns = np.array([len(batch) - 1])
+    positions = batch.heliocentric(np.array(DAYS), columns)
+    component = batch.components[-1]
+    for day, position in zip(DAYS, positions[0]):
+        assert_close(position, reference(component, day), day)
+
+
+def test_paths_match_calc_body_pos():
+    _, bodies = make_bodies()
+    batch = orbit_system.OrbitBatch(bodies)
+    days, positions = batch.paths(0.0, 400.0)
+    assert positions.shape == days.shape + (3,)
+    for row, component in enumerate(batch.components):
+        for column in (0, 7, days.shape[1] - 1):
+            assert_close(positions[row, column],
+                         reference(component, days[row, column]),
+                         component.name)
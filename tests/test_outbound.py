@@ -0,0 +1,112 @@
+"""Tests of outbound message batching."""
+
+import struct
+
+from spacedrive.networking import outbound
+from spacedrive.networking import protocol
+
+ADDRESS = ('127.0.0.1', 1999)
+OTHER = ('127.0.0.1', 2000)
+
+
+def throttle(normal):
+    return bytes(protocol.encode(protocol.REQUEST_THROTTLE, (normal, 0.0)))
+
+
+def login(name):
+    return bytes(protocol.encode(protocol.LOGIN, (protocol.to_bytes(name),)))
+
+
+def unpack(datagram):
+    """Returns the (msg_id, payload) of a flushed datagram."""
+    _, msg_id, payload, _ = datagram
+    if msg_id == protocol.BATCH:
+        return [(sub_id, bytes(sub_payload)) for sub_id, sub_payload
+                in outbound.unpack_batch(payload)]
+    return [(msg_id, payload)]
+
+
+def test_single_message_is_not_batched():
+    queue = outbound.OutboundQueue()
+    queue.put(ADDRESS, protocol.LOGIN, login('pilot'))
+    assert queue.flush() == [(ADDRESS, protocol.LOGIN, login('pilot'),
+                              (protocol.LOGIN,))]
+    assert len(queue) == 0
+    assert queue.flush() == []
+
+
+def test_superseded_messages_collapse():
+    queue = outbound.OutboundQueue()
+    queue.put(ADDRESS, protocol.REQUEST_THROTTLE, throttle(0.1))
+    queue.put(ADDRESS, protocol.LOGIN, login('pilot'))
+    queue.put(ADDRESS, protocol.REQUEST_THROTTLE, throttle(0.2))
+    queue.put(OTHER, protocol.REQUEST_THROTTLE, throttle(0.3))
+    assert len(queue) == 3
+    datagrams = queue.flush()
+    assert [datagram[0] for datagram in datagrams] == [ADDRESS, OTHER]
+    # The newest throttle keeps the place of the first one
+    assert unpack(datagrams[0]) == [
+        (protocol.REQUEST_THROTTLE, throttle(0.2)),
+        (protocol.LOGIN, login('pilot'))]
+    assert unpack(datagrams[1]) == [
+        (protocol.REQUEST_THROTTLE, throttle(0.3))]
+
+
+def test_other_messages_are_kept():
+    queue = outbound.OutboundQueue()
+    for name in ('a', 'b', 'c'):
+        queue.put(ADDRESS, protocol.LOGIN, login(name))
+    datagram, = queue.flush()
+    assert datagram[1] == protocol.BATCH
+    assert datagram[3] == (protocol.LOGIN,) * 3
+    assert unpack(datagram) == [(protocol.LOGIN, login(name))
+                                for name in ('a', 'b', 'c')]
+
+
+def test_split_at_mtu():
+    mtu = 200
+    queue = outbound.OutboundQueue(mtu=mtu)
+    messages = [(protocol.LOGIN, login(str(index))) for index in range(20)]
+    for msg_id, payload in messages:
+        queue.put(ADDRESS, msg_id, payload)
+    datagrams = queue.flush()
+    assert len(datagrams) > 1
+    for datagram in datagrams:
+        assert len(datagram[2]) <= mtu
+    assert [message for datagram in datagrams
+            for message in unpack(datagram)] == messages
+
+
+def test_oversized_message_goes_out_alone():
+    queue = outbound.OutboundQueue(mtu=64)
+    queue.put(ADDRESS, protocol.LOGIN, login('a'))
+    queue.put(ADDRESS, protocol.POS_PHYS_UPDATE, b'\0' * 100)
+    queue.put(ADDRESS, protocol.LOGIN, login('b'))
+    datagrams = queue.flush()
+    assert [datagram[3] for datagram in datagrams] == [
+        (protocol.LOGIN,), (protocol.POS_PHYS_UPDATE,), (protocol.LOGIN,)]
+
+
+def test_nested_batch_is_dropped():
+    inner = outbound.pack_batch([(protocol.LOGIN, login('inner'))])
+    data = outbound.pack_batch([(protocol.BATCH, inner),
+                                (protocol.LOGIN, login('outer'))])
+    assert [(msg_id, bytes(payload)) for msg_id, payload
+            in outbound.unpack_batch(data)] == [
+        (protocol.LOGIN, login('outer'))]
+
+
+def test_truncated_batch_ends_at_last_whole_message():
+    header = len(outbound.pack_batch([]))
+    data = outbound.pack_batch([(protocol.LOGIN, login('a')),
+                                (protocol.LOGIN, login('b'))])
+    entry = (len(data) - header) // 2
+    for size in range(len(data) + 1):
+        messages = list(outbound.unpack_batch(data[:size]))
+        assert len(messages) == max(size - header, 0) // entry
+
+
+def test_batch_count_beyond_data():
+    data = struct.pack('<H', 1000) + outbound.pack_batch(
+        [(protocol.LOGIN, login('a'))])[2:]
+    assert len(list(outbound.unpack_batch(data))) == 1
@@ -0,0 +1,71 @@
+"""Tests of the binary network protocol."""
+
+import numpy as np
+import pytest
+
+from spacedrive.networking import protocol
+
+MESSAGES = [message.id for message in protocol.MESSAGES]
+
+
+def make_message(msg_id, count=2):
+    """Returns (values, records) of a message with every byte of its fields
+    set to 1 and of its records to 2."""
+    message = protocol.get_message(msg_id)
+    values = message.header.unpack(b'\x01' * message.header.size)
+    if message.dtype is None:
+        return values, None
+    records = np.frombuffer(b'\x02' * (count * message.dtype.itemsize),
+                            dtype=message.dtype)
+    return values[:-1], records
+
+
+@pytest.mark.parametrize('msg_id', MESSAGES)
+def test_round_trip(msg_id):
+    values, records = make_message(msg_id)
+    data = bytes(protocol.encode(msg_id, values, records))
+    assert len(data) == protocol.get_message(msg_id).size(
+        0 if records is None else len(records))
+    decoded_values, decoded_records = protocol.decode(msg_id, data)
+    assert tuple(decoded_values) == tuple(values)
+    if records is None:
+        assert decoded_records is None
+    else:
+        assert decoded_records.tobytes() == records.tobytes()
+
+
+def test_round_trip_without_records():
+    values, _ = make_message(protocol.PLAYER_SHIPS)
+    data = bytes(protocol.encode(protocol.PLAYER_SHIPS, values))
+    assert len(protocol.decode(protocol.PLAYER_SHIPS, data)[1]) == 0
+
+
+def test_text_fields():
+    data = bytes(protocol.encode(protocol.LOGIN,
+                                 (protocol.to_bytes('pilot'),)))
+    values, _ = protocol.decode(protocol.LOGIN, data)
+    assert protocol.to_text(values.username) == 'pilot'
+
+
+@pytest.mark.parametrize('msg_id', MESSAGES)
+def test_truncated(msg_id):
+    values, records = make_message(msg_id)
+    data = bytes(protocol.encode(msg_id, values, records))
+    for size in (0, len(data) - 1):
+        assert protocol.decode(msg_id, data[:size]) is None
+
+
+@pytest.mark.parametrize('msg_id', [len(protocol.MESSAGES), 255])
+def test_unknown_type(msg_id):
+    assert protocol.decode(msg_id, b'\0' * 64) is None
+
+
+def test_too_many_records():
+    message = protocol.get_message(protocol.SHIP_CLASSES)
+    records = message.empty(protocol.MAX_RECORDS + 1)
+    with pytest.raises(ValueError, match='at most 65535'):
+        protocol.encode(protocol.SHIP_CLASSES, (), records)
+    data = bytes(protocol.encode(protocol.SHIP_CLASSES, (),
+                                 records[:protocol.MAX_RECORDS]))
+    assert len(protocol.decode(protocol.SHIP_CLASSES, data)[1]) \
+        == protocol.MAX_RECORDS
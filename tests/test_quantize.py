@@ -0,0 +1,75 @@
+"""Tests of the quantized ship state used by replication."""
+
+import numpy as np
+
+from spacedrive.networking import quantize
+from spacedrive.networking import replication
+
+TICK_RATE = replication.DEFAULT_TICK_RATE
+
+
+def make_states(positions, velocities):
+    """Returns STATE of ships with ids 0 to n at (n, 3) positions and
+    velocities relative to a SOI body at the origin."""
+    states = np.zeros(len(positions), dtype=quantize.STATE)
+    states['ship_id'] = np.arange(len(positions))
+    states['qw'] = 1.0
+    for column, axis in enumerate('xyz'):
+        states[axis] = positions[:, column]
+        states['v' + axis] = velocities[:, column]
+    return states
+
+
+def encode(quantizer, states):
+    zeros = np.zeros((len(states), 3))
+    return quantizer.encode(states, zeros, zeros)
+
+
+def test_round_trip():
+    quantizer = quantize.Quantizer()
+    positions = np.array([[1.0e6, -2.0e6, 3.0e5], [4.0e8, 1.0e8, -2.0e8]])
+    velocities = np.array([[7500.0, -10.0, 0.5], [-30000.0, 0.0, 12.0]])
+    states = quantizer.decode(encode(quantizer,
+                                     make_states(positions, velocities)))
+    steps = quantizer.steps[[0, 2]][:, None]
+    positions_back = quantize.get_columns(states, ('x', 'y', 'z'))
+    velocities_back = quantize.get_columns(states, ('vx', 'vy', 'vz'))
+    assert np.all(np.abs(positions_back - positions) <= steps / 2)
+    assert np.all(np.abs(velocities_back - velocities)
+                  <= steps / quantize.VELOCITY_SCALE)
+
+
+def test_predict_in_hops_matches_one_hop():
+    quantizer = quantize.Quantizer()
+    rng = np.random.default_rng(0)
+    records = encode(quantizer, make_states(
+        rng.uniform(-1.0e7, 1.0e7, (50, 3)),
+        rng.uniform(-3000, 3000, (50, 3))))
+    hopped = records
+    for _ in range(120):
+        hopped = quantizer.predict(hopped, 1.0 / TICK_RATE)
+    direct = quantizer.predict(records, 120 / TICK_RATE)
+    for field in ('px', 'py', 'pz'):
+        assert np.all(np.abs(hopped[field] - direct[field]) <= 1)
+
+
+def test_coasting_ship_leaves_out_positions():
+    """Ships moving in a straight line are predicted by the client, their
+    position columns are not sent again."""
+    quantizer = quantize.Quantizer()
+    rng = np.random.default_rng(1)
+    address = ('127.0.0.1', 1999)
+    for radius in (1.0e7, 5.0e8):
+        # Everything in the first delta, only the later ones are checked
+        replicator = replication.Replicator(quantizer=quantizer,
+                                            max_payload=1 << 20)
+        positions = rng.uniform(-radius / 2, radius / 2, (100, 3))
+        velocities = rng.uniform(-3000, 3000, (100, 3))
+        for tick in range(1, 240):
+            records = encode(quantizer, make_states(
+                positions + velocities * tick / TICK_RATE, velocities))
+            payload = replicator.encode(address, tick, records)
+            replicator.acknowledge(address, tick)
+            if tick > 1:
+                ids = replication.read_delta(payload)[2]
+                assert len(ids) == 0, (radius, tick)
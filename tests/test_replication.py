@@ -0,0 +1,205 @@
+"""Tests of delta replication between Replicator and SnapshotReceiver."""
+
+import numpy as np
+
+from spacedrive.networking import interest
+from spacedrive.networking import protocol
+from spacedrive.networking import quantize
+from spacedrive.networking import replication
+
+ADDRESS = ('127.0.0.1', 1999)
+
+
+def make_records(ids, rng):
+    """Returns quantized records of ships with ids at random positions of
+    the first band."""
+    records = np.zeros(len(ids), dtype=replication.RECORD)
+    records['ship_id'] = ids
+    for field in ('px', 'py', 'pz'):
+        records[field] = rng.integers(-10 ** 8, 10 ** 8, len(ids))
+    for field in ('vx', 'vy', 'vz'):
+        records[field] = rng.integers(-10 ** 6, 10 ** 6, len(ids))
+    records['quat'] = rng.integers(0, 2 ** 32, len(ids), dtype=np.uint32)
+    return records
+
+
+def coast(records, ticks):
+    """Returns records moved along their velocities for ticks, as the server
+    would quantize them."""
+    moved = replication.predict(records,
+                                ticks / replication.DEFAULT_TICK_RATE)
+    result = np.zeros(len(moved), dtype=replication.RECORD)
+    for field in replication.RECORD.names:
+        result[field] = moved[field]
+    return result
+
+
+def send(replicator, receiver, tick, records, delivered=True):
+    """Encodes records for ADDRESS and decodes them if delivered. Returns
+    the payload and the server's rebuilt snapshot."""
+    payload = replicator.encode(ADDRESS, tick, records)
+    rebuilt = replicator.get_client(ADDRESS).sent[tick]
+    if delivered:
+        decoded = receiver.decode(payload)
+        assert decoded is not None
+        assert decoded[0] == tick
+        assert decoded[1].tobytes() == rebuilt.tobytes()
+    return payload, rebuilt
+
+
+def test_rebuilt_matches_receiver():
+    """Client and server rebuild the same snapshots through loss, ack lag
+    and changing ships."""
+    rng = np.random.default_rng(0)
+    replicator = replication.Replicator()
+    receiver = replication.SnapshotReceiver()
+    records = make_records(np.arange(40), rng)
+    acks = []
+    for tick in range(1, 600):
+        records = coast(records, 1)
+        changed = rng.random(len(records)) < 0.1
+        records['vx'][changed] += rng.integers(-1000, 1000,
+                                               np.count_nonzero(changed))
+        delivered = rng.random() > 0.2
+        send(replicator, receiver, tick, records, delivered)
+        if delivered:
+            acks.append(tick)
+        if len(acks) > 3:
+            replicator.acknowledge(ADDRESS, acks.pop(0))
+
+
+def test_old_baseline_sends_full_snapshot():
+    rng = np.random.default_rng(1)
+    replicator = replication.Replicator(max_baseline_age=10)
+    receiver = replication.SnapshotReceiver()
+    records = make_records(np.arange(20), rng)
+    full, _ = send(replicator, receiver, 1, records)
+    replicator.acknowledge(ADDRESS, 1)
+    payload, _ = send(replicator, receiver, 2, coast(records, 1))
+    assert replication.read_delta(payload)[1] == 1
+    payload, _ = send(replicator, receiver, 20, coast(records, 19))
+    assert replication.read_delta(payload)[1] == replication.NO_BASELINE
+    assert len(payload) == len(full)
+
+
+def test_unknown_baseline_is_dropped():
+    """A client that lost its baseline drops the delta, the server falls
+    back to a full snapshot once it stops getting acks."""
+    rng = np.random.default_rng(2)
+    replicator = replication.Replicator(max_baseline_age=10)
+    records = make_records(np.arange(20), rng)
+    send(replicator, replication.SnapshotReceiver(), 1, records)
+    replicator.acknowledge(ADDRESS, 1)
+    receiver = replication.SnapshotReceiver()
+    payload, _ = send(replicator, receiver, 2, coast(records, 1),
+                      delivered=False)
+    assert receiver.decode(payload) is None
+    send(replicator, receiver, 12, coast(records, 11))
+
+
+def test_restarted_client_recovers_while_acking():
+    """A client that restarted on the same address drops deltas against
+    the baseline of its old run. Only ticks it rebuilt move the baseline,
+    so the stale acks stop counting once the baseline is too old and a full
+    snapshot goes out."""
+    rng = np.random.default_rng(5)
+    replicator = replication.Replicator(max_baseline_age=10)
+    records = make_records(np.arange(20), rng)
+    send(replicator, replication.SnapshotReceiver(), 1, records)
+    replicator.acknowledge(ADDRESS, 1)
+    receiver = replication.SnapshotReceiver()
+    decoded = []
+    for tick in range(2, 40):
+        payload = replicator.encode(ADDRESS, tick, coast(records, tick - 1))
+        if receiver.decode(payload) is not None:
+            decoded.append(tick)
+        # Acks of the old run keep arriving
+        replicator.acknowledge(ADDRESS, 1)
+        if receiver.latest_tick is not None:
+            replicator.acknowledge(ADDRESS, receiver.latest_tick)
+    assert decoded
+    assert decoded == list(range(decoded[0], 40))
+    assert decoded[0] <= 12
+
+
+def test_login_starts_from_full_snapshot():
+    rng = np.random.default_rng(6)
+    replicator = replication.Replicator()
+    records = make_records(np.arange(20), rng)
+    send(replicator, replication.SnapshotReceiver(), 1, records)
+    replicator.acknowledge(ADDRESS, 1)
+    replicator.remove_client(ADDRESS)
+    payload, _ = send(replicator, replication.SnapshotReceiver(), 2,
+                      coast(records, 1))
+    assert replication.read_delta(payload)[1] == replication.NO_BASELINE
+
+
+def test_added_and_removed_ships():
+    rng = np.random.default_rng(3)
+    replicator = replication.Replicator()
+    receiver = replication.SnapshotReceiver()
+    records = make_records(np.arange(10), rng)
+    send(replicator, receiver, 1, records)
+    replicator.acknowledge(ADDRESS, 1)
+    kept = coast(records, 1)[2:]
+    added = make_records(np.arange(10, 13), rng)
+    records = np.concatenate((kept, added))
+    payload, rebuilt = send(replicator, receiver, 2, records)
+    _, _, ids, _, removed, _ = replication.read_delta(payload)
+    assert set(removed.tolist()) == {0, 1}
+    assert {10, 11, 12} <= set(ids.tolist())
+    assert rebuilt['ship_id'].tolist() == list(range(2, 13))
+
+
+def test_coasting_delta_is_small():
+    rng = np.random.default_rng(4)
+    replicator = replication.Replicator(max_payload=1 << 20)
+    receiver = replication.SnapshotReceiver()
+    records = make_records(np.arange(100), rng)
+    full, _ = send(replicator, receiver, 1, records)
+    sizes = []
+    for tick in range(2, 120):
+        replicator.acknowledge(ADDRESS, tick - 1)
+        payload, _ = send(replicator, receiver, tick,
+                          coast(records, tick - 1))
+        sizes.append(len(payload))
+    assert max(sizes) * 10 < len(full)
+
+
+def test_full_snapshot_is_split():
+    """Ships the client lacks beyond max_payload follow in later ticks."""
+    rng = np.random.default_rng(7)
+    replicator = replication.Replicator()
+    receiver = replication.SnapshotReceiver()
+    records = make_records(np.arange(500), rng)
+    for tick in range(1, 40):
+        payload, rebuilt = send(replicator, receiver, tick,
+                                coast(records, tick - 1))
+        assert len(payload) <= replication.MAX_PAYLOAD
+        replicator.acknowledge(ADDRESS, receiver.latest_tick)
+    assert rebuilt['ship_id'].tolist() == list(range(500))
+
+
+def test_new_client_within_budget():
+    """Relevant ships a new client lacks are sent as they are selected,
+    within the budget of the InterestManager."""
+    budget = 600
+    states = np.zeros(60, dtype=quantize.STATE)
+    states['ship_id'] = np.arange(60)
+    states['x'] = np.linspace(0.0, 5000.0, 60)
+    states['qw'] = 1.0
+    zeros = np.zeros((60, 3))
+    records = quantize.get_quantizer().encode(states, zeros, zeros)
+    manager = interest.InterestManager(budget=budget)
+    replicator = replication.Replicator()
+    receiver = replication.SnapshotReceiver()
+    header = protocol.get_message(protocol.POS_PHYS_DELTA).size()
+    for tick in range(1, 20):
+        selected, relevant = manager.select(ADDRESS, states, (0.0, 0.0, 0.0))
+        payload = replicator.encode(ADDRESS, tick, records, selected,
+                                    relevant)
+        assert len(payload) - header <= budget
+        receiver.decode(payload)
+        replicator.acknowledge(ADDRESS, receiver.latest_tick)
+    snapshot = receiver.snapshots[receiver.latest_tick]
+    assert snapshot['ship_id'].tolist() == list(range(60))
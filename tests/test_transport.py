@@ -0,0 +1,127 @@
+"""Loopback tests of the threaded UDP transport."""
+
+import socket
+import time
+
+import pytest
+
+from spacedrive.networking import transport
+
+HOST = '127.0.0.1'
+# Room for two datagrams of the largest size and a few small ones, so the
+# ring wraps and fills up after a few dozen packets
+RING_SIZE = 2 * transport.MAX_DATAGRAM + 20000
+TIMEOUT = 5.0
+
+
+class Receiver(transport.AsyncUDPMixin):
+    """Network system keeping every packet handed to process_packet."""
+    def __init__(self, ring_size=RING_SIZE):
+        self.sequences = {}
+        self.transport = transport.Transport(HOST, 0, ring_size)
+        self.address = self.transport.sock.getsockname()
+        self.packets = []
+
+    def process_packet(self, msgID, remotePacketCount, ack, acks, hashID,
+                       serialized, address):
+        self.packets.append((msgID, remotePacketCount, serialized))
+
+
+def wait_for(condition):
+    deadline = time.time() + TIMEOUT
+    while not condition():
+        assert time.time() < deadline, "Timed out"
+        time.sleep(0.005)
+
+
+def make_payload(index):
+    """Returns a payload of a size varying with index, so the ring wraps at
+    different offsets."""
+    return bytes([index % 256]) * (1000 + index * 337 % 3000)
+
+
+@pytest.fixture
+def receiver():
+    receiver = Receiver()
+    yield receiver
+    receiver.stop()
+
+
+@pytest.fixture
+def sender():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind((HOST, 0))
+    yield sock
+    sock.close()
+
+
+def send(sock, address, index):
+    sock.sendto(transport.HEADER.pack(7, index % 256, 0, 0)
+                + make_payload(index), address)
+
+
+def test_ring_wraps_and_pauses(receiver, sender):
+    """More traffic than the ring holds pauses reading until the simulation
+    drains, payloads stay intact across the wraps."""
+    ring = receiver.transport
+    sent = 0
+    for _ in range(8):
+        for _ in range(50):
+            send(sender, receiver.address, sent)
+            sent += 1
+        wait_for(lambda: ring.paused)
+        assert ring.written - ring.released <= RING_SIZE
+        while len(receiver.packets) < sent:
+            receiver.drain()
+            time.sleep(0.005)
+    assert ring.written > 4 * RING_SIZE
+    assert ring.released == ring.written
+    assert len(receiver.packets) == sent
+    for index, (msg_id, sequence, payload) in enumerate(receiver.packets):
+        assert msg_id == 7
+        assert sequence == index % 256
+        assert payload == make_payload(index)
+
+
+def test_payloads_are_copies(receiver, sender):
+    send(sender, receiver.address, 1)
+    wait_for(lambda: len(receiver.transport.inbound) == 1)
+    receiver.drain()
+    payload = receiver.packets[0][2]
+    assert isinstance(payload, bytes)
+    # Overwrite the ring where the payload came from
+    receiver.transport.ring[:] = bytes(len(receiver.transport.ring))
+    assert payload == make_payload(1)
+
+
+def test_short_datagrams_are_dropped(receiver, sender):
+    sender.sendto(b'\0' * (transport.HEADER.size - 1), receiver.address)
+    send(sender, receiver.address, 2)
+    wait_for(lambda: len(receiver.transport.inbound) == 1)
+    receiver.drain()
+    assert [packet[2] for packet in receiver.packets] == [make_payload(2)]
+
+
+def test_acks_and_sequences(receiver):
+    other = Receiver()
+    try:
+        for index in (0, 1, 3):
+            packet = other.generateGenericPacket(5)
+            packet.appendData(bytes([index]))
+            # Skip sequence 2
+            other.sequences[receiver.address] = index
+            other.send_data(packet, receiver.address)
+        wait_for(lambda: len(receiver.transport.inbound) == 3)
+        receiver.drain()
+        assert [packet[1] for packet in receiver.packets] == [0, 1, 3]
+        assert receiver.get_sequence(other.address) == 0
+        packet = receiver.generateGenericPacket(5)
+        receiver.send_data(packet, other.address)
+        wait_for(lambda: len(other.transport.inbound) == 1)
+        msg_id, sequence, ack, acks = other.transport.inbound[0][:4]
+        # Sequence 3 is the newest, 1 and 0 are the second and third
+        # before it
+        assert (msg_id, sequence, ack, acks) == (5, 0, 3, 0b110)
+        assert receiver.get_sequence(other.address) == 1
+    finally:
+        other.stop()